@@ -1,2 +1,18 @@
-__all__ = ["default"]
-from .ananas import PineappleBot, ConfigurationError, reply, error_reporter, schedule, interval, hourly, daily, html_strip_tags
+__all__ = ["default", "PineappleBot", "ConfigurationError", "reply", "error_reporter", "schedule", "interval", "hourly", "daily", "html_strip_tags"]
+
+# Importing ananas.ananas pulls in Mastodon.py and requests, so only do it once
+# something from it is actually used; e.g. the runner's --workers supervisor
+# never needs it.
+def __getattr__(name):
+    if name in __all__ and name != "default":
+        from . import ananas
+        value = getattr(ananas, name)
+        globals()[name] = value
+        return value
+    if name == "default":
+        from . import default
+        return default
+    raise AttributeError("module 'ananas' has no attribute '{}'".format(name))
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
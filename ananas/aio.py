@@ -0,0 +1,142 @@
+import sys, asyncio, functools, inspect, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from .ananas import PineappleBot, next_run, handler_kind, record_job_run
+
+class AsyncRuntime():
+    """
+    Opt-in asyncio runtime for PineappleBots. Pass one instance as the
+    runtime of every bot (the ananas runner does this with --asyncio) and
+    their @interval/@schedule jobs, @reply handlers and @error_reporters all
+    run as tasks on a single event loop instead of on threads of their own.
+
+    Handlers may be either plain functions or async def coroutine functions.
+    Plain functions, and blocking Mastodon.py calls made through
+    bot.amastodon, are run in a bounded executor so they don't stall the loop.
+
+    The loop runs on a background thread so that the runner's main thread is
+    left free to handle signals.
+    """
+
+    def __init__(self, max_workers=8):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="ananas-io")
+        self.loop.set_default_executor(self.executor)
+        self.thread = None
+        self.tasks = {}
+
+    def start(self):
+        if self.thread: return
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name="ananas-loop", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Cancel all remaining tasks and stop the event loop. """
+        if not self.thread: return
+        async def cancel_all():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self.submit(cancel_all()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.executor.shutdown(wait=True)
+
+    def in_loop(self):
+        """ Whether the caller is running on the event loop's thread. """
+        return threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        """ Run coro on the event loop from any thread; returns a
+        concurrent.futures.Future for its result. """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def spawn(self, coro):
+        """ Start coro as a task from the event loop's own thread. """
+        return self.loop.create_task(coro)
+
+    async def call(self, f, *args):
+        """ Await f if it's a coroutine function, otherwise run it in the
+        executor. """
+        if inspect.iscoroutinefunction(f):
+            return await f(*args)
+        return await self.loop.run_in_executor(self.executor, functools.partial(f, *args))
+
+    # Scheduling, with the same interface as ananas.Scheduler
+
+    def add(self, bot, f):
+        if next_run(f) is None: return None
+        future = self.submit(self._track(bot, self._job(bot, f)))
+        bot.log(f.__name__, "Started")
+        return future
+
+    def call_later(self, delay, f, *args, bot=None):
+        """ Run f(*args) once after delay seconds, in the executor if it's a
+        plain function. Returns a Future which can be cancelled. """
+        async def call():
+            await asyncio.sleep(delay)
+            try:
+                await self.call(f, *args)
+            except Exception as e:
+                error = "Exception encountered in scheduled call: {}\n{}".format(repr(e), traceback.format_exc())
+                if bot: bot.report_error(error, f.__name__)
+                else: print(error, file=sys.stderr)
+        return self.submit(self._track(bot, call()) if bot else call())
+
+    def remove(self, bot):
+        def cancel():
+            for task in self.tasks.pop(bot, ()): task.cancel()
+        if self.thread: self.loop.call_soon_threadsafe(cancel)
+
+    async def _track(self, bot, coro):
+        task = asyncio.current_task()
+        self.tasks.setdefault(bot, set()).add(task)
+        try:
+            return await coro
+        finally:
+            self.tasks.get(bot, set()).discard(task)
+
+    async def _job(self, bot, f):
+        name = f.__name__
+        t = datetime.now()
+        when = next_run(f, t, t)
+        while when is not None:
+            delay = (when - datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if bot.state == PineappleBot.STOPPING:
+                bot.log(name, "Shutting down")
+                return
+            start = datetime.now()
+            try:
+                with bot.timer("ananas_handler_seconds", handler=name, kind=handler_kind(f)):
+                    await self.call(f)
+            except Exception as e:
+                error = "Exception encountered in @interval function: {}\n{}".format(repr(e), traceback.format_exc())
+                bot.report_error(error, name)
+
+            t = datetime.now()
+            record_job_run(bot, f, when, start, t)
+            when = next_run(f, t, t)
+            if when is None: break
+            when = max(when, t + timedelta(seconds=1))
+            if bot.verbose: bot.log(name + ".debug", "Next run at {:%Y-%m-%d %H:%M:%S}".format(when))
+        bot.log(name, "Schedule will never match again, stopping")
+
+    # Replies
+
+    async def reply(self, bot, status, user):
+        """ Run all of bot's @reply handlers for a mention concurrently. """
+        async def handle(f):
+            try:
+                with bot.timer("ananas_handler_seconds", handler=f.__name__, kind="reply"):
+                    await self.call(f, status, user)
+            except Exception as e:
+                error = "Fatal exception: {}\n{}".format(repr(e), traceback.format_exc())
+                bot.report_error(error, f.__name__)
+        await self._track(bot, asyncio.gather(*[handle(f) for f in bot.reply_funcs]))
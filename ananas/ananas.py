@@ -1,12 +1,23 @@
-import os, sys, re, time, threading, _thread
-import warnings, tempfile
+import os, sys, re, time, threading, _thread, heapq, itertools, random
+import warnings, tempfile, functools, atexit
+from concurrent.futures import ThreadPoolExecutor
 import configparser, inspect, getpass, traceback
 from datetime import datetime, timedelta, timezone
+from collections import deque
 from collections.abc import Iterable
 from html.parser import HTMLParser
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
 import mastodon
 from mastodon import Mastodon, StreamListener
-from configobj import ConfigObj
+from .metrics import metrics
+from .state import StateStore
+from .pregen import Pregenerator
+
+# asyncio and configobj are imported where they're used, since most bots never
+# need asyncio and the runner's --workers supervisor never needs either
 
 # TODO: Polish up sample bots for distribution (and real use!)
 # TODO: Final pass on code quality and commenting
@@ -31,66 +42,187 @@ def interval(seconds):
         return f
     return wrapper
 
-def _cronslash(s, cat):
-    duration = {
-        "second": 60,
-        "minute": 60,
-        "hour": 24,
-        "day_of_week": 7,
-        "day_of_month": 31,
-        "month": 12,
-        "year": 9999, # Increase if this library is still in use in CE 9999
-    }[cat]
-    match = re.match(r"\*/(\d+)", s)
-    n = None
-    if match:
-        n = int(match.group(1))
-    elif s == "*":
-        n = 1
-    #print("range(0, {}, {})".format(duration, n))
-    if n:
-        return range(0, duration, n)
-    return None
-
-def _expand_scheduledict(scheduledict):
-    """Converts a dict of items, some of which are scalar and some of which are
-    lists, to a list of dicts with scalar items."""
-    result = []
-    def f(d):
-        nonlocal result
-        #print(d)
-        d2 = {}
-        for k,v in d.items():
-            if isinstance(v, str) and _cronslash(v, k) is not None:
-                d[k] = _cronslash(v, k)
-
-        for k,v in d.items():
-            if isinstance(v, Iterable):
+# Bounds (inclusive) of each field a schedule can be restricted on, in the
+# order they are resolved when looking for the next matching time.
+_schedule_fields = (
+    ("year", 1, 9999), # Increase if this library is still in use in CE 9999
+    ("month", 1, 12),
+    ("day_of_month", 1, 31),
+    ("day_of_week", 0, 6),
+    ("hour", 0, 23),
+    ("minute", 0, 59),
+    ("second", 0, 59),
+)
+_schedule_bounds = {name: (lo, hi) for name, lo, hi in _schedule_fields}
+
+def _bitrange(start, stop, step=1):
+    """Bitmask with bits start, start+step, ... up to and including stop."""
+    if step == 1: return ((1 << (stop + 1)) - 1) ^ ((1 << start) - 1)
+    mask = 0
+    for v in range(start, stop + 1, step):
+        mask |= 1 << v
+    return mask
+
+def _cronfield(s, cat):
+    """Parse a cron-like field for <cat> into a bitmask of the values it
+    accepts. Accepts comma-separated lists of "*", "n", "a-b", each optionally
+    followed by a step, e.g. "*/15", "9-17", "1,15,30" or "0-30/10"."""
+    lo, hi = _schedule_bounds[cat]
+    mask = 0
+    for part in s.split(","):
+        match = re.match(r"\s*(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?\s*$", part)
+        if not match:
+            raise ValueError("Invalid value '{}' for schedule field {}".format(s, cat))
+        star, start, stop, step = match.groups()
+        if star == "*":
+            start, stop = lo, hi
+        else:
+            start = int(start)
+            stop = int(stop) if stop is not None else (hi if step else start)
+        step = int(step) if step is not None else 1
+        if step < 1 or start > stop:
+            raise ValueError("Invalid value '{}' for schedule field {}".format(s, cat))
+        if start < lo or stop > hi:
+            raise ValueError("Value '{}' out of range for schedule field {} ({}-{})".format(part.strip(), cat, lo, hi))
+        mask |= _bitrange(start, stop, step)
+    return mask
+
+def _next_bit(mask, v):
+    """Smallest set bit in mask at position >= v, or None."""
+    m = mask >> v
+    if not m: return None
+    return v + (m & -m).bit_length() - 1
+
+class Schedule():
+    """
+    A compiled @schedule specification. Each field is either None (matches
+    anything) or a bitmask of the values it accepts (bit n set means n is
+    accepted), so a spec takes the same few integers no matter how many times
+    it matches a day, and the next matching time can be found by resolving
+    one field at a time from the year down to the second.
+    """
+
+    def __init__(self, **kwargs):
+        unknown = set(kwargs) - set(_schedule_bounds)
+        if unknown:
+            raise ValueError("Unknown schedule field(s): {}".format(", ".join(sorted(unknown))))
+        for name, _, _ in _schedule_fields:
+            setattr(self, name, self._compile(kwargs[name], name) if name in kwargs else None)
+
+        # Seconds aren't treated as an open slot, otherwise schedule(minute=5)
+        # would run sixty times a minute.
+        if "second" not in kwargs: self.second = 1
+        # Only one of day_of_week and day_of_month may be used; day_of_month
+        # wins if both are given.
+        if self.day_of_month is not None: self.day_of_week = None
+
+    @staticmethod
+    def _compile(value, name):
+        if isinstance(value, str):
+            mask = _cronfield(value, name)
+        else:
+            values = value if isinstance(value, Iterable) else [value]
+            lo, hi = _schedule_bounds[name]
+            mask = 0
+            for v in values:
+                v = int(v)
+                if v < lo or v > hi:
+                    raise ValueError("Value {} out of range for schedule field {} ({}-{})".format(v, name, lo, hi))
+                mask |= 1 << v
+        lo, hi = _schedule_bounds[name]
+        # A field accepting every value is the same as leaving it open
+        if mask == _bitrange(lo, hi): return None
+        return mask
+
+    @staticmethod
+    def _next_value(mask, v):
+        """ Smallest accepted value >= v, or None. """
+        if mask is None: return v
+        return _next_bit(mask, v)
+
+    def _next_day(self, t):
+        """ Smallest day of t's month >= t.day matching the day spec, or None. """
+        days_in_month = ((t.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)).day
+        if self.day_of_month is not None:
+            day = _next_bit(self.day_of_month, t.day)
+        elif self.day_of_week is not None:
+            # Rotate the week so that bit 0 is t's weekday
+            weekday = t.weekday()
+            week = self.day_of_week | (self.day_of_week << 7)
+            day = t.day + _next_bit(week, weekday) - weekday
+        else:
+            day = t.day
+        if day is None or day > days_in_month: return None
+        return day
+
+    def matches(self, t):
+        """ Whether t (at a resolution of one second) fits this schedule. """
+        day_mask, day = ((self.day_of_month, t.day) if self.day_of_week is None
+                         else (self.day_of_week, t.weekday()))
+        for mask, v in ((self.year, t.year), (self.month, t.month), (day_mask, day),
+                        (self.hour, t.hour), (self.minute, t.minute), (self.second, t.second)):
+            if mask is not None and not (mask >> v) & 1: return False
+        return True
+
+    def next(self, t, inclusive=False):
+        """ Return the first datetime after t (or at t, if inclusive) matching
+        this schedule, at a resolution of one second, or None if this schedule
+        will never match again. """
+        if t.microsecond or not inclusive:
+            t = t.replace(microsecond=0) + timedelta(seconds=1)
+        while True:
+            year = self._next_value(self.year, t.year)
+            if year is None: return None
+            if year != t.year: t = datetime(year, 1, 1)
+
+            month = self._next_value(self.month, t.month)
+            if month is None:
+                if t.year == 9999: return None
+                t = datetime(t.year + 1, 1, 1)
                 continue
-            else:
-                d2[k] = v
+            if month != t.month: t = datetime(t.year, month, 1)
 
-        if len(d2.keys()) == len(d.keys()):
-            result.append(d2)
-            return
+            day = self._next_day(t)
+            if day is None:
+                if t.month == 12:
+                    if t.year == 9999: return None
+                    t = datetime(t.year + 1, 1, 1)
+                else:
+                    t = datetime(t.year, t.month + 1, 1)
+                continue
+            if day != t.day: t = datetime(t.year, t.month, day)
+
+            hour = self._next_value(self.hour, t.hour)
+            if hour is None:
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                continue
+            if hour != t.hour: t = t.replace(hour=hour, minute=0, second=0)
+
+            minute = self._next_value(self.minute, t.minute)
+            if minute is None:
+                t = t.replace(minute=0, second=0) + timedelta(hours=1)
+                continue
+            if minute != t.minute: t = t.replace(minute=minute, second=0)
 
-        for k,v in d.items():
-            if isinstance(v, Iterable):
-                for i in v:
-                    dprime = dict(**d)
-                    dprime[k] = i
-                    f(dprime)
-                break
-    f(scheduledict)
-    return result
+            second = self._next_value(self.second, t.second)
+            if second is None:
+                t = t.replace(second=0) + timedelta(minutes=1)
+                continue
+            return t.replace(second=second)
+
+    def __repr__(self):
+        def values(mask): return ",".join(str(v) for v in range(mask.bit_length()) if (mask >> v) & 1)
+        fields = ["{}={}".format(name, values(getattr(self, name))) for name, _, _ in _schedule_fields
+                  if getattr(self, name) is not None]
+        return "<Schedule {}>".format(" ".join(fields))
 
 def schedule(**kwargs):
     def wrapper(f):
-        schedules = _expand_scheduledict(kwargs)
+        compiled = Schedule(**kwargs)
         if (not hasattr(f, "schedule")):
-            f.schedule = schedules
+            f.schedule = [compiled]
         else:
-            f.schedule.extend(schedules)
+            f.schedule.append(compiled)
         return f
     return wrapper
 
@@ -106,86 +238,728 @@ def total_seconds(dt):
     """Returns the total number of seconds in a timedelta."""
     return dt.seconds + dt.days * 24 * 60 * 60
 
-def interval_next(f, t = datetime.now(), tLast = datetime.now()):
+def next_run(f, t=None, tLast=None):
     """
-    Calculate the number of seconds from now until the function should next run.
-    This function handles both cron-like and interval-like scheduling via the
-    following:
-     ∗ If no interval and no schedule are specified, return 0
-     ∗ If an interval is specified but no schedule, return the number of seconds
-       from <t> until <interval> has passed since <tLast> or 0 if it's overdue.
-     ∗ If a schedule is passed but no interval, figure out when next to run by
-       parsing the schedule according to the following rules:
-         ∗ If all of second, minute, hour, day_of_week/day_of_month, month, year
-           are specified, then the time to run is singular and the function will
-           run only once at that time. If it has not happened yet, return the
-           number of seconds from <t> until that time, otherwise return -1.
-         ∗ If one or more are unspecified, then they are treated as open slots.
-           return the number of seconds from <t> until the time next fits within
-           the specified constraints, or if it never will again return -1.
-             ∗ Only one of day_of_week and day_of_month may be specified. if both
-               are specified, then day_of_month is used and day_of_week is ignored.
-         ∗ If all are unspecified treat it as having no schedule specified
-     ∗ If both a schedule and an interval are specified, TODO but it should do
-       something along the lines of finding the next multiple of interval from tLast
-       that fits the schedule spec and returning the number of seconds until then.
-
-    NOTE: If the time until the next event is greater than an hour in the
-    future, this function will return the number of seconds until the top of the
-    next hour (1-3600). Be sure to continue checking until this function
-    returns 0.
+    Calculate the datetime at which the function should next run, or None if
+    it never should again. This function handles both cron-like and
+    interval-like scheduling via the following:
+     ∗ If no interval and no schedule are specified, return <t>.
+     ∗ If an interval is specified but no schedule, return the time <interval>
+       seconds after <tLast>, or <t> if that's already passed.
+     ∗ If a schedule is passed but no interval, return the first time after <t>
+       that fits within the constraints of any of the function's schedules:
+         ∗ Unspecified fields are treated as open slots, except for second,
+           which defaults to 0.
+         ∗ Only one of day_of_week and day_of_month may be specified. if both
+           are specified, then day_of_month is used and day_of_week is ignored.
+         ∗ If every field (including year) is pinned down, the schedule only
+           matches once; after that time has passed it never matches again.
+     ∗ If both a schedule and an interval are specified, return the first time
+       fitting the schedule that is at least <interval> seconds after <tLast>
+       (and after <t>).
     """
+    if t is None: t = datetime.now()
+    if tLast is None: tLast = t
     has_interval = hasattr(f, "interval")
     has_schedule = hasattr(f, "schedule")
 
     if (not has_interval and not has_schedule):
-        return 0
+        return t
     if (has_interval and not has_schedule):
-        tNext = tLast + timedelta(seconds = f.interval)
-        return max(total_seconds(tNext - t), 0)
-    if (has_schedule): # and not has_interval):
-        interval_min = 3600
-        for s in f.schedule:
-            interval = schedule_next(s, t)
-            if interval < interval_min:
-                interval_min = interval
-        return interval_min
-
-def schedule_next(schedule, t):
-    # Operate in day-of-month mode unless day-of-week is specified
-    use_day_of_week = "day_of_week" in schedule
-
-    spec = [schedule.get("hour", -1),
-            (schedule.get("day_of_week", -1) if use_day_of_week
-             else schedule.get("day_of_month", -1)),
-            schedule.get("month", -1),
-            schedule.get("year", -1)]
-    now = [t.hour,
-           t.weekday() if use_day_of_week else t.day,
-           t.month,
-           t.year]
-    matches_hour_spec = all(spec[slot] == -1 or now[slot] == spec[slot] for slot in range(4))
-
-    # Note that if decorator didn't specify second, we assume 0, we don't pattern match.
-    spec = [schedule.get("second", 0),
-            schedule.get("minute", -1)]
-    now = [t.second,
-           t.minute]
-    now_s = 60 * now[1] + now[0]
-
-    if matches_hour_spec:
-        # Wait until minute:second matches time spec
-        if spec[1] == -1:
-            if now[0] < spec[0]: return spec[0] - now[0]
-            elif now[0] > spec[0]: return 60 - (now[0] - spec[0])
-            else: return 0
+        return max(tLast + timedelta(seconds = f.interval), t)
+
+    earliest, inclusive = t, False
+    if (has_interval):
+        tInterval = tLast + timedelta(seconds = f.interval)
+        if tInterval > t: earliest, inclusive = tInterval, True
+    times = [s.next(earliest, inclusive) for s in f.schedule]
+    times = [tNext for tNext in times if tNext is not None]
+    return min(times) if times else None
+
+def interval_next(f, t=None, tLast=None):
+    """
+    Calculate the number of seconds from now until the function should next
+    run (see next_run), or -1 if it never should again.
+    """
+    if t is None: t = datetime.now()
+    tNext = next_run(f, t, tLast)
+    if tNext is None: return -1
+    return max(total_seconds(tNext - t), 0)
+
+class JobStats():
+    """
+    Timing of one scheduled function: how late each run started compared to
+    when it was due (lag), how long it took, and how often a run outlasted the
+    function's next due time (an overrun), along with the number of due times
+    that were skipped over as a result. Only @schedule functions can overrun:
+    an @interval function's next due time is counted from the end of its last
+    run, so it never falls during one.
+    """
+
+    # Don't spend forever counting skipped slots of e.g. a once a second job
+    max_skipped = 10000
+
+    def __init__(self):
+        self.runs = 0
+        self.last_run = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.overruns = 0
+        self.skipped = 0
+
+    @property
+    def mean_lag(self):
+        return self.total_lag / self.runs if self.runs else 0.0
+
+    @property
+    def mean_duration(self):
+        return self.total_duration / self.runs if self.runs else 0.0
+
+    def record(self, f, due, start, end):
+        """ Record a run of f which was due at <due>, started at <start> and
+        finished at <end> (all datetimes). Returns the number of due times
+        skipped because it was still running. """
+        lag = max((start - due).total_seconds(), 0.0)
+        duration = (end - start).total_seconds()
+        skipped = 0
+        tNext = next_run(f, start, start) if hasattr(f, "schedule") else None
+        while tNext is not None and tNext < end and skipped < JobStats.max_skipped:
+            skipped += 1
+            tNext = next_run(f, tNext, tNext)
+
+        self.runs += 1
+        self.last_run = start
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        if skipped:
+            self.overruns += 1
+            self.skipped += skipped
+        return skipped
+
+    def __repr__(self):
+        return ("{} runs, lag mean {:.3f}s max {:.3f}s, duration mean {:.3f}s max {:.3f}s, {} overruns, {} skipped"
+                .format(self.runs, self.mean_lag, self.max_lag, self.mean_duration, self.max_duration,
+                        self.overruns, self.skipped))
+
+def record_job_run(bot, f, due, start, end):
+    """ Record a run of bot's scheduled function f in bot.job_stats and the
+    metrics registry. """
+    name = f.__name__
+    stats = bot.job_stats.get(name)
+    if stats is None: stats = bot.job_stats[name] = JobStats()
+    skipped = stats.record(f, due, start, end)
+    bot.observe("ananas_scheduler_lag_seconds", stats.last_lag, handler=name)
+    if skipped:
+        bot.count("ananas_scheduler_skipped_total", skipped, handler=name)
+        if bot.verbose: bot.log(name + ".debug", "Ran for {:.3f}s, skipping {} scheduled runs".format(stats.last_duration, skipped))
+
+class Scheduler():
+    """
+    Process-wide scheduler for the @interval and @schedule functions of every
+    bot. Jobs are kept in a heap ordered by their next run time; a single timer
+    thread sleeps until the earliest one is due and hands it off to a bounded
+    pool of worker threads. A job is only put back on the heap once it has
+    finished running, so a slow function never overlaps with itself.
+    """
+
+    class Job():
+        def __init__(self, bot, f):
+            self.bot = bot
+            self.f = f
+            self.name = f.__name__
+            self.when = None
+            self.cancelled = False
+
+    class Call():
+        """ A one-off function call, see call_later. """
+        def __init__(self, f, args, bot=None):
+            self.bot = bot
+            self.f = f
+            self.args = args
+            self.name = f.__name__
+            self.when = None
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.pool = None
+        self.running = False
+
+    def start(self):
+        with self.cond:
+            if self.running: return
+            self.running = True
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix="ananas-job")
+            self.thread = threading.Thread(target=self._timer_threadproc,
+                                           name="ananas-scheduler", daemon=True)
+            self.thread.start()
+
+    def stop(self, wait=True):
+        """ Stop the timer thread and wait for any running jobs to finish. Jobs
+        still on the heap are discarded. """
+        with self.cond:
+            if not self.running: return
+            self.running = False
+            self.heap = []
+            self.cond.notify_all()
+        self.thread.join()
+        self.pool.shutdown(wait=wait)
+        self.thread = None
+        self.pool = None
+
+    def add(self, bot, f):
+        """ Start running the decorated function f on behalf of bot. """
+        job = Scheduler.Job(bot, f)
+        t = datetime.now()
+        when = next_run(f, t, t)
+        if when is None: return None
+        self.start()
+        self._push(job, when)
+        bot.log(job.name, "Started")
+        return job
+
+    def call_later(self, delay, f, *args, bot=None):
+        """ Run f(*args) once on a worker thread after delay seconds. Returns
+        a Call which can be cancelled; if bot is given the call is also dropped
+        by remove(bot) and errors are reported to it. """
+        call = Scheduler.Call(f, args, bot)
+        self.start()
+        self._push(call, datetime.now() + timedelta(seconds=max(delay, 0)))
+        return call
+
+    def remove(self, bot):
+        """ Drop every job belonging to bot. Jobs which are currently running
+        are allowed to finish but won't be rescheduled. """
+        with self.cond:
+            for _, _, job in self.heap:
+                if job.bot is bot: job.cancelled = True
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cond.notify_all()
+
+    def jobs(self, bot=None):
+        with self.cond:
+            return [job for _, _, job in sorted(self.heap)
+                    if bot is None or job.bot is bot]
+
+    def _push(self, job, when):
+        with self.cond:
+            if not self.running or job.cancelled: return
+            job.when = when
+            heapq.heappush(self.heap, (when, next(self.seq), job))
+            # Only wake the timer if the new job is now the earliest one
+            if self.heap[0][2] is job: self.cond.notify()
+
+    def _timer_threadproc(self):
+        with self.cond:
+            while self.running:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                when, _, job = self.heap[0]
+                delay = (when - datetime.now()).total_seconds()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.heap)
+                if job.cancelled: continue
+                if isinstance(job, Scheduler.Call):
+                    self.pool.submit(self._run_call, job)
+                else:
+                    self.pool.submit(self._run_job, job)
+
+    def _run_call(self, call):
+        try:
+            call.f(*call.args)
+        except Exception as e:
+            error = "Exception encountered in scheduled call: {}\n{}".format(repr(e), traceback.format_exc())
+            if call.bot: call.bot.report_error(error, call.name)
+            else: print(error, file=sys.stderr)
+
+    def _run_job(self, job):
+        bot, f = job.bot, job.f
+        # Only ever run a @schedule function at a time that fits its schedule;
+        # if it was woken at any other, put it back for the next one that does
+        if hasattr(f, "schedule") and not any(s.matches(job.when) for s in f.schedule):
+            times = [s.next(job.when) for s in f.schedule]
+            times = [tNext for tNext in times if tNext is not None]
+            if not times:
+                bot.log(job.name, "Schedule will never match again, stopping")
+                return
+            if bot.verbose: bot.log(job.name + ".debug", "Woken off schedule, next run at {:%Y-%m-%d %H:%M:%S}".format(min(times)))
+            self._push(job, min(times))
+            return
+        with bot.alive:
+            if bot.state == PineappleBot.STOPPING:
+                bot.log(job.name, "Shutting down")
+                return
+            start = datetime.now()
+            try:
+                with bot.timer("ananas_handler_seconds", handler=job.name, kind=handler_kind(f)):
+                    bot.call(f)
+            except Exception as e:
+                error = "Exception encountered in @interval function: {}\n{}".format(repr(e), traceback.format_exc())
+                bot.report_error(error, job.name)
+
+        t = datetime.now()
+        record_job_run(bot, f, job.when, start, t)
+        when = next_run(f, t, t)
+        if when is None:
+            bot.log(job.name, "Schedule will never match again, stopping")
+            return
+        when = max(when, t + timedelta(seconds=1))
+        if bot.verbose: bot.log(job.name + ".debug", "Next run at {:%Y-%m-%d %H:%M:%S}".format(when))
+        self._push(job, when)
+
+scheduler = Scheduler()
+
+class Dispatcher():
+    """
+    Bounded queue of work drained by a small pool of worker threads, used to
+    run @reply handlers off the streaming thread so that a slow handler never
+    holds up receipt of later notifications. When the queue is full, the
+    overflow policy decides what happens to a new item:
+     ∗ "drop_oldest": discard the item that has been waiting longest
+     ∗ "drop_newest": discard the new item
+     ∗ "block": wait for room in the queue
+    An exception from an item is passed to on_error (or printed, without
+    one) and the worker carries on with the next.
+    """
+
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, workers=1, queue_size=100, overflow="drop_oldest", name="ananas-reply", on_drop=None, on_error=None):
+        if overflow not in Dispatcher.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}', expected one of {}"
+                             .format(overflow, ", ".join(Dispatcher.OVERFLOW_POLICIES)))
+        self.workers = max(int(workers), 1)
+        self.queue_size = max(int(queue_size), 1)
+        self.overflow = overflow
+        self.name = name
+        self.on_drop = on_drop
+        self.on_error = on_error
+
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.threads = []
+        self.running = True
+
+        # Counters
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def stats(self):
+        with self.cond:
+            return {"depth": len(self.queue), "max_depth": self.max_depth,
+                    "submitted": self.submitted, "completed": self.completed,
+                    "dropped": self.dropped, "failed": self.failed}
+
+    def submit(self, f, *args):
+        """ Queue f(*args) to be run on a worker thread. Returns False if the
+        item was dropped instead. """
+        dropped = None
+        accepted = True
+        with self.cond:
+            if not self.running: return False
+            while self.overflow == "block" and len(self.queue) >= self.queue_size:
+                self.cond.wait()
+                if not self.running: return False
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                if self.overflow == "drop_newest":
+                    dropped, accepted = (f, args), False
+                else:
+                    dropped = self.queue.popleft()
+            if accepted:
+                self.queue.append((f, args))
+                self.submitted += 1
+                self.max_depth = max(self.max_depth, len(self.queue))
+                if len(self.threads) < self.workers: self._spawn()
+                self.cond.notify_all()
+        if dropped is not None and self.on_drop: self.on_drop(*dropped)
+        return accepted
+
+    def stop(self, wait=True):
+        """ Stop accepting work. Workers finish whatever is already queued
+        before exiting. """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if wait:
+            for t in self.threads:
+                if t is not threading.current_thread(): t.join()
+
+    def _spawn(self):
+        t = threading.Thread(target=self._worker_threadproc, daemon=True,
+                             name="{}-{}".format(self.name, len(self.threads)))
+        self.threads.append(t)
+        t.start()
+
+    def _worker_threadproc(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.queue: return
+                f, args = self.queue.popleft()
+                self.cond.notify_all()
+            try:
+                f(*args)
+            except Exception as e:
+                with self.cond: self.failed += 1
+                self._report(f, args, "Exception encountered in {}: {}\n{}".format(
+                        getattr(f, "__name__", repr(f)), repr(e), traceback.format_exc()))
+            finally:
+                with self.cond: self.completed += 1
+
+    def _report(self, f, args, error):
+        # Never let reporting an error take the worker down with it
+        if self.on_error:
+            try:
+                self.on_error(f, args, error)
+                return
+            except Exception: pass
+        print(error, file=sys.stderr)
+
+def _log_dropped_mention(f, args):
+    bot, status, user = args
+    bot.log("reply", "Reply queue full, dropped mention {} from {}".format(status["id"], user["acct"]))
+
+def _log_failed_mention(f, args, error):
+    bot = args[0]
+    bot.log("reply", error)
+
+# Shared by every bot whose config sets reply_pool = shared; the runner sizes it
+reply_dispatcher = None
+
+def shared_dispatcher(workers=4, queue_size=1000, overflow="drop_oldest"):
+    """Return the process-wide reply Dispatcher, creating it with the given
+    settings if it doesn't exist yet."""
+    global reply_dispatcher
+    if reply_dispatcher is None:
+        reply_dispatcher = Dispatcher(workers, queue_size, overflow,
+                                      name="ananas-reply-shared", on_drop=_log_dropped_mention,
+                                      on_error=_log_failed_mention)
+    return reply_dispatcher
+
+class ConnectionPool():
+    """
+    Process-wide pool of keep-alive HTTP connections for the Mastodon API,
+    with one requests.Session per instance (api_base_url) shared by every bot
+    on it, so API calls reuse open TLS connections instead of each bot paying
+    for its own handshakes. Every response is also reported to the timing
+    hooks, as hook(api_base_url, method, path, status, seconds).
+
+    Mastodon.py is built on requests, which only speaks HTTP/1.1, so there's
+    no HTTP/2 here.
+    """
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.timing_hooks = []
+
+    @staticmethod
+    def normalize(api_base_url):
+        if "://" not in api_base_url: api_base_url = "https://" + api_base_url
+        return api_base_url.rstrip("/")
+
+    def session(self, api_base_url):
+        """ Return the shared session for api_base_url. """
+        base = ConnectionPool.normalize(api_base_url)
+        with self.lock:
+            if base not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                # Requests are authenticated with each bot's own token; never
+                # let a cookie set for one account leak into another's calls
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                session.hooks["response"].append(functools.partial(self._report_timing, base))
+                self.sessions[base] = session
+            return self.sessions[base]
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values(): session.close()
+            self.sessions = {}
+
+    def _report_timing(self, base, response, *args, **kwargs):
+        record_api_call(base, response)
+        if not self.timing_hooks: return
+        seconds = response.elapsed.total_seconds()
+        path = urlparse(response.url).path
+        for hook in self.timing_hooks:
+            try:
+                hook(base, response.request.method, path, response.status_code, seconds)
+            except Exception as e:
+                print("Exception in API timing hook: {}\n{}".format(repr(e), traceback.format_exc()), file=sys.stderr)
+
+def record_api_call(base, response, *args, **kwargs):
+    """ requests response hook recording API latency and errors in the
+    metrics registry. """
+    # Ids would make every status its own time series
+    path = re.sub(r"/\d+(?=/|$)", "/:id", urlparse(response.url).path)
+    labels = {"instance": base, "method": response.request.method, "path": path}
+    metrics.observe("ananas_api_seconds", response.elapsed.total_seconds(), **labels)
+    if response.status_code >= 400:
+        metrics.inc("ananas_api_errors_total", status=str(response.status_code), **labels)
+
+def handler_kind(f):
+    if hasattr(f, "reply"): return "reply"
+    if hasattr(f, "schedule"): return "schedule"
+    return "interval"
+
+class LogWriter():
+    """
+    Writes the log lines of every bot from one background thread.
+    PineappleBot.log only timestamps the message and puts it on a queue; the
+    writer formats whatever has queued up in one go, writes it through a large
+    buffer, and flushes on a timer or when the buffer fills, so bot threads
+    never wait on file I/O. flush() and LogFile.close() block until everything
+    queued before them has been written out.
+    """
+
+    def __init__(self, flush_interval=1.0, buffer_size=65536):
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.thread = None
+        self.dirty = set()
+
+    def write(self, target, ts, id, msg):
+        with self.cond:
+            self.queue.append((target, ts, id, msg))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._writer_threadproc,
+                                               name="ananas-log", daemon=True)
+                self.thread.start()
+            # No need to wake the writer for every line, the flush timer will
+            if len(self.queue) == 1: self.cond.notify()
+
+    def flush(self, target=None, close=False):
+        """ Wait until everything queued so far has been written, then flush
+        (and optionally close) target, or every file if target is None. """
+        if self.thread is None or not self.thread.is_alive():
+            self._write_batch([])
+            self._flush(target, close)
+            return
+        done = threading.Event()
+        with self.cond:
+            self.queue.append((None, done, target, close))
+            self.cond.notify()
+        done.wait()
+
+    def _write_batch(self, batch):
+        lines = {}
+        for target, ts, id, msg in batch:
+            lines.setdefault(target, []).append((ts, id, msg))
+        for target, entries in lines.items():
+            try:
+                target._emit(entries)
+                self.dirty.add(target)
+            except Exception as e:
+                print("Could not write to log {}: {}".format(target.path, repr(e)), file=sys.stderr)
+
+    def _flush(self, target=None, close=False):
+        targets = [target] if target is not None else list(self.dirty)
+        for t in targets:
+            try:
+                t._flush(close)
+            except Exception as e:
+                print("Could not flush log {}: {}".format(t.path, repr(e)), file=sys.stderr)
+            self.dirty.discard(t)
+
+    def _writer_threadproc(self):
+        last_flush = time.monotonic()
+        while True:
+            with self.cond:
+                timeout = self.flush_interval - (time.monotonic() - last_flush)
+                if not self.queue and (not self.dirty or timeout > 0):
+                    self.cond.wait(timeout if self.dirty else None)
+                batch, self.queue = self.queue, deque()
+
+            # Split the batch on flush requests so they see everything queued
+            # before them
+            lines = []
+            for item in batch:
+                if item[0] is not None:
+                    lines.append(item)
+                    continue
+                _, done, target, close = item
+                self._write_batch(lines)
+                lines = []
+                self._flush(target, close)
+                done.set()
+            self._write_batch(lines)
+
+            if self.dirty and time.monotonic() - last_flush >= self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+
+class LogFile():
+    """
+    A log file written by the shared LogWriter, optionally rotated once it
+    grows past max_bytes (to <path>.1, <path>.2, ...) or on an "hourly" or
+    "daily" schedule (to <path>.<date>), keeping the newest <backups> old logs.
+    With no path, lines go to stderr.
+    """
+
+    def __init__(self, path=None, writer=None):
+        self.path = path
+        self.writer = writer or log_writer
+        self.fp = None
+        self.size = 0
+        self.closed = False
+        self.max_bytes = 0
+        self.rotate = None
+        self.backups = 5
+        self.rollover_at = None
+
+    def configure(self, max_bytes=0, rotate=None, backups=5):
+        if rotate not in (None, "", "hourly", "daily"):
+            raise ValueError("Unknown log rotation '{}', expected hourly or daily".format(rotate))
+        self.max_bytes = int(max_bytes or 0)
+        self.rotate = rotate or None
+        self.backups = int(backups)
+        self.rollover_at = None
+
+    def write(self, id, msg):
+        self.writer.write(self, time.time(), id, msg)
+
+    def flush(self):
+        self.writer.flush(self)
+
+    def close(self):
+        self.closed = True
+        self.writer.flush(self, close=True)
+
+    # Called on the writer thread only
+
+    def _emit(self, entries):
+        lines = ["[{0:%Y-%m-%d %H:%M:%S}] {1}: {2}\n".format(datetime.fromtimestamp(ts), id, msg)
+                 for ts, id, msg in entries]
+        if self.path is None:
+            sys.stderr.write("".join(lines))
+            return
+        if self.fp is None: self._open()
+        if self.rotate:
+            ts = entries[0][0]
+            if self.rollover_at is None: self.rollover_at = self._next_rollover(time.time())
+            if ts >= self.rollover_at:
+                period = "%Y-%m-%d_%H" if self.rotate == "hourly" else "%Y-%m-%d"
+                self._rollover("{}.{}".format(self.path, datetime.fromtimestamp(self.rollover_at - 1).strftime(period)))
+                self.rollover_at = self._next_rollover(ts)
+        if not self.max_bytes:
+            data = "".join(lines)
+            self.fp.write(data)
+            self.size += len(data)
+            return
+        start = 0
+        size = self.size
+        for i, line in enumerate(lines):
+            if size > 0 and size + len(line) > self.max_bytes:
+                self.fp.write("".join(lines[start:i]))
+                for n in range(self.backups - 1, 0, -1):
+                    if os.path.exists("{}.{}".format(self.path, n)):
+                        os.replace("{}.{}".format(self.path, n), "{}.{}".format(self.path, n + 1))
+                self._rollover("{}.1".format(self.path))
+                start, size = i, 0
+            size += len(line)
+        self.fp.write("".join(lines[start:]))
+        self.size = size
+
+    def _open(self):
+        self.fp = open(self.path, "a", buffering=self.writer.buffer_size)
+        self.size = self.fp.tell()
+
+    def _next_rollover(self, ts):
+        t = datetime.fromtimestamp(ts)
+        if self.rotate == "hourly":
+            t = t.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
         else:
-            spec_s = 60 * spec[1] + spec[0]
-            if (now_s <= spec_s): return spec_s - now_s
-            #else: fallthrough
-    # else:
-    # Wait until top of next hour
-    return 3600 - now_s
+            t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+        return t.timestamp()
+
+    def _rollover(self, rotated_name):
+        self.fp.close()
+        os.replace(self.path, rotated_name)
+        self._open()
+        if self.rotate and self.backups > 0:
+            # Timestamped backups sort by age
+            directory = os.path.dirname(self.path) or "."
+            prefix = os.path.basename(self.path) + "."
+            old = sorted(f for f in os.listdir(directory)
+                         if f.startswith(prefix) and not f[len(prefix):].isdigit())
+            for f in old[:-self.backups]:
+                os.remove(os.path.join(directory, f))
+
+    def _flush(self, close=False):
+        if self.path is None:
+            sys.stderr.flush()
+            return
+        if self.fp is not None:
+            self.fp.flush()
+            if close:
+                self.fp.close()
+                self.fp = None
+
+stderr_log = LogFile()
+
+class AsyncMastodon():
+    """
+    Wrapper around a Mastodon client for use from async def handlers: every
+    API method becomes a coroutine function which runs the blocking
+    Mastodon.py call in an executor, e.g.
+        await self.amastodon.status_post("hello")
+    """
+
+    def __init__(self, mastodon, executor=None):
+        self._mastodon = mastodon
+        self._executor = executor
+
+    def __getattr__(self, name):
+        attr = getattr(self._mastodon, name)
+        if not callable(attr): return attr
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            import asyncio
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+        return wrapper
 
 class HTMLTextParser(HTMLParser):
     def __init__(self):
@@ -236,6 +1010,160 @@ def parse_list(list_str, sep=',', strip_separator_whitespace=True):
         l = [item.strip() for item in l]
     return l
 
+def parse_bool(value):
+    """Interpret a config value such as "yes", "true", "on" or "1" as a bool."""
+    if isinstance(value, str): return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+class ConfigFile():
+    """
+    A parsed config file shared by every bot configured in it. The file is
+    only re-parsed when its mtime, size or inode change (i.e. someone else
+    edited or replaced it), and changes made by bots are tracked per section
+    and written out together: save() stages a bot's changes and a single
+    atomic write of the whole file follows after <save_delay> seconds, or on
+    flush(), so that shutting down dozens of bots writes the file once.
+    """
+
+    files = {}
+    files_lock = threading.Lock()
+    save_delay = 1.0
+
+    @classmethod
+    def get(cls, filename):
+        """ The shared ConfigFile for filename. """
+        path = os.path.realpath(filename)
+        with cls.files_lock:
+            if path not in cls.files: cls.files[path] = ConfigFile(filename)
+            return cls.files[path]
+
+    @classmethod
+    def flush_all(cls):
+        with cls.files_lock:
+            files = list(cls.files.values())
+        return all([f.flush() for f in files])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.cfg = None
+        self.signature = None
+        self.written = None
+        # {section: {key: value}} changed since the last write
+        self.pending = {}
+        self.timer = None
+        self.refresh()
+
+    def _stat(self):
+        st = os.stat(self.filename)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def refresh(self):
+        """ Re-parse the file if it has changed on disk, keeping any changes
+        which haven't been written yet. """
+        with self.lock:
+            signature = self._stat()
+            if signature == self.signature: return False
+            from configobj import ConfigObj
+            self.cfg = ConfigObj(self.filename, interpolation="configparser", encoding="utf-8")
+            self.signature = signature
+            for section, values in self.pending.items():
+                if section not in self.cfg: self.cfg[section] = {}
+                self.cfg[section].update(values)
+            return True
+
+    def sections(self):
+        with self.lock:
+            self.refresh()
+            return list(self.cfg.sections)
+
+    def section(self, name):
+        """ The settings of section <name> on top of the DEFAULT section, or
+        None if there's no such section. """
+        with self.lock:
+            self.refresh()
+            if name not in self.cfg.sections: return None
+            values = dict(self.cfg["DEFAULT"]) if "DEFAULT" in self.cfg.sections else {}
+            values.update(self.cfg[name])
+            return values
+
+    def update(self, name, values):
+        """ Stage values for section <name>, skipping any which are the same
+        as what's already there (or inherited from DEFAULT). Returns the
+        number of values which changed. Nothing is staged if the section
+        has been removed from the file. """
+        with self.lock:
+            self.refresh()
+            if name not in self.cfg.sections: return 0
+            section = self.cfg[name]
+            default = self.cfg["DEFAULT"] if "DEFAULT" in self.cfg.sections else {}
+            changed = 0
+            for key, value in values.items():
+                value = _config_str(value)
+                current = section.get(key, default.get(key))
+                if current is not None and _config_str(current) == value: continue
+                section[key] = value
+                self.pending.setdefault(name, {})[key] = value
+                changed += 1
+            return changed
+
+    def save(self, wait=False):
+        """ Write out any staged changes, after save_delay seconds unless wait
+        is set. Returns False if a write was attempted and failed. """
+        with self.lock:
+            if not self.pending: return True
+            if wait or self.save_delay <= 0: return self.flush()
+            if self.timer is None:
+                self.timer = threading.Timer(self.save_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            return True
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending: return True
+            try:
+                # Pick up anything edited by hand in the meantime
+                self.refresh()
+                # Do a dance to write to a temp file and then move it over the
+                # user config, so that it won't clobber the config if the FS is
+                # full
+                t = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(os.path.abspath(self.filename)))
+                try:
+                    self.cfg.write(t)
+                    t.flush()
+                    os.fsync(t.fileno())
+                    t.close()
+                    os.replace(t.name, self.filename)
+                except BaseException:
+                    t.close()
+                    os.unlink(t.name)
+                    raise
+            except OSError as e:
+                print("ERROR: Could not save config to {}! {}".format(self.filename, e), file=sys.stderr)
+                return False
+            self.signature = self.written = self._stat()
+            self.pending = {}
+            return True
+
+    def written_by_us(self):
+        """ Whether the file is still as we last wrote it, e.g. to ignore our
+        own changes when watching it. """
+        with self.lock:
+            try:
+                return self.written is not None and self.written == self._stat()
+            except OSError:
+                return False
+
+def _config_str(value):
+    if isinstance(value, (list, tuple)): return ",".join([str(v) for v in value])
+    return str(value)
+
+atexit.register(ConfigFile.flush_all)
+
 class PineappleBot(StreamListener):
     """
     Main bot class
@@ -265,9 +1193,7 @@ class PineappleBot(StreamListener):
         def __delattr(self, key): del self[key]
 
         def open(self, filename):
-            self._file = open(self._filename, "r+")
-            self._cfg = ConfigObj(self._file, interpolation="configparser",encoding="utf-8")
-            self._cfg.filename = self._filename
+            self._cfg = ConfigFile.get(filename)
 
         def load(self, name=None, silent=False):
             """ Load section <name> from the config file into this object,
@@ -275,87 +1201,153 @@ class PineappleBot(StreamListener):
             if (name != None):
                 self._name = name
 
-            self._cfg.reload()
-            if (name not in self._cfg.sections):
+            values = self._cfg.section(self._name)
+            if (values is None):
                 self._bot.log("config", "Section {} not in {}, aborting.".format(self._name, self._filename))
                 return False
             if not silent: self._bot.log("config", "Loading configuration from {}".format(self._filename))
-            if "DEFAULT" in self._cfg.sections:
-                self.update(self._cfg["DEFAULT"])
-            self.update(self._cfg[self._name])
+            # Forget settings which have been deleted from the file since the
+            # last load, so that saving doesn't put them back
+            for key in self.get("_loaded", ()):
+                if key not in values: self.pop(key, None)
+            self.update(values)
+            self._loaded = set(values)
             return True
 
-        def save(self):
-            """ Save back out to the config file. """
-            self._cfg.reload()
-            for attr, value in self.items():
-                if attr[0] != '_':
-                    if "DEFAULT" not in self._cfg or (not (attr in self._cfg["DEFAULT"] and self._cfg["DEFAULT"][attr] == value)):
-                        if isinstance(value, (list, tuple)):
-                            value = ",".join([str(v) for v in value])
-                    self._cfg[self._name][attr] = str(value)
+        def save(self, wait=False):
+            """ Save back out to the config file. Only settings which have
+            changed are written, together with those of every other bot in the
+            same file, shortly afterwards unless wait is set. """
+            changed = self._cfg.update(self._name, {attr: value for attr, value in self.items()
+                                                    if attr[0] != '_'})
+            if changed == 0 and not wait: return True
             self._bot.log("config", "Saving configuration to {}...".format(self._filename))
-
-            try:
-                # Do a dance to write to a temp file and then move it over the
-                # user config, so that it won't clobber the config if the FS is
-                # full
-                t = tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(self._filename))
-                self._cfg.write(t)
-                self._file.close()
-                t.close()
-                os.replace(t.name, self._filename)
-                self.open(self._filename)
-            except OSError as e:
-                self._bot.log("config", "ERROR: Could not save config to file! {}".format(e))
+            if not self._cfg.save(wait):
+                self._bot.log("config", "ERROR: Could not save config to file!")
                 return False
-
-            self._bot.log("config", "Done.")
+            if wait: self._bot.log("config", "Done.")
             return True
 
-    def __init__(self, cfgname, name=None, log_to_stderr=True, interactive=False, verbose=False):
+    def __init__(self, cfgname, name=None, log_to_stderr=True, interactive=False, verbose=False, runtime=None, stream_mux=None, connection_pool=None):
         if (name is None): name = self.__class__.__name__
         self.name = name
         self.state = PineappleBot.INITIALIZING
 
+        # Either the shared threaded scheduler or an ananas.aio.AsyncRuntime,
+        # which then also runs the reply and error handlers on its event loop
+        self.runtime = runtime
+        self.scheduler = scheduler if runtime is None else runtime
+
         self.alive = threading.Condition()
-        self.threads = []
         self.reply_funcs = []
         self.report_funcs = []
+        self.dispatcher = None
+        self.job_stats = {}
+        self.pregenerators = []
 
         self.mastodon = None
+        self.amastodon = None
         self.account_info = None
         self.username = None
         self.default_visibility = None
         self.default_sensitive = None
         self.stream = None
+        self.stream_mux = stream_mux
+        self.reconnect_attempts = 0
+        self.notification_lock = threading.Lock()
+        self.last_notification_id = None
+        # Recently handled notification ids, since replays overlap the stream
+        self.seen_notifications = deque(maxlen=1000)
+        self.seen_notification_ids = set()
+        self.max_replay = 200
+        self.poll_interval = None
+        self.poll_seeded = False
+        self.poll_cursor = None
+        self.poll_etag = None
+        self.connection_pool = connection_pool
         self.interactive = interactive
         self.verbose = verbose
 
         self.log_to_stderr = log_to_stderr
         self.log_name = self.name + ".log"
-        self.log_file = open(self.log_name, "a")
+        self.log_file = LogFile(self.log_name)
+
+        # Cursors, counters etc. which change while the bot runs; the config
+        # is for settings
+        self.state_store = StateStore(self.name + ".state")
 
         self.config = PineappleBot.Config(self, cfgname)
         self.init() # Call user init to initialize bot-specific properties to default values
         if not self.config.load(self.name,silent=not verbose): return
+        try:
+            self.log_file.configure(max_bytes=self.config.get("log_max_bytes", 0),
+                                    rotate=self.config.get("log_rotate"),
+                                    backups=self.config.get("log_backups", 5))
+        except ValueError as e:
+            self.log("config", "Ignoring log rotation settings: {}".format(e))
         if not self.login(): return
 
         self.startup()
 
+    def count(self, name, n=1, **labels):
+        """Add n to the counter name in ananas.metrics, labelled with the
+        bot's name and any other labels given."""
+        metrics.inc(name, n, bot=self.name, **labels)
+
+    def observe(self, name, value, **labels):
+        """Record value (e.g. seconds) in the histogram name in
+        ananas.metrics."""
+        metrics.observe(name, value, bot=self.name, **labels)
+
+    def timer(self, name, **labels):
+        """Context manager observing the time spent in its body in the
+        histogram name, with status="error" if it raises."""
+        return metrics.timer(name, bot=self.name, **labels)
+
+    def pregenerate(self, generate):
+        """Start and return an ananas.pregen.Pregenerator keeping outputs of
+        generate() ready to be taken with its get(), configured by the bot's
+        pregenerate settings. It's stopped when the bot shuts down."""
+        pregenerator = Pregenerator(generate,
+                                    size=int(self.config.get("pregenerate", 10)),
+                                    low_water=int(self.config.get("pregenerate_low_water", 3)),
+                                    max_length=int(self.config.get("max_length", 500)) or None,
+                                    recent=int(self.config.get("dedup_recent", 0)),
+                                    processes=int(self.config.get("pregenerate_processes", 0)),
+                                    log=lambda msg: self.log("pregen", msg))
+        pregenerator.start()
+        self.pregenerators.append(pregenerator)
+        return pregenerator
+
+    def stop_pregenerators(self):
+        for pregenerator in self.pregenerators:
+            pregenerator.stop()
+            self.log("pregen", "Pregenerated outputs: {}".format(pregenerator.stats()))
+        self.pregenerators = []
+
     def log(self, id, msg):
         if (id == None): id = self.name
         else: id = self.name + "." + id
-        ts = datetime.now()
-        msg_f = "[{0:%Y-%m-%d %H:%M:%S}] {1}: {2}".format(ts, id, msg)
 
+        # Lines are formatted and written out in batches by the log writer thread
         if self.log_file.closed or self.log_to_stderr:
-            print(msg_f, file=sys.stderr)
-        elif not self.log_file.closed: print(msg_f, file=self.log_file, flush=True)
+            stderr_log.write(id, msg)
+        else: self.log_file.write(id, msg)
 
     def startup(self):
         self.state = PineappleBot.STARTING
         self.log(None, "Starting {0} {1}".format(self.__class__.__name__, self.name))
+        # Older versions kept this in the config file
+        last_notification_id = self.state_store.get("last_notification_id",
+                                                    self.config.get("last_notification_id"))
+        if last_notification_id:
+            self.last_notification_id = int(last_notification_id)
+        self.max_replay = int(self.config.get("max_replay", self.max_replay))
+        # Big enough to cover everything a replay can overlap with
+        if self.seen_notifications.maxlen < 2 * self.max_replay:
+            self.seen_notifications = deque(self.seen_notifications, maxlen=2 * self.max_replay)
+        # Where to catch up from, taken before the stream can move it on
+        replay_cursor = self.last_notification_id
 
         try:
             self.start()
@@ -363,40 +1355,11 @@ class PineappleBot(StreamListener):
             self.log(None, "Fatal exception: {}\n{}".format(repr(e), traceback.format_exc()))
             return
 
-        def interval_threadproc(f):
-            self.log(f.__name__, "Started")
-            t = datetime.now()
-            tLast = t
-            while (True):
-                self.alive.acquire()
-                t = datetime.now()
-                interval = interval_next(f, t, tLast)
-
-                if (interval == 0):
-                    try:
-                        f()
-                    except Exception as e:
-                        error = "Exception encountered in @interval function: {}\n{}".format(repr(e), traceback.format_exc())
-                        self.report_error(error, f.__name__)
-
-                    t = datetime.now()
-                    interval = interval_next(f, t, t)
-
-                if self.verbose: self.log(f.__name__ + ".debug", "Next wait interval: {}s".format(interval))
-                tLast = t
-                self.alive.wait(max(interval, 1))
-                if (self.state == PineappleBot.STOPPING):
-                    self.alive.release()
-                    self.log(f.__name__, "Shutting down")
-                    return 0
-                else:
-                    self.alive.release()
-
+        has_jobs = False
         for fname, f in inspect.getmembers(self, predicate=inspect.ismethod):
             if hasattr(f, "interval") or hasattr(f, "schedule"):
-                t = threading.Thread(args=(f,), target=interval_threadproc)
-                t.start()
-                self.threads.append(t)
+                self.scheduler.add(self, f)
+                has_jobs = True
 
             if hasattr(f, "reply"):
                 self.reply_funcs.append(f)
@@ -404,9 +1367,14 @@ class PineappleBot(StreamListener):
             if hasattr(f, "error_reporter"):
                 self.report_funcs.append(f)
 
+        summary_interval = float(self.config.get("job_summary_interval", 3600))
+        if summary_interval > 0 and has_jobs:
+            self.scheduler.call_later(summary_interval, self.log_job_stats, summary_interval, bot=self)
+
         if len(self.reply_funcs) > 0:
-            self.stream = self.mastodon.stream_user(self, run_async=True,
-                                                    reconnect_async=True)
+            if not self.runtime: self.dispatcher = self.make_dispatcher()
+            if parse_bool(self.config.get("polling", False)): self.start_polling()
+            else: self.stream = self.open_stream()
 
         credentials = self.mastodon.account_verify_credentials()
         self.account_info = credentials
@@ -417,6 +1385,9 @@ class PineappleBot(StreamListener):
         self.state = PineappleBot.RUNNING
         self.log(None, "Startup complete.")
 
+        # Catch up on anything that came in while we weren't running
+        if len(self.reply_funcs) > 0: self.replay_notifications(replay_cursor)
+
     def shutdown(self):
         self.alive.acquire()
         self.state = PineappleBot.STOPPING
@@ -424,10 +1395,18 @@ class PineappleBot(StreamListener):
         self.alive.notify_all()
         self.alive.release()
 
+        self.scheduler.remove(self)
         if self.stream: self.stream.close()
+        if self.dispatcher:
+            if self.dispatcher is not reply_dispatcher: self.dispatcher.stop()
+            self.log("reply", "Reply queue: {}".format(self.dispatcher.stats()))
 
+        self.log_job_stats()
+        # Before stop(), which may free what they generate from
+        self.stop_pregenerators()
         self.stop()
         self.config.save()
+        self.state_store.close()
 
         self.log_file.close()
 
@@ -448,11 +1427,20 @@ class PineappleBot(StreamListener):
             self.log("api", "No access key set in config and interactive = False, exiting.")
             return False
 
+        if self.connection_pool:
+            session = self.connection_pool.session(self.config.domain)
+        else:
+            session = requests.Session()
+            session.hooks["response"].append(functools.partial(
+                record_api_call, ConnectionPool.normalize(self.config.domain)))
         self.mastodon = Mastodon(client_id = self.config.client_id,
                                   client_secret = self.config.client_secret,
                                   access_token = self.config.access_token,
-                                  api_base_url = self.config.domain)
+                                  api_base_url = self.config.domain,
+                                  session = session)
                                   #debug_requests = True)
+        self.amastodon = AsyncMastodon(self.mastodon,
+                                       self.runtime.executor if self.runtime else None)
         return True
 
     def interactive_login(self):
@@ -471,7 +1459,7 @@ class PineappleBot(StreamListener):
                 self.config.client_id, self.config.client_secret = Mastodon.create_app(client_name,
                         api_base_url="https://"+self.config.domain)
                 # TODO handle failure
-                self.config.save()
+                self.config.save(wait=True)
             if (not hasattr(self, "access_token")):
                 email = input("{0}: Enter the account email: ".format(self.name))
                 email = email.strip()
@@ -481,7 +1469,7 @@ class PineappleBot(StreamListener):
                                         client_secret = self.config.client_secret,
                                         api_base_url = "https://"+self.config.domain)
                     self.config.access_token = mastodon.log_in(email, password)
-                    self.config.save()
+                    self.config.save(wait=True)
                 except ValueError as e:
                     self.log("login", "Could not authenticate with {0} as '{1}':"
                              .format(self.config.domain, email))
@@ -505,53 +1493,233 @@ class PineappleBot(StreamListener):
         be added by using the @error_reporter decorator."""
         if location == None: location = inspect.stack()[1][3]
         self.log(location, error)
+        if self.runtime and self.runtime.in_loop():
+            # Don't block the event loop on e.g. DMing the admin
+            for f in self.report_funcs:
+                self.runtime.spawn(self.runtime.call(f, error))
+            return
         for f in self.report_funcs:
-            f(error)
+            self.call(f, error)
+
+    def call(self, f, *args):
+        """Call one of the bot's handlers from a thread which isn't running an
+        event loop. Handlers may be plain functions or coroutine functions."""
+        if inspect.iscoroutinefunction(f):
+            if self.runtime: return self.runtime.submit(f(*args)).result()
+            import asyncio
+            return asyncio.run(f(*args))
+        return f(*args)
+
+    def log_job_stats(self, repeat=None):
+        """Log a line of timing stats for each scheduled function, see
+        JobStats. Logs again every <repeat> seconds if given."""
+        for name, stats in sorted(self.job_stats.items()):
+            self.log("scheduler", "{}: {}".format(name, stats))
+        if repeat and self.state != PineappleBot.STOPPING:
+            self.scheduler.call_later(repeat, self.log_job_stats, repeat, bot=self)
+
+    def make_dispatcher(self):
+        """Build the Dispatcher which runs this bot's @reply handlers, from the
+        reply_pool, reply_workers, reply_queue_size and reply_overflow
+        settings."""
+        if self.config.get("reply_pool", "") == "shared":
+            return shared_dispatcher()
+        return Dispatcher(workers=self.config.get("reply_workers", 1),
+                          queue_size=self.config.get("reply_queue_size", 100),
+                          overflow=self.config.get("reply_overflow", "drop_oldest"),
+                          name=self.name + "-reply", on_drop=_log_dropped_mention,
+                          on_error=_log_failed_mention)
+
+    def open_stream(self):
+        """Open the user stream, through the shared per-instance reader if the
+        runner gave us one and falling back to a dedicated Mastodon.py stream
+        if that doesn't work."""
+        if self.stream_mux:
+            try:
+                return self.stream_mux.stream_user(self.mastodon, self)
+            except Exception as e:
+                self.log("stream", "Couldn't use the shared streaming reader ({}), using a dedicated connection".format(e))
+        return self.mastodon.stream_user(self, run_async=True, reconnect_async=False,
+                                         reconnect_async_wait_sec=self.reconnect_delay())
 
     def on_notification(self, notif):
+        # Skip anything already seen, since replays can overlap with the stream
+        notif_id = int(notif["id"])
+        with self.notification_lock:
+            if notif_id in self.seen_notification_ids: return
+            if len(self.seen_notifications) == self.seen_notifications.maxlen:
+                self.seen_notification_ids.discard(self.seen_notifications[0])
+            self.seen_notifications.append(notif_id)
+            self.seen_notification_ids.add(notif_id)
+            if self.last_notification_id is None or notif_id > self.last_notification_id:
+                self.last_notification_id = notif_id
+                self.state_store["last_notification_id"] = notif_id
+
         if self.verbose: self.log("debug", "Got a {} from {} at {}".format(notif["type"], notif["account"]["username"], notif["created_at"]))
         if (notif["type"] == "mention"):
-            for f in self.reply_funcs:
-                try:
-                    f(notif["status"], notif["account"])
-                except Exception as e:
-                    error = "Fatal exception: {}\n{}".format(repr(e), traceback.format_exc())
-                    self.report_error(error, f.__name__)
-
-    def on_close(self):
-        # Attempt to re-open the connection, since this is usually the result of
-        # the server just dropping the connection for one reason or another.
-        self.log(None, "Dropped streaming connection to {}".format(self.config.domain))
-        self.stream.close()
-        old_timeout = self.mastodon.request_timeout
-        # Don't wait forever for the instance to respond to the /api/v1/instance endpoint inside Mastodon.py
-        #self.mastodon.request_timeout = (10, 10)
-        #print("thing1")
-        try:
-            self.mastodon.instance()
-        except mastodon.Mastodon.MastodonNetworkError as e:
-            self.log("Instance appears to have gone down")
+            self.count("ananas_mentions_total")
+            if self.runtime:
+                self.runtime.submit(self.runtime.reply(self, notif["status"], notif["account"]))
+            elif self.dispatcher:
+                self.dispatcher.submit(PineappleBot.handle_mention, self, notif["status"], notif["account"])
+            else:
+                self.handle_mention(notif["status"], notif["account"])
 
-        #print("thing2")
-        wait = 10
-        while(True):
+    def handle_mention(self, status, user):
+        """Run every @reply handler for a mention, reporting any errors."""
+        for f in self.reply_funcs:
             try:
-                self.log(None, "Attempting to reinitialize in {}s...".format(wait))
-                time.sleep(wait)
-                self.stream = self.mastodon.stream_user(self, run_async=True,
-                                                        reconnect_async=True)
-                # Call the instance API first, so that we don't get stuck in stream_user
-                #  (timeout doesn't work there for some reason)
-                self.mastodon.instance()
-
-                # If we get here without erroring, success
-                self.mastodon.request_timeout = old_timeout
-                self.log(None, "Successfully reinitialized streaming connection.")
-                break
-            except mastodon.Mastodon.MastodonNetworkError:
-                self.log(None, "Timed out")
-                wait *= 2
-                continue
+                with self.timer("ananas_handler_seconds", handler=f.__name__, kind="reply"):
+                    self.call(f, status, user)
+            except Exception as e:
+                error = "Fatal exception: {}\n{}".format(repr(e), traceback.format_exc())
+                self.report_error(error, f.__name__)
+
+    def on_close(self, error=None):
+        """Called when the streaming connection drops, usually because the
+        server just dropped it for one reason or another. Schedules a reconnect
+        after a capped, jittered exponential backoff, so that an instance blip
+        doesn't have every bot on it reconnecting in lockstep."""
+        if self.state == PineappleBot.STOPPING: return
+        self.log(None, "Dropped streaming connection to {}{}".format(
+            self.config.domain, ": {}".format(error) if error else ""))
+        self.schedule_reconnect()
+
+    def reconnect_delay(self):
+        """Seconds to wait before the next reconnect attempt: doubling from
+        reconnect_min_wait up to reconnect_max_wait, with the top half of each
+        delay randomized."""
+        lo = float(self.config.get("reconnect_min_wait", 5))
+        hi = float(self.config.get("reconnect_max_wait", 300))
+        delay = min(lo * 2 ** min(self.reconnect_attempts, 32), hi)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def schedule_reconnect(self):
+        delay = self.reconnect_delay()
+        self.reconnect_attempts += 1
+        self.count("ananas_stream_reconnects_total")
+        self.log(None, "Attempting to reinitialize in {:.0f}s...".format(delay))
+        self.scheduler.call_later(delay, self.reconnect, bot=self)
+
+    def reconnect(self):
+        if self.state == PineappleBot.STOPPING: return
+        with self.notification_lock:
+            replay_cursor = self.last_notification_id
+        try:
+            self.stream = self.open_stream()
+        except Exception as e:
+            self.log(None, "Reconnecting failed: {}".format(repr(e)))
+            self.schedule_reconnect()
+            return
+        self.reconnect_attempts = 0
+        self.log(None, "Successfully reinitialized streaming connection.")
+        self.replay_notifications(replay_cursor)
+
+    def handle_stream(self, response):
+        """Wraps Mastodon.py's stream reader so that the end of a dedicated
+        stream goes through on_close instead of Mastodon.py's own fixed-delay
+        reconnect loop."""
+        error = None
+        try:
+            super().handle_stream(response)
+        except Exception as e:
+            error = e
+        self.on_close(error)
+
+    def fetch_notifications(self, cursor, max_count=None):
+        """Page through every notification newer than cursor, oldest first,
+        feeding each through on_notification. Stops after max_count if given.
+        Returns the number fetched."""
+        fetched = 0
+        while max_count is None or fetched < max_count:
+            limit = 30 if max_count is None else min(30, max_count - fetched)
+            page = self.mastodon.notifications(min_id=cursor, limit=limit)
+            if not page: break
+            for notif in sorted(page, key=lambda n: int(n["id"])):
+                self.on_notification(notif)
+                fetched += 1
+            cursor = max(int(n["id"]) for n in page)
+            if len(page) < limit: break
+        return fetched
+
+    def replay_notifications(self, cursor):
+        """Feed the notifications newer than cursor (e.g. those received while
+        the stream was disconnected) through on_notification, oldest first, up
+        to max_replay of them. cursor should be taken before the stream is
+        (re)opened, so that nothing arriving on it in the meantime can move
+        the starting point past what was missed. Does nothing if cursor is
+        None, i.e. no notification has been processed yet."""
+        if cursor is None: return
+        try:
+            replayed = self.fetch_notifications(cursor, self.max_replay)
+        except Exception as e:
+            self.report_error("Couldn't fetch missed notifications: {}\n{}".format(repr(e), traceback.format_exc()), "replay")
+            return
+        if replayed: self.log(None, "Fetched {} missed notifications".format(replayed))
+        if replayed >= self.max_replay:
+            self.log(None, "Stopped replaying at max_replay ({}), any missed notifications after those were skipped".format(self.max_replay))
+
+    def start_polling(self):
+        """Poll for notifications instead of streaming them, for instances
+        whose streaming API can't be relied on."""
+        self.poll_interval = float(self.config.get("poll_min_interval", 15))
+        self.log(None, "Polling for notifications every {:.0f}s or more".format(self.poll_interval))
+        try:
+            self.seed_poll_cursor()
+        except Exception as e:
+            # poll() tries again
+            self.log("poll", "Couldn't fetch the newest notification: {}".format(repr(e)))
+        self.scheduler.call_later(self.poll_interval, self.poll, bot=self)
+
+    def seed_poll_cursor(self):
+        """Start polling from the newest notification there is now, rather
+        than replying to the whole backlog. A bot which has handled
+        notifications before starts from the last of those instead, and one
+        with none at all handles everything from its first."""
+        if self.last_notification_id is None:
+            newest = self.mastodon.notifications(limit=1)
+            with self.notification_lock:
+                if newest and self.last_notification_id is None:
+                    self.last_notification_id = int(newest[0]["id"])
+                    self.state_store["last_notification_id"] = self.last_notification_id
+        self.poll_seeded = True
+
+    def poll_changed(self, cursor):
+        """Cheap conditional check for notifications newer than cursor: asks
+        for just the first one, sending back the ETag from the last time we
+        asked so an unchanged answer comes back as an empty 304."""
+        if cursor != self.poll_cursor: self.poll_etag = None
+        self.poll_cursor = cursor
+        headers = {"Authorization": "Bearer " + self.mastodon.access_token}
+        if self.poll_etag: headers["If-None-Match"] = self.poll_etag
+        # requests leaves out min_id when there's no cursor yet
+        response = self.mastodon.session.get(self.mastodon.api_base_url + "/api/v1/notifications",
+                                             params={"min_id": cursor, "limit": 1}, headers=headers,
+                                             timeout=self.mastodon.request_timeout)
+        if response.status_code == 304: return False
+        response.raise_for_status()
+        self.poll_etag = response.headers.get("ETag")
+        return len(response.json()) > 0
+
+    def poll(self):
+        """Fetch new notifications, then schedule the next poll: soon if there
+        were any, otherwise backing off towards poll_max_interval."""
+        if self.state == PineappleBot.STOPPING: return
+        fetched = 0
+        try:
+            if not self.poll_seeded: self.seed_poll_cursor()
+            with self.notification_lock:
+                cursor = self.last_notification_id
+            if self.poll_changed(cursor):
+                fetched = self.fetch_notifications(cursor)
+        except Exception as e:
+            self.log("poll", "Polling notifications failed: {}".format(repr(e)))
+
+        lo = float(self.config.get("poll_min_interval", 15))
+        hi = float(self.config.get("poll_max_interval", 300))
+        self.poll_interval = lo if fetched else min(self.poll_interval * 2, hi)
+        if self.verbose: self.log("poll.debug", "Fetched {} notifications, next poll in {:.0f}s".format(fetched, self.poll_interval))
+        self.scheduler.call_later(self.poll_interval, self.poll, bot=self)
 
     def get_reply_visibility(self, status_dict):
         """Given a status dict, return the visibility that should be used.
@@ -573,6 +1741,12 @@ class PineappleBot(StreamListener):
         pass
     def stop(self):
         pass
+    def reload(self):
+        """Called by the runner when the bot's section of the config file
+        changes (or on SIGHUP), after the new settings have been loaded into
+        self.config. Return True if the bot has applied them; otherwise it's
+        shut down and started again."""
+        return False
 
 # Exceptions
 
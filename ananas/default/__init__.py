@@ -1,4 +1,20 @@
 __all__ = ["roll", "tracery"]
-from .roll import DiceBot
-from .tracery import TraceryBot
-from .announce import AnnounceBot
+
+# Bot classes by name, imported when first used so that loading one bot doesn't
+# import the dependencies of all of them
+_bots = {
+    "DiceBot": ".roll",
+    "TraceryBot": ".tracery",
+    "AnnounceBot": ".announce",
+}
+
+def __getattr__(name):
+    if name in _bots:
+        import importlib
+        value = getattr(importlib.import_module(_bots[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'ananas.default' has no attribute '{}'".format(name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_bots))
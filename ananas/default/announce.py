@@ -19,11 +19,14 @@ class AnnounceBot(PineappleBot):
         if isinstance(self.config.allow_list, str):
             self.config.allow_list = [self.config.allow_list]
 
-        if isinstance(self.config.last_seen, str):
-            self.config.last_seen = [self.config.last_seen]
+        # The last seen ids are kept in the state store; a last_seen setting
+        # in the config only gives the starting point
+        self.last_seen = self.state_store.get("last_seen", self.config.last_seen)
+        if isinstance(self.last_seen, (str, int)):
+            self.last_seen = [self.last_seen]
 
         # Make sure last seen ids are actually ints
-        self.config.last_seen = [int(id) for id in self.config.last_seen]
+        self.last_seen = [int(id) for id in self.last_seen]
 
         # Grab the actual user dicts for the usernames listed in the config
         self.users = []
@@ -36,7 +39,7 @@ class AnnounceBot(PineappleBot):
         assert len(self.config.allow_list) == len(self.users)
 
         # Make sure the last seen array is the right length
-        if len(self.config.last_seen) != len(self.config.allow_list):
+        if len(self.last_seen) != len(self.config.allow_list):
             raise ConfigurationError("There must be the same number of last seen IDs as allowed users")
 
         # Run initial update immediately
@@ -48,7 +51,7 @@ class AnnounceBot(PineappleBot):
     def update(self):
         self.log("debug", "Updating!")
         for i, user in enumerate(self.users):
-            lowest_seen_this_time = self.config.last_seen[i]
+            lowest_seen_this_time = self.last_seen[i]
             while (True):
                 posts = self.mastodon.account_statuses(user, since_id=lowest_seen_this_time+1, exclude_replies=True)
                 for post in posts:
@@ -60,11 +63,12 @@ class AnnounceBot(PineappleBot):
                     for tag in post.tags:
                         if tag.name == self.config.hashtag:
                             self.log("debug", "BOOST: {}".format(post.id))
-                            mastodon.status_reblog(post)
-                            self.config.last_seen[i] = post_id
+                            self.mastodon.status_reblog(post)
+                            self.last_seen[i] = post_id
+                            self.state_store["last_seen"] = self.last_seen
                             break
 
-                if self.config.last_seen[i] == lowest_seen_this_time: break
-                else: lowest_seen_this_time = self.config.last_seen[i]
+                if self.last_seen[i] == lowest_seen_this_time: break
+                else: lowest_seen_this_time = self.last_seen[i]
 
 
@@ -1,57 +1,374 @@
-import random
+import hashlib, heapq, itertools, mmap, os, random, struct, sys, tempfile, time
+from array import array
+from bisect import bisect_right
 from ananas import PineappleBot, ConfigurationError, hourly, reply
 
 def make_gram(word_array):
     return " ".join(word_array)
 
+# Model files: this header, then the word table (offsets into the UTF-8 bytes
+# of the words, and those bytes), the state keys, the successor offsets, and
+# succ_words, succ_cum and succ_next, each starting on an 8-byte boundary.
+# The arrays are in the byte order of the machine which wrote them.
+MODEL_MAGIC = b"ANMK"
+MODEL_VERSION = 1
+_model_header = struct.Struct("<4sHBxIIIIII32s")
+
+def _align(pos):
+    return (pos + 7) & ~7
+
+def corpus_hash(path):
+    """ SHA-256 of the contents of the file at path. """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.digest()
+
+class WordTable():
+    """ The words of a memory-mapped model, decoded as they're used. """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
 class NGramTextModel():
+    """
+    An order-n Markov chain over the words of a corpus, one sentence per line.
+
+    Words are interned as integer ids, and each state (the previous n word
+    ids) is packed into a single integer, so generating a word is integer
+    arithmetic rather than joining strings. The model is kept in flat arrays
+    rather than per-state Python objects: the state keys in sorted order, and
+    for state number s its successors, from offsets[s] to offsets[s + 1] in
+    succ_words/succ_cum/succ_next, as (word id, cumulative count, number of
+    the state it leads to). Each distinct successor is stored once however
+    often it was seen, picking one is a binary search over the counts, and
+    generating a sentence never has to look a state up.
+    """
+
+    START = "^"
+    END = "$"
+    # succ_next of the transitions into the all-END state, which has none
+    END_STATE = 0xFFFFFFFF
+
     def __init__(self, n, lines):
         self.n = n
-        self.gram_dictionary = dict()
+        self.words = [NGramTextModel.START, NGramTextModel.END]
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+        self.vocab = len(self.words)
+        self.state_keys = array("Q")
+        self.offsets = array("I", [0])
+        self.succ_words = array("I")
+        self.succ_cum = array("I")
+        self.succ_next = array("I")
+        self.start_state = NGramTextModel.END_STATE
+        self.corpus_hash = None
+        self.mapping = None
         self.build_from_lines(lines)
 
+    def pack(self, ids, vocab):
+        key = 0
+        for i in ids: key = key * vocab + i
+        return key
+
+    def unpack(self, key, vocab):
+        ids = []
+        for _ in range(self.n):
+            key, i = divmod(key, vocab)
+            ids.append(i)
+        return ids[::-1]
+
     def build_from_lines(self, lines):
+        if self.mapping is not None: self._unmap()
+        # Intern the words first, so that the number of them, which packed
+        # keys are in base of, is known
+        tokens, lengths = array("I"), array("I")
+        word_ids = self.word_ids
         for line in lines:
             line = line.replace("\r", " ")
             line = line.replace("\n", " ")
-            line_arr = ["^"] * self.n + [word.strip() for word in line.split()] + ["$"] * self.n
-
-            for i in range(self.n, len(line_arr)):
-                gram = make_gram(line_arr[i - self.n : i])
-                word = line_arr[i]
-                if (gram not in self.gram_dictionary):
-                    self.gram_dictionary[gram] = []
-                self.gram_dictionary[gram].append(word)
-    
+            words = line.split()
+            for word in words:
+                word = word.strip()
+                i = word_ids.get(word)
+                if i is None:
+                    i = word_ids[word] = len(self.words)
+                    self.words.append(word)
+                tokens.append(i)
+            lengths.append(len(words))
+
+        old_vocab, vocab = self.vocab, len(self.words)
+        self.vocab = vocab
+        transitions = self._transitions(tokens, lengths, vocab)
+        if len(self.state_keys):
+            transitions = heapq.merge(self._old_transitions(old_vocab, vocab), transitions)
+        self._compile(transitions, vocab)
+
+    def _transitions(self, tokens, lengths, vocab):
+        """ (state * vocab + successor, count) for each distinct transition
+        in the tokenized lines, in order. """
+        start, end = self.word_ids[NGramTextModel.START], self.word_ids[NGramTextModel.END]
+        start_key = self.pack([start] * self.n, vocab)
+        shift = vocab ** (self.n - 1)
+        ends = [end] * self.n
+        # A sorted list of packed ints takes much less memory than counting
+        # in a dict
+        packed = []
+        pos = 0
+        for length in lengths:
+            key = start_key
+            for i in itertools.chain(tokens[pos:pos + length], ends):
+                packed.append(key * vocab + i)
+                key = key % shift * vocab + i
+            pos += length
+        packed.sort()
+        last, count = None, 0
+        for t in packed:
+            if t == last:
+                count += 1
+                continue
+            if count: yield last, count
+            last, count = t, 1
+        if count: yield last, count
+
+    def _old_transitions(self, old_vocab, vocab):
+        """ The transitions already in the model, repacked with the new number
+        of words. That doesn't change their order. """
+        for s, key in enumerate(self.state_keys):
+            state = self.pack(self.unpack(key, old_vocab), vocab) * vocab
+            prev = 0
+            for j in range(self.offsets[s], self.offsets[s + 1]):
+                yield state + self.succ_words[j], self.succ_cum[j] - prev
+                prev = self.succ_cum[j]
+
+    def _compile(self, transitions, vocab):
+        # Keys are less than vocab ** n; if that won't fit in 64 bits, fall back
+        # to a list of ints
+        keys = array("Q") if vocab ** self.n <= 1 << 64 else []
+        offsets = array("I", [0])
+        succ_words = array("I")
+        succ_cum = array("I")
+        last, last_t, total = None, None, 0
+        for t, count in transitions:
+            if t == last_t:
+                # The same transition from the old and the new lines
+                total += count
+                succ_cum[-1] = total
+                continue
+            state, word = divmod(t, vocab)
+            if state != last:
+                if last is not None: offsets.append(len(succ_words))
+                keys.append(state)
+                last, total = state, 0
+            total += count
+            succ_words.append(word)
+            succ_cum.append(total)
+            last_t = t
+        if last is not None: offsets.append(len(succ_words))
+
+        # Find the state each transition leads to. Generating stops at n END
+        # markers even if the corpus had "$" words of its own.
+        shift = vocab ** (self.n - 1)
+        index = {key: s for s, key in enumerate(keys)}
+        index[self.pack([self.word_ids[NGramTextModel.END]] * self.n, vocab)] = NGramTextModel.END_STATE
+        succ_next = array("I", bytes(4 * len(succ_words)))
+        for s, key in enumerate(keys):
+            state = key % shift * vocab
+            for j in range(offsets[s], offsets[s + 1]):
+                succ_next[j] = index[state + succ_words[j]]
+
+        self.state_keys, self.offsets = keys, offsets
+        self.succ_words, self.succ_cum, self.succ_next = succ_words, succ_cum, succ_next
+        self.start_state = index.get(self.pack([self.word_ids[NGramTextModel.START]] * self.n, vocab),
+                                     NGramTextModel.END_STATE)
+
     def generate_sentence(self):
-        sentence = self.n*["^"]
-        next_gram = sentence[-self.n : ]
-        while(next_gram != ["$"]*self.n):
-            try:
-                word_suggestion = random.choice(self.gram_dictionary[make_gram(next_gram)])
-                sentence += [word_suggestion]
-            except IndexError:
-                break
-            next_gram = sentence[-self.n : ]
-        return " ".join(sentence[self.n : -self.n])
+        offsets, succ_words, succ_cum, succ_next = self.offsets, self.succ_words, self.succ_cum, self.succ_next
+        rand = random.random
+        s = self.start_state
+        sentence = []
+        while s != NGramTextModel.END_STATE:
+            lo, hi = offsets[s], offsets[s + 1]
+            if hi - lo == 1:
+                j = lo
+            else:
+                j = bisect_right(succ_cum, rand() * succ_cum[hi - 1], lo, hi)
+            sentence.append(succ_words[j])
+            s = succ_next[j]
+        # The sentence ends with n END markers
+        return " ".join([self.words[i] for i in sentence[:len(sentence) - self.n]])
+
+    def save(self, path):
+        """ Write the model to path, in the form load() maps. """
+        if isinstance(self.state_keys, list):
+            raise ValueError("too many words for state keys to fit in a model file")
+        word_offsets, data = array("I", [0]), bytearray()
+        for word in self.words:
+            data += word.encode("utf-8")
+            word_offsets.append(len(data))
+        header = _model_header.pack(MODEL_MAGIC, MODEL_VERSION, sys.byteorder == "little",
+                                    self.n, self.vocab, len(self.state_keys), len(self.succ_words),
+                                    self.start_state, len(data), self.corpus_hash or bytes(32))
+
+        directory = os.path.dirname(os.path.abspath(path))
+        t = tempfile.NamedTemporaryFile("wb", delete=False, dir=directory)
+        try:
+            t.write(header)
+            for section in (word_offsets, data, self.state_keys, self.offsets,
+                            self.succ_words, self.succ_cum, self.succ_next):
+                t.write(bytes(_align(t.tell()) - t.tell()))
+                t.write(section)
+            t.flush()
+            os.fsync(t.fileno())
+            t.close()
+            os.replace(t.name, path)
+        except:
+            t.close()
+            try: os.unlink(t.name)
+            except OSError: pass
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """ Map a model written by save() read-only, so that every process
+        using the same file shares one copy of it. Raises ValueError if path
+        isn't a model file this machine can read. """
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, little, n, vocab, states, transitions, start_state, data_size, digest = \
+                    _model_header.unpack_from(mapping)
+        except struct.error:
+            mapping.close()
+            raise ValueError("{} is too short to be a model file".format(path))
+        if magic != MODEL_MAGIC or version != MODEL_VERSION or bool(little) != (sys.byteorder == "little"):
+            mapping.close()
+            raise ValueError("{} is not a model file this version can read".format(path))
+
+        layout = []
+        pos = _model_header.size
+        for typecode, count in (("I", vocab + 1), ("B", data_size), ("Q", states), ("I", states + 1),
+                                ("I", transitions), ("I", transitions), ("I", transitions)):
+            pos = _align(pos)
+            size = count * array(typecode).itemsize
+            layout.append((typecode, pos, size))
+            pos += size
+        if pos > len(mapping):
+            mapping.close()
+            raise ValueError("{} is truncated".format(path))
+        view = memoryview(mapping)
+        sections = [view[pos:pos + size].cast(typecode) for typecode, pos, size in layout]
+
+        model = cls.__new__(cls)
+        model.n, model.vocab, model.start_state, model.corpus_hash = n, vocab, start_state, digest
+        model.words, model.word_ids = WordTable(sections[0], sections[1]), None
+        model.state_keys, model.offsets, model.succ_words, model.succ_cum, model.succ_next = sections[2:]
+        model.mapping = (mapping, view, sections)
+        model.path = path
+        return model
+
+    def __reduce_ex__(self, protocol):
+        # A mapped model is sent to other processes as its file, which they map
+        # for themselves
+        if self.mapping is not None: return (NGramTextModel.load, (self.path,))
+        return super().__reduce_ex__(protocol)
+
+    def close(self):
+        """ Unmap a model loaded with load(). """
+        if self.mapping is None: return
+        mapping, view, sections = self.mapping
+        self.mapping = None
+        self.words = []
+        self.state_keys = self.offsets = self.succ_words = self.succ_cum = self.succ_next = ()
+        for section in sections: section.release()
+        view.release()
+        mapping.close()
+
+    def _unmap(self):
+        """ Copy a mapped model into memory, so that lines can be added to it. """
+        words = list(self.words)
+        arrays = [array(typecode, section) for typecode, section in
+                  (("Q", self.state_keys), ("I", self.offsets), ("I", self.succ_words),
+                   ("I", self.succ_cum), ("I", self.succ_next))]
+        self.close()
+        self.words, self.word_ids = words, {word: i for i, word in enumerate(words)}
+        self.state_keys, self.offsets, self.succ_words, self.succ_cum, self.succ_next = arrays
+
+def load_model(corpus, n, path=None):
+    """
+    The order-n model of the corpus file, mapped from the model file at path
+    (default <corpus>.n<n>.model). If that file is missing, or was built from
+    a different corpus or n, the model is built and saved there first.
+    """
+    if path is None: path = "{}.n{}.model".format(corpus, n)
+    digest = corpus_hash(corpus)
+    try:
+        model = NGramTextModel.load(path)
+        if model.n == n and model.corpus_hash == digest: return model
+        model.close()
+    except (OSError, ValueError):
+        pass
+
+    with open(corpus, "r") as f:
+        model = NGramTextModel(n, f.readlines())
+    model.corpus_hash = digest
+    try:
+        model.save(path)
+    except (OSError, ValueError) as e:
+        print("{}: could not save model: {}".format(path, e), file=sys.stderr)
+        return model
+    return NGramTextModel.load(path)
 
 class MarkovBot(PineappleBot):
-    def init():
+    """Bot that posts, and replies with, sentences from an order-n Markov
+    chain (n default 2) trained on a corpus file of one sentence per line.
+    The trained model is saved to model_file (default <corpus>.n<n>.model)
+    and memory-mapped from there, so it's only rebuilt when the corpus or n
+    changes, and bots using the same corpus share it. It can also be built
+    ahead of time with `python -m ananas.default.markov <corpus> -n <n>`."""
+
+    def init(self):
         self.config.n = 2
-    def start():
+    def start(self):
         if "corpus" not in self.config: raise ConfigurationError("MarkovBot requires a 'corpus'")
-        with open(self.config.grammar_file, "r") as f:
-            if f: self.model = NGramTextModel(self.config.n, f.lines())
-            else: raise ConfigurationError("Couldn't open corpus file")
+        if not os.path.isfile(self.config.corpus): raise ConfigurationError("Couldn't open corpus file")
+        start = time.monotonic()
+        self.model = load_model(self.config.corpus, int(self.config.n), self.config.get("model_file") or None)
+        self.log("markov", "Loaded model of {} ({} states) in {:.2f}s".format(
+            self.config.corpus, len(self.model.state_keys), time.monotonic() - start))
+        self.sentences = self.pregenerate(self.model.generate_sentence)
+
+    def stop(self):
+        # Nothing may be generating from the model once it's unmapped
+        self.stop_pregenerators()
+        model = getattr(self, "model", None)
+        if model is not None: model.close()
 
     @reply
     def reply(self, mention, user):
-        self.mastodon.status_post("@{} {}".format(user["acct"], 
-                self.model.generate_sentence()),
+        mention_text = "@{} ".format(user["acct"])
+        self.mastodon.status_post(mention_text + self.sentences.get(reserve=len(mention_text)),
                 in_reply_to_id = mention["id"],
                 visibility = mention["visibility"])
 
     @hourly()
     def post(self):
-        self.mastodon.toot(self.model.generate_sentence())
+        self.mastodon.toot(self.sentences.get())
 
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the model file for a MarkovBot corpus")
+    parser.add_argument("corpus", help="corpus file, one sentence per line")
+    parser.add_argument("-n", type=int, default=2, help="order of the model (default 2)")
+    parser.add_argument("-o", "--output", help="model file (default <corpus>.n<n>.model)")
+    args = parser.parse_args()
+    model = load_model(args.corpus, args.n, args.output)
+    print("{} words, {} states, {} transitions".format(model.vocab, len(model.state_keys), len(model.succ_words)))
@@ -1,5 +1,4 @@
-import random, string, itertools, traceback
-from more_itertools import peekable
+import functools, heapq, itertools, math, random, re, traceback
 from ananas import PineappleBot, reply, html_strip_tags
 
 def peek(gen): return gen.peek()
@@ -39,114 +38,154 @@ def peek(gen): return gen.peek()
 
 ops = "+-*x"
 
+# Parsed rolls are cached by their tokens, so popular rolls are only parsed
+# once however they're worded
+parse_cache_size = 1024
+
+_symbols = {c: c for c in ops + "dk;,"}
+_symbols["\U0001F4AF"] = 100
+# A token, with any (ASCII) whitespace before it: a number, a run of
+# characters which aren't tokens, or one character which is
+_token_re = re.compile(r"([ \t\n\r\x0b\x0c]*)(?:([0-9]+)|([^0-9 \t\n\r\x0b\x0c{}]+)|(.))".format(
+    re.escape("".join(_symbols))), re.S)
+
+class AbortedParseError(Exception): pass
+
+class Tokens():
+    """ Peekable iterator over a sequence of (token, whitespace before). """
+    __slots__ = ("tokens", "i")
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        i = self.i
+        if i >= len(self.tokens): raise StopIteration
+        self.i = i + 1
+        return self.tokens[i]
+
+    def peek(self):
+        if self.i >= len(self.tokens): raise StopIteration
+        return self.tokens[self.i]
+
+def tokenize(text):
+    """ The (token, whitespace before) pairs of text, normalized so that
+    texts which parse the same give the same tokens: any other character is
+    'z', and runs of them are one 'z', and whether there's whitespace before
+    a token is only kept for numbers, the only place it matters. """
+    tokens = []
+    for m in _token_re.finditer(text):
+        ws, digits, other, c = m.groups()
+        if digits is not None:
+            tokens.append((int(digits), ws != ""))
+            continue
+        if other is not None:
+            if not tokens or tokens[-1][0] != "z": tokens.append(("z", False))
+            continue
+        # Newlines are whitespace, not separators
+        if c in " \t\n\r\x0b\x0c": continue
+        token = _symbols.get(c, "z")
+        if token == "z" and tokens and tokens[-1][0] == "z": continue
+        tokens.append((token, isinstance(token, int) and ws != ""))
+    return tuple(tokens)
+
 def parse_dice(text):
-    class AbortedParseError(Exception): pass
+    # A copy, since the cached list is shared
+    return list(parse_tokens(tokenize(text)))
 
-    def expect(gen, pred): 
-        val,ws = gen.peek()
-        if (not pred(val,ws)): raise AbortedParseError("parse got unexpected value {} in {}".format(val, pred.__code__))
-        return next(gen)[0]
+@functools.lru_cache(maxsize=parse_cache_size)
+def parse_tokens(tokens):
+    return _parse_roll_list(Tokens(tokens))
 
-    def tokenizer():
-        s = ""
-        ws = False
-        for c in text:
-            if c in string.digits: s += c
-            else:
-                if len(s) > 0:
-                    yield int(s), ws
-                    s = ""
-                    ws = False
-                if c in string.whitespace: ws = True; continue
-                elif c in ops+"dk;,\n": yield c, ws; ws = False
-                elif c == '\U0001F4AF': yield 100, ws; ws = False
-                else: yield 'z', ws; ws = False
-        if len(s) > 0:
-            yield int(s), ws
-        return
-
-    def parse_roll_list(tokens):
-        rolls = []
+def _expect(gen, pred):
+    val,ws = gen.peek()
+    if (not pred(val,ws)): raise AbortedParseError("parse got unexpected value {} in {}".format(val, pred.__code__))
+    return next(gen)[0]
+
+def _parse_roll_list(tokens):
+    rolls = []
+    try:
+        roll = _parse_roll_add_expr(tokens)
+        if (roll[0] != 'c'):
+            rolls.append(roll)
+    except StopIteration: return rolls
+    except AbortedParseError as e: pass #print(repr(e))
+    except ValueError as e: pass #print(repr(e))
+
+    while True:
         try:
-            roll = parse_roll_add_expr(tokens)
+            next(tokens)
+            roll = _parse_roll_add_expr(tokens)
             if (roll[0] != 'c'):
                 rolls.append(roll)
-        except StopIteration: return rolls
-        except AbortedParseError as e: pass #print(repr(e))
-        except ValueError as e: pass #print(repr(e))
+        except StopIteration: break
+        except AbortedParseError as e: continue #print(repr(e)); continue
+        except ValueError as e: continue #print(repr(e)); continue
 
-        while True:
-            try:
-                next(tokens)
-                roll = parse_roll_add_expr(tokens)
-                if (roll[0] != 'c'):
-                    rolls.append(roll)
-            except StopIteration: break
-            except AbortedParseError as e: continue #print(repr(e)); continue
-            except ValueError as e: continue #print(repr(e)); continue
-
-        return rolls
-
-    # 2 * 3 x 4
-    # (* 2 3)
-    # (x (* 2 3) 4)
-    # (* 2 (x 3 4))
-
-    # 2 x 3 x 4
-    # (x 2 3)
-    # (x (x 2 3) 4)
-
-    def parse_roll_mul_expr(tokens):
-        lhs = parse_roll(tokens)
-        while True:
-            try: 
-                if (str(peek(tokens)[0]) not in "*x"): break
-                op = expect(tokens, lambda t,ws: t in "*x")
-                rhs = parse_roll(tokens)
-                lhs = (op, lhs, rhs)
-            except AbortedParseError: return lhs
-            except StopIteration: return lhs
-        return lhs
-
-    def parse_roll_add_expr(tokens):
-        lhs = parse_roll_mul_expr(tokens)
-        while True:
-            try: 
-                if (peek(tokens)[0] not in "+-"): break
-                op = expect(tokens, lambda t,ws: t in "+-")
-                rhs = parse_roll_mul_expr(tokens)
-                lhs = (op, lhs, rhs)
-            except AbortedParseError: return lhs
-            except StopIteration: return lhs
-        return lhs
-
-    def parse_roll(tokens):
-        p,ws = peek(tokens)
-        if (p == 'd'): c = -1
-        else: c = expect(tokens, lambda t,ws: isinstance(t, int))
+    return rolls
 
-        try:
-            d = expect(tokens, lambda t,ws: t == 'd')
-            sides = expect(tokens, lambda t,ws: isinstance(t, int) and not ws)
-        except AbortedParseError:
-            return ('c', c)
-        except StopIteration: 
-            if c < 0: raise ValueError() # lone 'd'
-            return ('c', c)
+# 2 * 3 x 4
+# (* 2 3)
+# (x (* 2 3) 4)
+# (* 2 (x 3 4))
 
-        if (c < 0): return ('r', 1, sides)
+# 2 x 3 x 4
+# (x 2 3)
+# (x (x 2 3) 4)
 
+def _parse_roll_mul_expr(tokens):
+    lhs = _parse_roll(tokens)
+    while True:
         try:
-            dk = expect(tokens, lambda t,ws: t == 'd' or t == 'k')
-            num = expect(tokens, lambda t,ws: isinstance(t, int))
-        except StopIteration: 
-            return ('r', c, sides)
-        except AbortedParseError:
-            return ('r', c, sides)
-
-        return ('r', c, sides, dk, num)
-
-    return parse_roll_list(peekable(tokenizer()))
+            if (str(peek(tokens)[0]) not in "*x"): break
+            op = _expect(tokens, lambda t,ws: t in "*x")
+            rhs = _parse_roll(tokens)
+            lhs = (op, lhs, rhs)
+        except AbortedParseError: return lhs
+        except StopIteration: return lhs
+    return lhs
+
+def _parse_roll_add_expr(tokens):
+    lhs = _parse_roll_mul_expr(tokens)
+    while True:
+        try:
+            if (peek(tokens)[0] not in "+-"): break
+            op = _expect(tokens, lambda t,ws: t in "+-")
+            rhs = _parse_roll_mul_expr(tokens)
+            lhs = (op, lhs, rhs)
+        except AbortedParseError: return lhs
+        except StopIteration: return lhs
+    return lhs
+
+def _parse_roll(tokens):
+    p,ws = peek(tokens)
+    if (p == 'd'): c = -1
+    else: c = _expect(tokens, lambda t,ws: isinstance(t, int))
+
+    try:
+        d = _expect(tokens, lambda t,ws: t == 'd')
+        sides = _expect(tokens, lambda t,ws: isinstance(t, int) and not ws)
+    except AbortedParseError:
+        return ('c', c)
+    except StopIteration:
+        if c < 0: raise ValueError() # lone 'd'
+        return ('c', c)
+
+    if (c < 0): return ('r', 1, sides)
+
+    try:
+        dk = _expect(tokens, lambda t,ws: t == 'd' or t == 'k')
+        num = _expect(tokens, lambda t,ws: isinstance(t, int))
+    except StopIteration:
+        return ('r', c, sides)
+    except AbortedParseError:
+        return ('r', c, sides)
+
+    return ('r', c, sides, dk, num)
 
 # Syntax tree visitors
 # They only do singular roll expressions since the calling code is likely to
@@ -232,38 +271,284 @@ def visit_sum_dice(d):
     elif isinstance(d, list): return " + ".join([str(r) for r in d])
     else: return "{} {} {}".format(visit_sum_dice(d[1]), d[0], visit_sum_dice(d[2]))
 
+# ROLLING
+# Dice are drawn in one batch per roll: with numpy, if it's installed and
+# there are at least numpy_min_dice of them, and with random.choices
+# otherwise. numpy is only imported the first time it's wanted.
+numpy_min_dice = 1000
+_numpy = None
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+def draw_dice(dice, sides):
+    """ The faces of <dice> <sides>-sided dice, rolled together. """
+    np = _get_numpy() if dice >= numpy_min_dice else None
+    if np is not None: return np.random.randint(1, sides + 1, size=dice).tolist()
+    return random.choices(range(1, sides + 1), k=dice)
+
+def select_dice(r, keep):
+    """ The highest <keep> of the rolls in r, in the order they were rolled.
+    Of equal rolls, the earliest are kept. """
+    if keep >= len(r): return r
+    kept = heapq.nlargest(keep, range(len(r)), key=r.__getitem__)
+    kept.sort()
+    return [r[i] for i in kept]
+
 # Roll <dice> <sides>-sided dice
 # If <keep> is specified, only return the top <keep>
 # If <drop> is specified, return all but the bottom <drop>
 def perform_roll(dice=1, sides=6, keep=-1, drop=-1):
-    r = []
-    rolls = []
     if sides == 0: 
         raise SillyDiceError("I don't have any zero-dimensional constructs but when I find one, I'll get back to you.")
     if dice > 50:
         raise SillyDiceError("I don't have that many dice!")
     if sides > 1000:
         raise SillyDiceError("I rolled the sphere and it rolled off the table.")
-    for i in range(dice):
-        roll = random.randint(1, sides)
-        r.append(roll)
-        rolls.append((i, roll))
-    rolls.sort(key=lambda roll: -roll[1])
-
-    if keep > 0:
-        rolls = rolls[0:keep]
-    elif drop > 0 and drop < dice:
-        rolls = rolls[0:-drop]
-    elif drop == -1 and keep == -1: pass
+    kept = _kept_dice(dice, keep, drop)
+    return select_dice(draw_dice(dice, sides), kept)
+
+def _kept_dice(dice, keep, drop):
+    """ How many of <dice> dice a roll keeps, as perform_roll takes keep and
+    drop. """
+    if keep > 0: return min(keep, dice)
+    elif drop > 0 and drop < dice: return dice - drop
+    elif drop == -1 and keep == -1: return dice
     else:
         raise SillyDiceError("Whoops, dropped all the dice")
 
-    if len(rolls) < len(r):
-        r = [roll for i,roll in enumerate(r) if (i, roll) in rolls]
+# DISTRIBUTIONS
+# The exact probability of every result of a roll expression, worked out
+# without rolling anything. A distribution is a pair
+#  (<lowest result>, [<probability of lowest>, <of lowest + 1>, ...])
+# Sums of rolls are convolutions of their distributions, done with numpy (by
+# FFT, when they're long) if it's installed.
+#
+# Anyone can ask for stats, so everything is checked before it's worked out:
+# no distribution may have more than stats_max_results possible results, and
+# the work for one reply is capped at stats_max_work steps, a step being one
+# pure Python operation or numpy_ops_per_step numpy element operations.
+
+# Limits for stats, which can go far beyond what we'll actually roll
+stats_max_dice = 10000
+stats_max_results = 200000
+stats_max_work = 5000000
+numpy_ops_per_step = 32
+# Percentiles given by dice_stats
+stats_percentiles = (5, 25, 50, 75, 95)
+
+class _Budget():
+    """ Steps of work left, spent before they're taken. """
+    __slots__ = ("left",)
+
+    def __init__(self, steps=None):
+        self.left = stats_max_work if steps is None else steps
+
+    def spend(self, steps):
+        if steps > self.left: raise SillyDiceError("I can't count that high.")
+        self.left -= steps
+
+def _check_results(n):
+    if n > stats_max_results: raise SillyDiceError("I can't count that high.")
+
+def _convolve(a, b, budget):
+    """ The distribution of the sum of results from distributions a and b. """
+    (lo_a, pa), (lo_b, pb) = a, b
+    n = len(pa) + len(pb) - 1
+    _check_results(n)
+    np = _get_numpy()
+    if np is not None:
+        if min(len(pa), len(pb)) > 64:
+            # Three FFTs of length n
+            budget.spend(3 * n * n.bit_length() // numpy_ops_per_step + 1)
+            p = np.fft.irfft(np.fft.rfft(pa, n) * np.fft.rfft(pb, n), n)
+            p = np.clip(p, 0.0, None)
+        else:
+            budget.spend(len(pa) * len(pb) // numpy_ops_per_step + 1)
+            p = np.convolve(pa, pb)
+        return (lo_a + lo_b, p.tolist())
+    budget.spend(len(pa) * len(pb))
+    p = [0.0] * n
+    for i, x in enumerate(pa):
+        if x == 0.0: continue
+        for j, y in enumerate(pb):
+            p[i + j] += x * y
+    return (lo_a + lo_b, p)
+
+def _convolve_power(a, times, budget):
+    """ The distribution of the sum of <times> results from distribution a. """
+    _check_results(times * (len(a[1]) - 1) + 1)
+    result = (0, [1.0])
+    while times:
+        if times & 1: result = _convolve(result, a, budget)
+        times >>= 1
+        if times: a = _convolve(a, a, budget)
+    return result
+
+def _negate(a):
+    lo, p = a
+    return (-(lo + len(p) - 1), p[::-1])
+
+def _multiply(a, b, budget):
+    """ The distribution of the product of results from distributions a and b. """
+    (lo_a, pa), (lo_b, pb) = a, b
+    hi_a, hi_b = lo_a + len(pa) - 1, lo_b + len(pb) - 1
+    ends = (lo_a * lo_b, lo_a * hi_b, hi_a * lo_b, hi_a * hi_b)
+    _check_results(max(ends) - min(ends) + 1)
+    budget.spend(len(pa) * len(pb) + max(ends) - min(ends))
+    # Spans every product, even those whose odds have rounded down to zero
+    lo = min(ends)
+    p = [0.0] * (max(ends) - lo + 1)
+    for i, x in enumerate(pa):
+        for j, y in enumerate(pb):
+            p[(lo_a + i) * (lo_b + j) - lo] += x * y
+    return (lo, p)
+
+def _from_dict(probs):
+    lo, hi = min(probs), max(probs)
+    p = [0.0] * (hi - lo + 1)
+    for v, x in probs.items(): p[v - lo] = x
+    return (lo, p)
+
+def _sum_distribution(dice, sides, budget):
+    """ The distribution of the total of <dice> <sides>-sided dice. """
+    _check_results(dice * (sides - 1) + 1)
+    die = (1, [1.0 / sides] * sides)
+    if _get_numpy() is not None: return _convolve_power(die, dice, budget)
+    # Adding a die sums a window of <sides>, taken from running totals
+    budget.spend(dice * (dice * (sides - 1) // 2 + sides) * 3)
+    p = [1.0]
+    for _ in range(dice):
+        totals = [0.0] * sides + list(itertools.accumulate(p))
+        totals += [totals[-1]] * (sides - 1)
+        p = [max(hi - lo, 0.0) / sides for lo, hi in zip(totals, totals[sides:])]
+    return (dice, p)
+
+def _keep_distribution(dice, sides, keep, budget):
+    """ The distribution of the total of the highest <keep> of <dice>
+    <sides>-sided dice. """
+    _check_results(keep * (sides - 1) + 1)
+    # Faces, times states, times dice on the face, times totals
+    budget.spend(sides * keep * keep * (keep * sides) // 2 + sides * keep * keep)
+    # Going through the faces from the highest, and deciding how many dice
+    # landed on each: dice not placed yet are no higher than the face, so
+    # each is on it with probability 1/face. The first <keep> placed are the
+    # ones kept, so until then the state is just the dice placed and the kept
+    # total, and after it the total is final.
+    states = {0: {0: 1.0}}
+    result = {}
+    for face in range(sides, 1, -1):
+        log_p, log_q = math.log(1.0 / face), math.log(1.0 - 1.0 / face)
+        new = {}
+        for placed, totals in states.items():
+            left = dice - placed
+            # Ways the kept dice aren't all placed yet, then the rest
+            remaining = 1.0
+            for j in range(keep - placed):
+                w = math.exp(math.lgamma(left + 1) - math.lgamma(j + 1) - math.lgamma(left - j + 1)
+                             + j * log_p + (left - j) * log_q)
+                remaining -= w
+                if w == 0.0: continue
+                target = new.setdefault(placed + j, {})
+                for total, x in totals.items():
+                    target[total + j * face] = target.get(total + j * face, 0.0) + x * w
+            if remaining <= 0.0: continue
+            add = (keep - placed) * face
+            for total, x in totals.items():
+                result[total + add] = result.get(total + add, 0.0) + x * remaining
+        states = new
+    # Whatever's left landed on 1
+    for placed, totals in states.items():
+        add = keep - placed
+        for total, x in totals.items():
+            result[total + add] = result.get(total + add, 0.0) + x
+    return _from_dict(result)
+
+def dice_distribution(spec, budget=None):
+    """ The distribution of results of the roll expression spec, worked out
+    within budget (by default, a fresh one of stats_max_work steps). """
+    if budget is None: budget = _Budget()
+    if spec[0] == 'c': return (spec[1], [1.0])
+    if spec[0] == 'r':
+        r = spec[1:]
+        dice, sides = r[0], r[1]
+        if sides == 0: 
+            raise SillyDiceError("I don't have any zero-dimensional constructs but when I find one, I'll get back to you.")
+        if dice > stats_max_dice:
+            raise SillyDiceError("I don't have that many dice!")
+        if sides > 1000:
+            raise SillyDiceError("I rolled the sphere and it rolled off the table.")
+        if dice == 0: return (0, [1.0])
+        if len(r) == 2: keep = dice
+        else: keep = _kept_dice(dice, r[3] if r[2] == 'k' else -1, r[3] if r[2] == 'd' else -1)
+        if keep == dice: return _sum_distribution(dice, sides, budget)
+        return _keep_distribution(dice, sides, keep, budget)
+    if spec[0] == 'x':
+        c = None
+        roll = None
+        if spec[1][0] == "c": c = spec[1]
+        elif spec[1][0] == "r": roll = spec[1]
+        if spec[2][0] == "c": c = spec[2]
+        elif spec[2][0] == "r": roll = spec[2]
 
-    return r
+        if (c == None or roll == None):
+            return _multiply(dice_distribution(spec[1], budget), dice_distribution(spec[2], budget), budget)
+        if (c[1] > stats_max_dice):
+            raise SillyDiceError("I don't have that many dice!")
+        return _convolve_power(dice_distribution(roll, budget), c[1], budget)
+    if spec[0] == '+':
+        return _convolve(dice_distribution(spec[1], budget), dice_distribution(spec[2], budget), budget)
+    if spec[0] == '-':
+        return _convolve(dice_distribution(spec[1], budget), _negate(dice_distribution(spec[2], budget)), budget)
+    if spec[0] == '*':
+        return _multiply(dice_distribution(spec[1], budget), dice_distribution(spec[2], budget), budget)
+    else: raise ValueError("Invalid dice specification")
+
+def dice_stats(spec, budget=None):
+    """ The lowest, highest and mean result of the roll expression spec, its
+    standard deviation, and its stats_percentiles as {percentile: result}.
+    See dice_distribution for budget. """
+    if budget is None: budget = _Budget()
+    lo, p = dice_distribution(spec, budget)
+    budget.spend(3 * len(p))
+    # Rounding leaves the total a hair off 1
+    total = sum(p)
+    mean = sum(i * x for i, x in enumerate(p)) / total
+    variance = sum((i - mean) ** 2 * x for i, x in enumerate(p)) / total
+    percentiles = {}
+    wanted = iter(stats_percentiles)
+    q = next(wanted)
+    cumulative = 0.0
+    for i, x in enumerate(p):
+        cumulative += x / total
+        while q is not None and cumulative >= q / 100 - 1e-12:
+            percentiles[q] = lo + i
+            q = next(wanted, None)
+        if q is None: break
+    for q in stats_percentiles: percentiles.setdefault(q, lo + len(p) - 1)
+    return {"min": lo, "max": lo + len(p) - 1, "mean": lo + mean,
+            "sd": math.sqrt(variance), "percentiles": percentiles}
+
+# "@roll stats 100d20" asks for the odds of a roll rather than rolling it
+_stats_re = re.compile(r"\bstats\b", re.I)
 
 class DiceBot(PineappleBot):
+    """Bot that rolls the dice in mentions, e.g. "@roll 3d20k1 + 2, 4d6d1".
+    Mentioning "stats" gets the odds of each roll instead (its mean, spread
+    and percentiles), worked out exactly, for up to stats_max_dice dice.
+    Installing numpy (the "numpy" extra) makes big rolls of both kinds
+    faster."""
+
+    def stop(self):
+        self.log("debug", "Parse cache: {}".format(parse_tokens.cache_info()))
+
     @reply
     def handle_roll(self, mention, user):
         raw = html_strip_tags(mention["content"]) 
@@ -284,6 +569,10 @@ class DiceBot(PineappleBot):
         else:
             self.log("debug", "rolls: {}".format(rolls))
 
+        if _stats_re.search(raw):
+            self.reply_stats(mention, username, rolls)
+            return
+
         for i, r in enumerate(rolls):
             try:
                 #r = fixup_tree(r)
@@ -303,4 +592,32 @@ class DiceBot(PineappleBot):
                 visibility = mention["visibility"])
 
 
+    def reply_stats(self, mention, username, rolls):
+        """ Reply with the odds of each roll instead of rolling it, as many
+        as fit in one post of max_length characters (default 500), all
+        worked out within one budget of stats_max_work steps. """
+        max_length = int(self.config.get("max_length", 500))
+        message = "@{}\n".format(username)
+        more = "…\n"
+        budget = _Budget()
+        for i, r in enumerate(rolls):
+            try:
+                stats = dice_stats(r, budget)
+                line = "Stats for {}: mean {:.2f}, sd {:.2f}, range {}-{}; {}\n".format(
+                        spec_dice(r), stats["mean"], stats["sd"], stats["min"], stats["max"],
+                        ", ".join("{}%: {}".format(q, v) for q, v in sorted(stats["percentiles"].items())))
+            except SillyDiceError as e:
+                line = str(e) + "\n"
+            # Leave room to say that there was more, unless this is the last
+            room = max_length - len(message) - (len(more) if i < len(rolls) - 1 else 0)
+            if len(line) > room:
+                if i == 0: message += line[:max(max_length - len(message) - len(more), 0)]
+                message += more
+                break
+            message += line
+
+        self.mastodon.status_post(message,
+                in_reply_to_id = mention["id"],
+                visibility = mention["visibility"])
+
 class SillyDiceError(Exception): pass
@@ -1,90 +1,386 @@
-import json, random
+import functools, json, os, random, threading
 from ananas import PineappleBot, ConfigurationError, hourly, reply
 
-def _split_delimited(str, sep, inside=False):
-    s = str.partition(sep)
-    if s[1] == sep:
-        if inside: return [sep + s[0]] + _split_delimited(s[2], sep, False) 
-        else: return ([s[0]] if s[0] else []) + _split_delimited(s[2], sep, True)
-    elif inside: raise ValueError("Uneven number of separators")
-    else: return [str] if str else []
+# Modifiers, as in tracery's base English modifiers
+
+def _is_vowel(c):
+    return c != "" and c.lower() in "aeiou"
+
+def _a(phrase):
+    # "a unicorn", but "an umbrella"
+    if phrase[:1].lower() == "u" and phrase[2:3].lower() == "i": return "a " + phrase
+    return ("an " if _is_vowel(phrase[:1]) else "a ") + phrase
+
+def _capitalize(phrase):
+    return phrase[:1].upper() + phrase[1:]
+
+def _capitalize_all(phrase):
+    out = []
+    cap_next = True
+    for c in phrase:
+        if not c.isalnum():
+            cap_next = True
+            out.append(c)
+        else:
+            out.append(c.upper() if cap_next else c)
+            cap_next = False
+    return "".join(out)
+
+def _s(phrase):
+    last = phrase[-1:]
+    if last in ("s", "h", "x"): return phrase + "es"
+    if last == "y" and not _is_vowel(phrase[-2:-1]): return phrase[:-1] + "ies"
+    return phrase + "s"
+
+def _first_s(phrase):
+    words = phrase.split(" ")
+    return " ".join([_s(words[0])] + words[1:])
+
+def _ed(phrase):
+    last = phrase[-1:]
+    if last == "e": return phrase + "d"
+    if last == "y" and not _is_vowel(phrase[-2:-1]): return phrase[:-1] + "ied"
+    return phrase + "ed"
+
+def _replace(phrase, old, new):
+    # Literally, as in tracery, which escapes the pattern
+    return phrase.replace(old, new)
+
+# Modifiers by name, looked up once when a grammar is compiled. Each is called
+# with the phrase and then any parameters, e.g. #x.replace(a,b)#
+filters = {
+    "a": _a,
+    "capitalize": _capitalize,
+    "capitalizeAll": _capitalize_all,
+    "s": _s,
+    "firstS": _first_s,
+    "ed": _ed,
+    "replace": _replace,
+}
+
+class _Modifier():
+    """ A modifier with its parameters. """
+    __slots__ = ("func", "params")
+
+    def __init__(self, func, params):
+        self.func = func
+        self.params = params
+
+    def __call__(self, phrase):
+        return self.func(phrase, *self.params)
+
+# Actions, [target:rule,rule...] and [target:POP], and the steps they're
+# carried out in on the expansion stack
+
+class _Push():
+    __slots__ = ("target", "sections")
+
+    def __init__(self, target, sections):
+        self.target = target
+        self.sections = sections
+
+class _Pop():
+    __slots__ = ("target",)
+
+    def __init__(self, target):
+        self.target = target
+
+class _Mark():
+    """ Notes where the output of one of a push's rules starts. """
+    __slots__ = ()
+
+class _Bind():
+    """ Binds target to the output of the last <count> marked rules. """
+    __slots__ = ("target", "count")
+
+    def __init__(self, target, count):
+        self.target = target
+        self.count = count
+
+_mark = _Mark()
+
+def _split(text, sep, parens=False):
+    """ Split text on sep, except where it's escaped, or inside a #tag# or
+    [action] (or, with parens, a (parameter list)). """
+    parts = []
+    depth = 0
+    in_tag = False
+    escaped = False
+    start = 0
+    for i, c in enumerate(text):
+        if escaped: escaped = False
+        elif c == "\\": escaped = True
+        elif c == "#" and depth == 0: in_tag = not in_tag
+        elif c == "[" or (parens and c == "("): depth += 1
+        elif (c == "]" or (parens and c == ")")) and depth > 0: depth -= 1
+        elif c == sep and depth == 0 and not in_tag:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+def _parse(rule):
+    """ Split rule into ("text", text), ("tag", raw) and ("action", raw)
+    sections. A backslash escapes the next character of text; the raw
+    contents of tags and actions keep theirs to be parsed in turn. """
+    sections = []
+    text = []
+    depth = 0
+    in_tag = False
+    escaped = False
+    start = 0
+    for i, c in enumerate(rule):
+        plain = not in_tag and depth == 0
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = True
+            continue
+        elif c == "[":
+            if plain:
+                if text: sections.append(("text", "".join(text)))
+                text = []
+                start = i + 1
+            depth += 1
+            continue
+        elif c == "]" and depth > 0:
+            depth -= 1
+            if depth == 0 and not in_tag: sections.append(("action", rule[start:i]))
+            continue
+        elif c == "#" and depth == 0:
+            if in_tag:
+                sections.append(("tag", rule[start:i]))
+            else:
+                if text: sections.append(("text", "".join(text)))
+                text = []
+                start = i + 1
+            in_tag = not in_tag
+            continue
+        if plain: text.append(c)
+    if in_tag: raise ValueError("Uneven number of separators")
+    if depth > 0: raise ValueError("Unclosed [")
+    if text: sections.append(("text", "".join(text)))
+    return sections
 
 class TraceryGrammar():
-    """ Class representing the runtime tree of a tracery grammar for easy
-    evaluation. """
+    """ A tracery grammar compiled for fast evaluation.
 
-    class Symbol():
-        def __init__(self, sym):
-            parts = sym.partition(".")
-            self.nonterminal = parts[0]
-            self.filter = parts[2]
+    Symbols are numbered, and rules[i] holds the options of symbol i, each a
+    tuple of literal strings, symbol numbers, (symbol number, modifiers)
+    pairs and actions, stored in reverse so they can go straight onto the
+    expansion stack. eval() expands with that explicit stack into one output
+    list, so deep grammars aren't limited by Python's recursion limit; only by
+    max_expansions, which stops grammars which never finish.
 
-        def eval(self, grammar):
-            return grammar.filter(grammar.eval(self.nonterminal), self.filter)
+    Variables set by actions are kept per eval(), so a compiled grammar is
+    never changed and can be shared between bots and threads. """
 
-        def __str__(self):
-            return "<symbol: {}{}>".format(self.nonterminal, " <- {}".format(self.filter) if self.filter else "")
+    max_expansions = 100000
 
     def __init__(self, json_dict):
-        self.nonterminals = json_dict
-        for n,expansion in self.nonterminals.items():
-            for i,option in enumerate(expansion):
+        self.symbols = []
+        self.symbol_ids = {}
+        self.rules = []
+        for n in json_dict: self.symbol_id(n)
+        for n, expansion in json_dict.items():
+            if isinstance(expansion, str): expansion = [expansion]
+            options = []
+            for option in expansion:
                 try:
-                    symbols = _split_delimited(option, "#")
+                    options.append(tuple(reversed(self.compile(option))))
                 except ValueError as e:
                     raise ValueError("In {}: {}".format(option, e))
-                for j,s in enumerate(symbols):
-                    if s[0] == "#":
-                        symbols[j] = TraceryGrammar.Symbol(s[1:])
-                expansion[i] = symbols
+            self.rules[self.symbol_ids[n]] = tuple(options)
+        self.rules = tuple(self.rules)
+
+    def symbol_id(self, name):
+        i = self.symbol_ids.get(name)
+        if i is None:
+            i = self.symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name)
+            # Symbols which are used but never defined (e.g. set by actions)
+            # only fail if expanded while unset
+            self.rules.append(None)
+        return i
+
+    def compile(self, rule):
+        """ The literal strings, symbol references and actions of rule, in
+        order. """
+        items = []
+        for kind, value in _parse(rule):
+            if kind == "text": items.append(value)
+            elif kind == "action": items.append(self.compile_action(value))
+            else: items += self.compile_tag(value)
+        return items
+
+    def compile_action(self, action):
+        target, sep, rules = action.partition(":")
+        if not sep: raise ValueError("Unsupported action [{}]".format(action))
+        target = self.symbol_id(target)
+        if rules == "POP": return _Pop(target)
+        return _Push(target, tuple(tuple(reversed(self.compile(r))) for r in _split(rules, ",")))
+
+    def compile_tag(self, tag):
+        actions = []
+        name = ""
+        for kind, value in _parse(tag):
+            if kind == "action": actions.append(self.compile_action(value))
+            elif kind == "text": name += value
+        items = list(actions)
+        if name:
+            symbol, *modifiers = _split(name, ".", parens=True)
+            modifiers = tuple(self.filter_function(m) for m in modifiers if m)
+            items.append((self.symbol_id(symbol), modifiers) if modifiers else self.symbol_id(symbol))
+        # Variables set inside a tag only last until the end of it
+        items += [_Pop(a.target) for a in actions if isinstance(a, _Push)]
+        return items
+
+    def filter_function(self, func):
+        name, _, params = func.partition("(")
+        try:
+            f = filters[name]
+        except KeyError:
+            raise ValueError("Unknown filter {}".format(name))
+        if not params: return f
+        if not params.endswith(")"): raise ValueError("Unclosed ( in filter {}".format(func))
+        return _Modifier(f, tuple(params[:-1].split(",")))
 
     def filter(self, phrase, func):
         if func == "": return phrase
-        if func == "a": return ("an " if phrase[0] in "aeiou" else "a ") + phrase
-        if func == "capitalize": return phrase.capitalize()
-        if func == "capitalizeAll": return " ".join([w.capitalize() for w in phrase.split(" ")])
-        if func == "s": 
-            if phrase[-1] == "y": return phrase[:-1] + "ies"
-            return phrase + "s"
-        if func == "ed": 
-            if phrase[-1] == "y": return phrase[:-1] + "ied"
-            else: return phrase + "ed"
-        raise ValueError("Unknown filter {}".format(func))
+        return self.filter_function(func)(phrase)
 
     def eval(self, sym):
-        options = self.nonterminals[sym]
-        expansion = random.choice(options)
-        return "".join([s.eval(self) if isinstance(s, TraceryGrammar.Symbol) else s for s in expansion])
+        rules, choice = self.rules, random.choice
+        out = []
+        # Literals, symbols and actions still to come, last first, and
+        # [modifiers, start] markers to apply modifiers to everything output
+        # since start
+        stack = [self.symbol_ids[sym]]
+        # Symbol -> stack of options set by actions; where push rules start
+        bindings = {}
+        marks = []
+        expansions = 0
+        while stack:
+            item = stack.pop()
+            t = type(item)
+            if t is str:
+                out.append(item)
+                continue
+            if t is list:
+                funcs, start = item
+                text = "".join(out[start:])
+                for f in funcs: text = f(text)
+                out[start:] = [text]
+                continue
+            if t is tuple:
+                item, funcs = item
+                stack.append([funcs, len(out)])
+                t = int
+            if t is int:
+                bound = bindings.get(item) if bindings else None
+                options = bound[-1] if bound else rules[item]
+                if options is None: raise KeyError(self.symbols[item])
+                expansions += 1
+                if expansions > self.max_expansions:
+                    raise ValueError("Expanding {} took more than {} steps".format(sym, self.max_expansions))
+                stack.extend(choice(options))
+            elif t is _Push:
+                # Expand each of its rules in turn, then bind the results
+                stack.append(_Bind(item.target, len(item.sections)))
+                for section in reversed(item.sections):
+                    stack.extend(section)
+                    stack.append(_mark)
+            elif t is _Mark:
+                marks.append(len(out))
+            elif t is _Bind:
+                starts = marks[-item.count:]
+                del marks[-item.count:]
+                ends = starts[1:] + [len(out)]
+                options = tuple(("".join(out[s:e]),) for s, e in zip(starts, ends))
+                del out[starts[0]:]
+                bindings.setdefault(item.target, []).append(options)
+            elif t is _Pop:
+                bound = bindings.get(item.target)
+                if bound: bound.pop()
+        return "".join(out)
 
     def __str__(self):
+        filter_names = {f: name for name, f in filters.items()}
+        def describe(s):
+            if isinstance(s, int):
+                return "<symbol: {}>".format(self.symbols[s])
+            if isinstance(s, tuple):
+                names = [filter_names.get(f) or "{}({})".format(filter_names[f.func], ",".join(f.params))
+                         for f in s[1]]
+                return "<symbol: {} <- {}>".format(self.symbols[s[0]], ".".join(names))
+            if isinstance(s, _Push):
+                return "<push: {}>".format(self.symbols[s.target])
+            if isinstance(s, _Pop):
+                return "<pop: {}>".format(self.symbols[s.target])
+            return s
+
         r = ""
-        for n, os in self.nonterminals.items():
+        for n, options in zip(self.symbols, self.rules):
+            if options is None: continue
             r += "{}:\n".format(n)
-            for o in os:
+            for o in options:
                 r += "    "
-                for s in o:
-                    r += "{}, ".format(str(s))
+                for s in reversed(o):
+                    r += "{}, ".format(describe(s))
                 r += "\n"
         return r
 
+# Compiled grammars by absolute path, with the modification time and size of
+# the file they were compiled from
+_grammars = {}
+_grammars_lock = threading.Lock()
+
+def load_grammar(path):
+    """ The compiled grammar in the JSON file at path. Grammars are cached for
+    as long as their file doesn't change, so bots using the same one share
+    it. """
+    path = os.path.abspath(path)
+    with _grammars_lock:
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        cached = _grammars.get(path)
+        if cached is not None and cached[0] == signature: return cached[1]
+        with open(path, "r") as f:
+            grammar = TraceryGrammar(json.load(f))
+        _grammars[path] = (signature, grammar)
+        return grammar
+
 class TraceryBot(PineappleBot):
+    """Bot that posts, and replies with, expansions of root_symbol (default
+    "origin") in the tracery grammar in grammar_file. Bots using the same
+    grammar file share one compiled copy of it."""
+
     def init(self):
         self.config.root_symbol = "origin"
 
     def start(self):
         if "grammar_file" not in self.config: raise ConfigurationError("TraceryBot requires a 'grammar_file'")
         if "root_symbol" not in self.config: raise ConfigurationError("TraceryBot requires a 'root_symbol'")
-        with open(self.config.grammar_file, "r") as f:
-            if f: self.grammar = TraceryGrammar(json.load(f))
-            else: raise ConfigurationError("Couldn't open grammar file")
+        try:
+            self.grammar = load_grammar(self.config.grammar_file)
+        except OSError:
+            raise ConfigurationError("Couldn't open grammar file")
+        # Replacing any from before a reload
+        self.stop_pregenerators()
+        self.outputs = self.pregenerate(functools.partial(self.grammar.eval, self.config.root_symbol))
+
+    def reload(self):
+        # Pick up a new grammar_file, or changes to the grammar itself
+        self.start()
+        return True
 
     @reply
     def reply(self, mention, user):
-        self.mastodon.status_post("@{} {}".format(user["acct"], 
-                self.grammar.eval(self.config.root_symbol)),
+        mention_text = "@{} ".format(user["acct"])
+        self.mastodon.status_post(mention_text + self.outputs.get(reserve=len(mention_text)),
                 in_reply_to_id = mention["id"],
                 visibility = mention["visibility"])
 
     @hourly()
     def post(self):
-        self.mastodon.toot(self.grammar.eval(self.config.root_symbol))
+        self.mastodon.toot(self.outputs.get())
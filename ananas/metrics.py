@@ -0,0 +1,233 @@
+import bisect, json, math, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+class Histogram():
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+class Timer():
+    """ Context manager observing the time spent in its body, see
+    Metrics.timer. The label "status" is set to "error" if the body raises. """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.labels.setdefault("status", "ok" if exc_type is None else "error")
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics():
+    """
+    In-process registry of counters and histograms, keyed by name and labels.
+    Recording is a dict lookup and a few additions under a lock, so it's
+    cheap enough to leave on. The current values can be rendered in the
+    Prometheus text format (see MetricsServer), and every recorded event is
+    also handed to any sinks added with add_sink, e.g. a JSONLinesSink.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.sinks = []
+        # Added to every metric, e.g. the worker number when the runner is
+        # split across processes
+        self.common_labels = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, n=1, **labels):
+        """ Add n to the counter name{labels}. """
+        if self.common_labels: labels = dict(self.common_labels, **labels)
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None: counter = self.counters[key] = Counter()
+            counter.value += n
+        if self.sinks: self._emit("counter", name, n, labels)
+
+    def observe(self, name, value, **labels):
+        """ Record value (usually a duration in seconds) in the histogram
+        name{labels}. """
+        if self.common_labels: labels = dict(self.common_labels, **labels)
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = Histogram(self.buckets)
+            hist.counts[bisect.bisect_left(hist.buckets, value)] += 1
+            hist.count += 1
+            hist.sum += value
+        if self.sinks: self._emit("histogram", name, value, labels)
+
+    def timer(self, name, **labels):
+        """ with metrics.timer("name", bot=...): observes the time taken. """
+        return Timer(self, name, labels)
+
+    def get(self, name, **labels):
+        """ The current value of a counter, or (count, sum) of a histogram. """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key in self.counters: return self.counters[key].value
+            if key in self.histograms: return (self.histograms[key].count, self.histograms[key].sum)
+        return None
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        if sink in self.sinks: self.sinks.remove(sink)
+
+    def _emit(self, kind, name, value, labels):
+        for sink in self.sinks:
+            try:
+                sink.event(time.time(), kind, name, value, labels)
+            except Exception as e:
+                print("Exception in metrics sink: {}".format(repr(e)), file=sys.stderr)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format. """
+        with self.lock:
+            counters = [(key, c.value) for key, c in self.counters.items()]
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()]
+
+        out = []
+        seen = set()
+        def header(name, kind):
+            if name in seen: return
+            seen.add(name)
+            if name in self.help: out.append("# HELP {} {}".format(name, self.help[name]))
+            out.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in sorted(counters):
+            header(name, "counter")
+            out.append("{}{} {}".format(name, _labels(labels), _number(value)))
+        for (name, labels), counts, count, total in sorted(histograms, key=lambda h: h[0]):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = "+Inf" if bound == math.inf else _number(bound)
+                out.append("{}_bucket{} {}".format(name, _labels(labels + (("le", le),)), cumulative))
+            out.append("{}_sum{} {}".format(name, _labels(labels), _number(total)))
+            out.append("{}_count{} {}".format(name, _labels(labels), count))
+        return "\n".join(out) + "\n"
+
+def _labels(labels):
+    if not labels: return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for k, v in labels) + "}"
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class JSONLinesSink():
+    """
+    Appends every metrics event to a file as one JSON object per line:
+    {"ts": ..., "kind": "counter"|"histogram", "name": ..., "value": ...,
+    "labels": {...}}. Lines are written in batches by the log writer thread,
+    so recording an event never waits on the disk. Each batch is a single
+    append, so several processes can share one file without their lines
+    getting mixed up.
+    """
+
+    def __init__(self, path, writer=None):
+        from .ananas import log_writer
+        self.path = path
+        self.writer = writer or log_writer
+        self.fd = None
+
+    def event(self, ts, kind, name, value, labels):
+        self.writer.write(self, ts, None, (kind, name, value, labels))
+
+    def close(self):
+        self.writer.flush(self, close=True)
+
+    # Called on the writer thread, see LogWriter
+
+    def _emit(self, entries):
+        if self.fd is None: self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        data = "".join(json.dumps({"ts": round(ts, 6), "kind": kind, "name": name,
+                                   "value": value, "labels": labels}) + "\n"
+                       for ts, _, (kind, name, value, labels) in entries).encode("utf-8")
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def _flush(self, close=False):
+        if close and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class MetricsServer():
+    """
+    Serves a Metrics registry at http://<host>:<port>/metrics for Prometheus
+    to scrape, from a daemon thread.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        registry = metrics
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="ananas-metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+metrics = Metrics()
+metrics.describe("ananas_handler_seconds", "Time spent in @reply, @interval and @schedule functions.")
+metrics.describe("ananas_api_seconds", "Mastodon API request latency.")
+metrics.describe("ananas_api_errors_total", "Mastodon API requests which failed with an HTTP error status.")
+metrics.describe("ananas_mentions_total", "Mentions received.")
+metrics.describe("ananas_stream_reconnects_total", "Streaming connection reconnect attempts.")
+metrics.describe("ananas_scheduler_lag_seconds", "How late @interval and @schedule functions started compared to when they were due.")
+metrics.describe("ananas_scheduler_skipped_total", "Due times of @schedule functions skipped because the previous run was still going.")
+metrics.describe("ananas_startup_seconds", "Time taken to log in and start each bot.")
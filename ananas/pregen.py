@@ -0,0 +1,157 @@
+import sys, threading
+from collections import deque
+
+# The generate function of a pool worker process, set when it starts
+_generate = None
+
+def _start_worker(generate):
+    global _generate
+    _generate = generate
+
+def _generate_batch(n):
+    return [_generate() for _ in range(n)]
+
+class Pregenerator():
+    """
+    Keeps up to <size> outputs of generate() ready, so that a bot's handlers
+    can take one with get() instead of generating it while the mention or
+    schedule waits. Whenever fewer than <low_water> are left, a background
+    thread tops the buffer back up: in batches run by a pool of <processes>
+    worker processes if that's more than 0 (generate must then be picklable),
+    and otherwise on that thread itself.
+
+    Outputs longer than max_length characters, and, if recent is more than 0,
+    the same as one of the last <recent> taken or one still waiting, are
+    thrown away as they're generated, so get() doesn't have to check. If the
+    buffer is ever empty, get() generates an output itself.
+
+    get(reserve) leaves room for <reserve> more characters within max_length,
+    e.g. for the mention a reply starts with: it takes the first output ready
+    which is short enough, leaving the rest for later.
+    """
+
+    # Candidates get() will generate looking for an acceptable one before
+    # giving up and returning the last, cut down to max_length
+    max_attempts = 100
+    # How long to wait before retrying after a batch with nothing acceptable
+    # in it, or which failed
+    retry_wait = 5.0
+    # How long stop() waits for an output being generated to finish
+    stop_timeout = 10.0
+
+    def __init__(self, generate, size=10, low_water=3, max_length=None, recent=0, processes=0, log=None):
+        self.generate = generate
+        self.size = size
+        self.low_water = min(low_water, size)
+        self.max_length = max_length
+        self.processes = processes
+        self.log = log or (lambda msg: print(msg, file=sys.stderr))
+
+        self.cond = threading.Condition()
+        self.buffer = deque()
+        self.buffered = set()
+        self.recent = deque(maxlen=recent) if recent > 0 else None
+        self.recent_set = set()
+        self.running = False
+        self.thread = None
+        self.pool = None
+
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    def start(self):
+        if self.size <= 0: return
+        if self.processes > 0:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.processes, initializer=_start_worker, initargs=(self.generate,))
+        self.running = True
+        self.thread = threading.Thread(target=self._threadproc, name="ananas-pregen", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop refilling the buffer, waiting for the background thread to
+        finish, so that whatever generate() uses can be freed once this
+        returns. """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.stop_timeout)
+            if self.thread.is_alive():
+                self.log("Pregeneration thread still running {:.0f}s after stopping".format(self.stop_timeout))
+        self.thread = None
+        self.pool = None
+
+    def stats(self):
+        with self.cond:
+            return {"ready": len(self.buffer), "hits": self.hits, "misses": self.misses,
+                    "rejected": self.rejected}
+
+    def _fits(self, text, reserve=0):
+        return self.max_length is None or len(text) <= self.max_length - reserve
+
+    def _acceptable(self, text, reserve=0):
+        if not self._fits(text, reserve): return False
+        if self.recent is None: return True
+        return text not in self.recent_set and text not in self.buffered
+
+    def _taken(self, text):
+        if self.recent is None: return
+        self.recent.append(text)
+        self.recent_set = set(self.recent)
+
+    def get(self, reserve=0):
+        with self.cond:
+            for i, text in enumerate(self.buffer):
+                if not self._fits(text, reserve): continue
+                del self.buffer[i]
+                self.buffered.discard(text)
+                self.hits += 1
+                self._taken(text)
+                if len(self.buffer) < self.low_water: self.cond.notify()
+                return text
+            self.misses += 1
+            if self.running: self.cond.notify()
+
+        for _ in range(self.max_attempts):
+            text = self.generate()
+            with self.cond:
+                if self._acceptable(text, reserve): break
+                self.rejected += 1
+        else:
+            if self.max_length is not None: text = text[:max(self.max_length - reserve, 0)]
+        with self.cond: self._taken(text)
+        return text
+
+    def _threadproc(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.buffer) >= self.low_water: self.cond.wait()
+                if not self.running: return
+                wanted = self.size - len(self.buffer)
+
+            accepted = 0
+            try:
+                if self.pool is not None:
+                    candidates = self.pool.submit(_generate_batch, wanted).result()
+                else:
+                    candidates = (self.generate() for _ in range(wanted))
+                for text in candidates:
+                    with self.cond:
+                        if not self.running: return
+                        if len(self.buffer) >= self.size: break
+                        if not self._acceptable(text):
+                            self.rejected += 1
+                            continue
+                        self.buffer.append(text)
+                        self.buffered.add(text)
+                        accepted += 1
+            except Exception as e:
+                self.log("Exception generating outputs: {}".format(repr(e)))
+
+            if accepted == 0:
+                with self.cond:
+                    if self.running: self.cond.wait(self.retry_wait)
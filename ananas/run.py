@@ -1,62 +1,295 @@
 #!/usr/bin/env python3
-import os, sys, signal, argparse, configparser, traceback, time
+import os, sys, signal, argparse, configparser, traceback, time, threading, importlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing
-from ananas import PineappleBot
-import ananas.default
+from ananas.metrics import metrics, JSONLinesSink, MetricsServer
 
 # Add the cwd to the module search path so that we can load user bot classes
 sys.path.append(os.getcwd())
 
+# ananas.ananas, imported by import_runtime once we know we're running bots
+# (and not just supervising worker processes)
+core = None
 bots = []
+runtime = None
+connection_pool = None
+api_timings = {}
+# Shared stream readers, one per instance domain
+stream_muxes = {}
+metrics_server = None
+metrics_sink = None
+# Bots are started on several threads at once
+output_lock = threading.Lock()
+startup = None
+# The settings of each bot's config section as of the last (re)load
+sections = {}
+reload_lock = threading.Lock()
+watcher = None
+# Changing these always means starting the bot again rather than reloading it
+restart_keys = ("class", "domain", "client_id", "client_secret", "access_token")
+# Bot classes by (module, class name)
+bot_classes = {}
+# (bot, seconds importing, seconds starting) for --profile-startup
+startup_profile = []
+
+def record_api_timing(base, method, path, status, seconds):
+    count, total = api_timings.get(base, (0, 0.0))
+    api_timings[base] = (count + 1, total + seconds)
+
+def import_runtime():
+    """ Import everything needed to run bots, returning how long it took. """
+    global core
+    start = time.perf_counter()
+    import ananas.ananas as core
+    return time.perf_counter() - start
+
+def load_class(module, name):
+    """ The class <name> from <module>, importing it the first time. """
+    key = (module, name)
+    if key not in bot_classes:
+        bot_classes[key] = getattr(importlib.import_module(module), name)
+    return bot_classes[key]
+
+def load_bot(prog, module, botclass, config, name, args, stream_mux):
+    """ Construct (and so log in and start) one bot, returning it or None if
+    it couldn't be loaded. Runs on one of the startup threads. """
+    start = time.perf_counter()
+    imported = start
+    try:
+        cls = load_class(module, botclass)
+        imported = time.perf_counter()
+        bot = cls(config, name=name, interactive=args.interactive, verbose=args.verbose,
+                  runtime=runtime, stream_mux=stream_mux, connection_pool=connection_pool)
+    except ModuleNotFoundError as e:
+        with output_lock:
+            print("{}: encountered the following error loading module {}:".format(prog, module))
+            print("{}: the error was: {}".format(prog, e))
+            print("{}: skipping {}!".format(prog, name))
+        return None
+    except Exception as e:
+        with output_lock:
+            print("{}: fatal exception loading bot {}: {}\n{}".format(prog, name, repr(e), traceback.format_exc()))
+        return None
+    bots.append(bot)
+    elapsed = time.perf_counter() - start
+    startup_profile.append((name, imported - start, elapsed - (imported - start)))
+    metrics.observe("ananas_startup_seconds", elapsed, bot=name)
+    with output_lock:
+        if bot.state == core.PineappleBot.RUNNING:
+            print("{}: started {} in {:.2f}s".format(prog, name, elapsed))
+        else:
+            print("{}: {} failed to start after {:.2f}s, see its log".format(prog, name, elapsed))
+    return bot
+
+def read_sections(args):
+    """ The settings of each bot section of the config, including those from
+    DEFAULT, limited to this worker's share of the sections with --workers. """
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+    only = args.sections.split(",") if args.sections is not None else None
+    return {name: dict(cfg.items(name, raw=True)) for name in cfg
+            if name != "DEFAULT" and (only is None or name in only)}
+
+def start_bots(prog, args, names):
+    """ Start the bots for the given config sections concurrently, since
+    most of the time taken is waiting on their instances; one slow or
+    unreachable instance only ties up one of the startup threads. Returns
+    once they've all started (or failed to). """
+    futures = []
+    for bot in names:
+        section = sections[bot]
+        if not "class" in section:
+            print("{}: no class specified, skipping {}.".format(prog, bot))
+            continue
+
+        botclass = section["class"]
+        module, _, botclass = botclass.rpartition(".")
+        if module == "":
+            print("{}: no module given in class name '{}', skipping {}.".format(prog, botclass, bot))
+
+        stream_mux = None
+        domain = section.get("domain")
+        if args.shared_streams and domain:
+            from ananas.streaming import StreamMultiplexer
+            if domain not in stream_muxes: stream_muxes[domain] = StreamMultiplexer(domain)
+            stream_mux = stream_muxes[domain]
+
+        futures.append(startup.submit(load_bot, prog, module, botclass, args.config, bot, args, stream_mux))
+    for future in as_completed(futures): future.result()
+    return len(futures)
+
+def find_bot(name):
+    for bot in bots:
+        if bot.name == name: return bot
+    return None
+
+def stop_bot(name):
+    bot = find_bot(name)
+    if bot is None: return
+    if bot.state == core.PineappleBot.RUNNING: bot.shutdown()
+    bots.remove(bot)
+
+def reload_config(prog, args, force=False):
+    """ Bring the running bots in line with the config file: start bots for
+    new sections, stop those whose sections were removed, and reload or
+    restart those whose settings changed (all of them if force is set). Bots
+    whose sections didn't change are left alone. """
+    global sections
+    with reload_lock:
+        config_file = core.ConfigFile.files.get(os.path.realpath(args.config))
+        try:
+            new = read_sections(args)
+        except configparser.Error as e:
+            print("{}: not reloading {}: {}".format(prog, args.config, e))
+            return
+        old, sections = sections, new
+        if not force and config_file and config_file.written_by_us():
+            # Just the bots saving their own settings
+            return
+
+        for name in old:
+            if name not in new:
+                print("{}: {} was removed from the config, stopping it.".format(prog, name))
+                stop_bot(name)
+
+        restart = [name for name in new if name not in old]
+        for name in new:
+            if name not in old or (new[name] == old[name] and not force): continue
+            bot = find_bot(name)
+            # Load the new settings before anything else, so that saving the
+            # old ones when shutting down can't undo the change
+            try:
+                if bot is not None: bot.config.load(silent=True)
+            except Exception as e:
+                print("{}: exception loading the new settings of {}: {}".format(prog, name, repr(e)))
+            if bot is None or bot.state != core.PineappleBot.RUNNING or \
+               any(new[name].get(key) != old[name].get(key) for key in restart_keys):
+                stop_bot(name)
+                restart.append(name)
+                continue
+            try:
+                reloaded = bot.reload()
+            except Exception as e:
+                print("{}: exception reloading {}: {}\n{}".format(prog, name, repr(e), traceback.format_exc()))
+                reloaded = False
+            if reloaded:
+                print("{}: reloaded {}.".format(prog, name))
+            else:
+                stop_bot(name)
+                restart.append(name)
+        if restart: start_bots(prog, args, restart)
 
 def shutdown_all(signum, frame):
+    if watcher: watcher.stop()
     for bot in bots:
-        if bot.state == PineappleBot.RUNNING: bot.shutdown()
+        if bot.state == core.PineappleBot.RUNNING: bot.shutdown()
+    # Write every bot's config changes out in one go
+    core.ConfigFile.flush_all()
+    for base, (count, total) in sorted(api_timings.items()):
+        print("{}: {} API calls, mean latency {:.0f}ms".format(base, count, 1000 * total / count), file=sys.stderr)
+    if connection_pool: connection_pool.close()
+    for mux in stream_muxes.values(): mux.stop()
+    core.scheduler.stop()
+    if core.reply_dispatcher: core.reply_dispatcher.stop()
+    if runtime: runtime.stop()
+    if metrics_server: metrics_server.stop()
+    if metrics_sink: metrics_sink.close()
     sys.exit("Shutdown complete")
 
+def supervise(args):
+    """ Run the config's bots across args.workers processes. """
+    from ananas.supervisor import Supervisor, strip_option
+    if not os.path.exists(args.config):
+        sys.exit("Couldn't open '{}', exiting.".format(args.config))
+
+    argv = strip_option(strip_option(sys.argv[1:], "--workers"), "--metrics-port")
+    supervisor = Supervisor(argv, args.config, args.workers, args.metrics_port, watch=not args.no_reload)
+    supervisor.run()
+
 def main():
     parser = argparse.ArgumentParser(description="Pineapple command line interface.", prog="ananas")
     parser.add_argument("config", help="A cfg file to read bot configuration from.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Log more extensive messages for e.g. debugging purposes.")
     parser.add_argument("-i", "--interactive", action="store_true", help="Use interactive prompts for e.g. mastodon login")
+    parser.add_argument("--scheduler-workers", type=int, default=8, metavar="N", help="Number of worker threads shared by every bot's @interval and @schedule functions (default: 8).")
+    parser.add_argument("--asyncio", action="store_true", help="Run every bot's scheduled jobs and reply handlers on a single asyncio event loop instead of worker threads.")
+    parser.add_argument("--shared-reply-workers", type=int, default=4, metavar="N", help="Number of worker threads running @reply handlers for bots with reply_pool = shared (default: 4).")
+    parser.add_argument("--shared-reply-queue", type=int, default=1000, metavar="N", help="Maximum number of mentions waiting for a shared reply worker (default: 1000).")
+    parser.add_argument("--shared-streams", action="store_true", help="Read the streaming connections of all bots on the same instance from one thread.")
+    parser.add_argument("--pool-size", type=int, default=10, metavar="N", help="Maximum number of keep-alive HTTP connections kept open to each instance, shared by all of its bots (default: 10; 0 gives every bot its own client session).")
+    parser.add_argument("--startup-parallelism", type=int, default=8, metavar="N", help="Number of bots to log in and start at the same time (default: 8; always 1 with --interactive).")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT", help="Serve handler, API and reconnect metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--metrics-log", metavar="FILE", help="Append every metrics event to FILE as a line of JSON.")
+    parser.add_argument("--profile-startup", action="store_true", help="Report how long importing and starting each bot took.")
+    parser.add_argument("--no-reload", action="store_true", help="Don't watch the config file for changes. Bots can still be reloaded with SIGHUP.")
+    parser.add_argument("--workers", type=int, default=1, metavar="N", help="Split the bots in the config between N worker processes, balanced by each section's weight setting (default: 1). A worker is restarted when sections are added for it.")
+    # Set by the supervisor for each of its workers
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--sections", help=argparse.SUPPRESS)
     args = parser.parse_args()
 
-    prog = sys.argv[0]
-
-    cfg = configparser.ConfigParser()
-    try: cfg.read(args.config)
-    except FileNotFoundError:
-        sys.exit("Couldn't open '{}', exiting.".format(args.config))
+    if args.workers > 1 and args.worker_id is None:
+        supervise(args)
+        return
+    if args.worker_id is not None: metrics.common_labels["worker"] = str(args.worker_id)
+    import_seconds = import_runtime()
 
-    for bot in cfg:
-        if bot == "DEFAULT": continue
-        if not "class" in cfg[bot]:
-            print("{}: no class specified, skipping {}.".format(prog, bot))
-            continue
+    global runtime, connection_pool, metrics_server, metrics_sink
+    if args.metrics_log:
+        metrics_sink = JSONLinesSink(args.metrics_log)
+        metrics.add_sink(metrics_sink)
+    if args.metrics_port is not None:
+        try:
+            metrics_server = MetricsServer(metrics, args.metrics_port)
+            metrics_server.start()
+        except OSError as e:
+            sys.exit("Couldn't serve metrics on port {}: {}".format(args.metrics_port, e))
+        if args.worker_id is not None:
+            from ananas.supervisor import METRICS_PORT_MARKER
+            print(METRICS_PORT_MARKER + str(metrics_server.port), flush=True)
+    if args.pool_size > 0:
+        connection_pool = core.ConnectionPool(pool_size=args.pool_size)
+        if args.verbose: connection_pool.add_timing_hook(record_api_timing)
+    core.scheduler.max_workers = max(args.scheduler_workers, 1)
+    core.shared_dispatcher(args.shared_reply_workers, args.shared_reply_queue)
+    if args.asyncio:
+        from ananas.aio import AsyncRuntime
+        runtime = AsyncRuntime(max_workers=max(args.scheduler_workers, 1))
+        runtime.start()
 
-        botclass = cfg[bot]["class"]
-        module, _, botclass = botclass.rpartition(".")
-        if module == "":
-            print("{}: no module given in class name '{}', skipping {}.".format(prog, botclass, bot))
+    prog = sys.argv[0]
 
-        try:
-            exec("from {0} import {1}; bots.append({1}('{2}', name='{3}', interactive={4}, verbose={5}))"
-                    .format(module, botclass, args.config, bot, args.interactive, args.verbose))
-        except ModuleNotFoundError as e:
-            print("{}: encountered the following error loading module {}:".format(prog, module))
-            print("{}: the error was: {}".format(prog, e))
-            print("{}: skipping {}!".format(prog, bot))
-            continue
-        except Exception as e:
-            print("{}: fatal exception loading bot {}: {}\n{}".format(prog, bot, repr(e), traceback.format_exc()))
-            continue
-        except KeyboardInterrupt:
-            sys.exit()
+    global sections, startup, watcher
+    sections = read_sections(args)
 
+    # Handle signals from the start, so that an interrupt during a slow start
+    # still shuts down the bots which are already running
     signal.signal(signal.SIGINT, shutdown_all)
     signal.signal(signal.SIGABRT, shutdown_all)
     signal.signal(signal.SIGTERM, shutdown_all)
 
+    started = time.perf_counter()
+    # Login prompts from bots starting side by side would interleave on the
+    # one terminal, so interactive starts go one at a time
+    parallelism = 1 if args.interactive else max(args.startup_parallelism, 1)
+    startup = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="ananas-startup")
+    count = start_bots(prog, args, list(sections))
+    running = len([bot for bot in bots if bot.state == core.PineappleBot.RUNNING])
+    print("{}: started {} of {} bots in {:.2f}s".format(prog, running, count, time.perf_counter() - started))
+    if args.profile_startup:
+        print("{}: importing ananas took {:.0f}ms".format(prog, 1000 * import_seconds))
+        for name, importing, starting in sorted(startup_profile, key=lambda p: -(p[1] + p[2])):
+            print("{}: {}: importing {:.0f}ms, starting {:.0f}ms".format(prog, name, 1000 * importing, 1000 * starting))
+
+    if not args.no_reload:
+        from ananas.watch import FileWatcher
+        watcher = FileWatcher(args.config, lambda: reload_config(prog, args))
+        watcher.start()
+        if args.verbose: print("{}: watching {} for changes ({})".format(prog, args.config, watcher.method))
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload_config, args=(prog, args, True), name="ananas-reload").start())
+
     try:
         while(True): time.sleep(60)
     except KeyboardInterrupt:
@@ -0,0 +1,158 @@
+import json, os, sys, tempfile, threading
+
+class StateStore():
+    """
+    Small persistent key-value store for state which changes as a bot runs
+    (cursors, counters, ids it has already seen) and so shouldn't live in the
+    hand-edited config file. Values can be anything JSON can represent.
+
+    Every change is appended to the file as one line of JSON and flushed, so a
+    write costs a single small append rather than rewriting anything, and
+    survives the process dying. When the log has grown to several times the
+    number of live keys it is compacted: the current contents are written to a
+    temp file which is then moved over it.
+    """
+
+    # Don't bother compacting logs shorter than this
+    compact_min = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        self.entries = 0
+        self.fp = None
+        self._replay()
+        if self.entries > max(self.compact_min, 2 * len(self.data)): self.compact()
+
+    def _replay(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            # Where the last complete line ends, and whether the file ends
+            # with a line cut short
+            good = 0
+            torn = False
+            for n, line in enumerate(f):
+                complete = line.endswith(b"\n")
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # Most likely the tail of a write cut short by a crash
+                    print("{}: ignoring unreadable line {}".format(self.path, n + 1), file=sys.stderr)
+                    if complete: good += len(line)
+                    else: torn = True
+                    continue
+                if "d" in entry: self.data.pop(entry["k"], None)
+                else: self.data[entry["k"]] = entry["v"]
+                self.entries += 1
+                good += len(line)
+                # Only the newline was lost
+                if not complete: torn = True
+        if torn: self._repair(good)
+
+    def _repair(self, good):
+        """ Cut a torn last line off the log, so that the next append starts
+        on a line of its own instead of being glued to it and lost too. """
+        try:
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+                if good:
+                    f.seek(good - 1)
+                    if f.read(1) != b"\n": f.write(b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print("{}: could not repair state: {}".format(self.path, e), file=sys.stderr)
+
+    def _append(self, entry):
+        if self.fp is None: self.fp = open(self.path, "a", encoding="utf-8")
+        self.fp.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.fp.flush()
+        self.entries += 1
+        if self.entries > max(self.compact_min, 4 * len(self.data)): self._compact()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.data[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def keys(self):
+        with self.lock:
+            return list(self.data.keys())
+
+    def set(self, key, value):
+        """ Store value under key. Writing the same value again is free. """
+        # Round-trip through JSON so that what's read back later, e.g. tuples
+        # becoming lists, matches what's read back after a restart
+        value = json.loads(json.dumps(value))
+        with self.lock:
+            if key in self.data and self.data[key] == value: return
+            self.data[key] = value
+            self._append({"k": key, "v": value})
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.data: return
+            del self.data[key]
+            self._append({"k": key, "d": 1})
+
+    def incr(self, key, n=1):
+        """ Add n to the counter under key and return its new value. """
+        with self.lock:
+            value = self.data.get(key, 0) + n
+            self.data[key] = value
+            self._append({"k": key, "v": value})
+            return value
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        t = tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=directory)
+        try:
+            for key, value in self.data.items():
+                t.write(json.dumps({"k": key, "v": value}, separators=(",", ":")) + "\n")
+            t.flush()
+            os.fsync(t.fileno())
+            t.close()
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            os.replace(t.name, self.path)
+        except OSError as e:
+            t.close()
+            try: os.unlink(t.name)
+            except OSError: pass
+            print("{}: could not compact state: {}".format(self.path, e), file=sys.stderr)
+            return
+        self.entries = len(self.data)
+
+    def sync(self):
+        """ Make sure everything written so far is on disk. """
+        with self.lock:
+            if self.fp is not None: os.fsync(self.fp.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.fp is None: return
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+            self.fp = None
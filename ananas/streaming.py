@@ -0,0 +1,294 @@
+import json, selectors, socket, ssl, threading, time
+from urllib.parse import urlparse, urljoin
+
+class StreamError(Exception):
+    pass
+
+class _Connection():
+    """
+    A single streaming API connection: a plain HTTP/1.1 GET on a non-blocking
+    socket, with just enough parsing (status line, headers, chunked transfer
+    encoding, server-sent event lines) for the Mastodon streaming API, so that
+    many of them can be read from one thread with a selector.
+    """
+
+    def __init__(self, url, headers, timeout=30, redirects=3):
+        for _ in range(redirects + 1):
+            location = self._connect(url, headers, timeout)
+            if location is None: break
+            url = urljoin(url, location)
+        else:
+            raise StreamError("Too many redirects connecting to {}".format(url))
+        self.sock.setblocking(False)
+
+    def _connect(self, url, headers, timeout):
+        parsed = urlparse(url)
+        secure = parsed.scheme in ("https", "wss")
+        host = parsed.hostname
+        port = parsed.port or (443 if secure else 80)
+        path = parsed.path or "/"
+        if parsed.query: path += "?" + parsed.query
+
+        sock = socket.create_connection((host, port), timeout=timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        self.sock = sock
+
+        request = ["GET {} HTTP/1.1".format(path), "Host: {}".format(parsed.netloc),
+                   "Accept: text/event-stream", "Cache-Control: no-cache"]
+        request += ["{}: {}".format(k, v) for k, v in headers.items()]
+        sock.sendall(("\r\n".join(request) + "\r\n\r\n").encode("utf-8"))
+
+        raw = b""
+        while b"\r\n\r\n" not in raw:
+            data = sock.recv(4096)
+            if not data: raise StreamError("Connection closed while reading response headers")
+            raw += data
+        head, _, self.raw = raw.partition(b"\r\n\r\n")
+        lines = head.decode("iso-8859-1").split("\r\n")
+        try:
+            status = int(lines[0].split(" ")[1])
+        except (IndexError, ValueError):
+            raise StreamError("Malformed status line '{}'".format(lines[0]))
+        response_headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+
+        if status in (301, 302, 303, 307, 308) and "location" in response_headers:
+            sock.close()
+            return response_headers["location"]
+        if status != 200:
+            sock.close()
+            raise StreamError("Could not connect to streaming server: HTTP {}".format(status))
+
+        self.chunked = "chunked" in response_headers.get("transfer-encoding", "")
+        self.chunk_left = 0
+        self.ended = False
+        self.body = b""
+        self.last_read = time.monotonic()
+        return None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        try: self.sock.close()
+        except OSError: pass
+
+    def read_lines(self):
+        """ Read everything available without blocking and return the complete
+        lines received, decoded. Raises StreamError once the server closes the
+        connection. """
+        closed = False
+        received = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                break
+            if not data:
+                closed = True
+                break
+            self.raw += data
+            received = True
+        if received: self.last_read = time.monotonic()
+
+        if self.chunked: self._dechunk()
+        else: self.body, self.raw = self.body + self.raw, b""
+        closed = closed or self.ended
+
+        *lines, self.body = self.body.split(b"\n")
+        lines = [line.rstrip(b"\r").decode("utf-8") for line in lines]
+        # If there's anything left to hand over, the closed socket will still
+        # be readable on the next select and we'll end up back here
+        if closed and not lines: raise StreamError("Server closed the streaming connection")
+        return lines
+
+    def _dechunk(self):
+        while self.raw:
+            if self.chunk_left > 0:
+                data = self.raw[:self.chunk_left]
+                self.raw = self.raw[len(data):]
+                self.body += data
+                self.chunk_left -= len(data)
+                if self.chunk_left == 0: self.chunk_left = -2 # trailing CRLF
+            elif self.chunk_left < 0:
+                skip = min(-self.chunk_left, len(self.raw))
+                self.raw = self.raw[skip:]
+                self.chunk_left += skip
+            else:
+                size, sep, rest = self.raw.partition(b"\r\n")
+                if not sep: return
+                try:
+                    self.chunk_left = int(size.split(b";")[0], 16)
+                except ValueError:
+                    raise StreamError("Malformed chunk header")
+                self.raw = rest
+                if self.chunk_left == 0:
+                    self.raw = b""
+                    self.ended = True
+                    return
+
+class SharedStream():
+    """
+    One bot's subscription to the user stream, read by a StreamMultiplexer.
+    Has the same close/is_alive/is_receiving interface as the handle returned
+    by Mastodon.stream_user, so the bot can treat either one the same way.
+    """
+
+    def __init__(self, mux, listener, url, headers):
+        self.mux = mux
+        self.listener = listener
+        self.url = url
+        self.headers = headers
+        self.conn = None
+        self.event = {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.mux._remove(self)
+
+    def is_alive(self):
+        return not self.closed and self.mux.thread is not None and self.mux.thread.is_alive()
+
+    def is_receiving(self):
+        return self.is_alive() and self.conn is not None
+
+    def _feed(self, line):
+        """ Parse one line of the event stream, dispatching completed events to
+        the listener the same way Mastodon.py's own reader would. """
+        if line == "":
+            event, self.event = self.event, {}
+            if not event: return
+            if hasattr(self.listener, "_dispatch"):
+                self.listener._dispatch(event)
+            elif "event" in event and "data" in event:
+                handler = getattr(self.listener, "on_" + event["event"].replace(".", "_"), None)
+                if handler: handler(json.loads(event["data"]))
+        elif line.startswith(":"):
+            self.listener.handle_heartbeat()
+        else:
+            key, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            self.event[key] = self.event[key] + "\n" + value if key in self.event else value
+
+class StreamMultiplexer():
+    """
+    Reads the user streams of many bots on one instance from a single thread.
+    Each bot still has its own authenticated connection (the streaming API
+    has no way to share one between accounts), but they're all serviced by one
+    selector loop instead of one Mastodon.py reader thread per bot, and parsed
+    events are routed to each bot's on_notification etc.
+
+    When a connection drops, the stream is closed and the listener's
+    on_close(error) is called from the reader thread; reconnecting (with a new
+    call to stream_user) is up to the listener, and mustn't block.
+    """
+
+    # The streaming server sends a heartbeat comment every ~15s
+    heartbeat_timeout = 60
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.streams = set()
+        self.pending = []
+        self.thread = None
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.streaming_base = None
+
+    def stream_user(self, mastodon, listener):
+        """ Open listener's user stream through this multiplexer. Raises
+        StreamError (or OSError) if the streaming server can't be reached this
+        way, in which case the caller should fall back to
+        mastodon.stream_user. """
+        headers = {"Authorization": "Bearer " + mastodon.access_token}
+        if getattr(mastodon, "user_agent", None): headers["User-Agent"] = mastodon.user_agent
+        url = self._get_streaming_base(mastodon) + "/api/v1/streaming/user"
+
+        stream = SharedStream(self, listener, url, headers)
+        stream.conn = _Connection(url, headers)
+        self._add(stream)
+        return stream
+
+    def stop(self):
+        for stream in list(self.streams): stream.close()
+
+    def _get_streaming_base(self, mastodon):
+        if self.streaming_base is None:
+            url = mastodon.api_base_url
+            streaming_api = mastodon.instance().get("urls", {}).get("streaming_api")
+            if streaming_api:
+                parsed = urlparse(streaming_api)
+                scheme = {"wss": "https", "ws": "http"}.get(parsed.scheme, parsed.scheme)
+                url = scheme + "://" + parsed.netloc
+            self.streaming_base = url.rstrip("/")
+        return self.streaming_base
+
+    def _add(self, stream):
+        with self.lock:
+            self.pending.append(stream)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._reader_threadproc, daemon=True,
+                                               name="ananas-stream-{}".format(self.domain))
+                self.thread.start()
+        self.wakeup_w.send(b"\0")
+
+    def _remove(self, stream):
+        with self.lock:
+            self.pending.append(stream)
+        self.wakeup_w.send(b"\0")
+
+    def _lost(self, stream, error):
+        """ Called on the reader thread when a connection drops. """
+        self.selector.unregister(stream.conn)
+        stream.conn.close()
+        stream.conn = None
+        self.streams.discard(stream)
+        if stream.closed: return
+        stream.closed = True
+        stream.listener.on_close(error)
+
+    def _sync_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for stream in pending:
+            if stream.closed:
+                if stream in self.streams:
+                    self.selector.unregister(stream.conn)
+                    self.streams.discard(stream)
+                if stream.conn is not None:
+                    stream.conn.close()
+                    stream.conn = None
+            elif stream not in self.streams and stream.conn is not None:
+                self.selector.register(stream.conn, selectors.EVENT_READ, stream)
+                self.streams.add(stream)
+
+    def _reader_threadproc(self):
+        while True:
+            for key, _ in self.selector.select(timeout=self.heartbeat_timeout / 4):
+                stream = key.data
+                if stream is None:
+                    try: self.wakeup_r.recv(4096)
+                    except BlockingIOError: pass
+                    self._sync_pending()
+                    continue
+                if stream not in self.streams: continue
+                try:
+                    for line in stream.conn.read_lines():
+                        stream._feed(line)
+                except (OSError, StreamError, ValueError) as e:
+                    self._lost(stream, e)
+                except Exception as e:
+                    # Don't let one bot's handler take down everyone's streams
+                    stream.listener.report_error("Exception handling stream event: {}".format(repr(e)), "stream")
+
+            now = time.monotonic()
+            for stream in list(self.streams):
+                if now - stream.conn.last_read > self.heartbeat_timeout:
+                    self._lost(stream, StreamError("No heartbeat in {}s".format(self.heartbeat_timeout)))
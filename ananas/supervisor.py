@@ -0,0 +1,264 @@
+import os, sys, signal, subprocess, threading, time
+import configparser
+
+# Printed by a worker on stdout to tell the supervisor where its metrics are
+METRICS_PORT_MARKER = "ananas-worker: metrics port "
+
+def read_weights(path):
+    """ [(name, weight)] for each bot section of the config at path. """
+    cfg = configparser.ConfigParser()
+    cfg.read(path)
+    sections = []
+    for bot in cfg:
+        if bot == "DEFAULT" or "class" not in cfg[bot]: continue
+        try:
+            weight = float(cfg[bot].get("weight", 1))
+        except ValueError:
+            print("ananas: invalid weight for {}, using 1.".format(bot))
+            weight = 1.0
+        sections.append((bot, weight))
+    return sections
+
+def assign_sections(sections, workers):
+    """ Split [(name, weight)] between <workers> workers so that each gets
+    about the same total weight, heaviest sections first. Returns one list of
+    section names per worker. """
+    shards = [[] for _ in range(workers)]
+    loads = [0.0] * workers
+    for name, weight in sorted(sections, key=lambda s: -s[1]):
+        i = loads.index(min(loads))
+        shards[i].append(name)
+        loads[i] += weight
+    return shards
+
+def strip_option(argv, option):
+    """ Remove "--option value" and "--option=value" from argv. """
+    out = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            out.append(arg)
+    return out
+
+class Worker():
+    def __init__(self, id, sections):
+        self.id = id
+        self.sections = sections
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.restart_at = None
+        self.metrics_port = None
+        self.output_threads = []
+        # Stopped to be started again with more sections
+        self.resharding = False
+
+class WorkerMetrics():
+    """ Renders the metrics of every worker as one Prometheus exposition, by
+    scraping each of them in turn. Each worker labels its own metrics with
+    worker="<id>", so only the HELP/TYPE headers need merging. """
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+
+    def render(self):
+        import urllib.request
+        families = {}
+        current = None
+        for worker in self.supervisor.workers:
+            if worker.metrics_port is None: continue
+            try:
+                text = urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(worker.metrics_port),
+                                              timeout=5).read().decode("utf-8")
+            except OSError:
+                continue
+            for line in text.splitlines():
+                if not line: continue
+                if line.startswith("# "):
+                    name = line.split(" ")[2]
+                    headers, _ = families.setdefault(name, ([], []))
+                    if line not in headers: headers.append(line)
+                    current = name
+                elif current is not None:
+                    families[current][1].append(line)
+        out = []
+        for headers, samples in families.values(): out += headers + samples
+        return "\n".join(out) + "\n"
+
+class Supervisor():
+    """
+    Runs the bots of one config file across several worker processes, each of
+    them an ordinary ananas runner given a share of the config's sections,
+    so CPU-heavy bots don't all contend for one interpreter lock. Sections are
+    balanced by their weight setting (default 1).
+
+    Worker output is passed through with a [worker N] prefix, crashed workers
+    are restarted with a growing delay, SIGINT/SIGTERM are forwarded so every
+    worker shuts its bots down cleanly, and SIGHUP so they all reload.
+
+    Each worker watches the config for changes to its own sections. The
+    supervisor watches it too (unless watch is False), and checks it on
+    SIGHUP, for sections which are new: those are given to a new worker while
+    there are fewer than <workers>, and otherwise to the least loaded ones,
+    which are restarted to pick them up.
+    """
+
+    restart_min_wait = 1
+    restart_max_wait = 60
+    # A worker which has been up this long gets its restart delay reset
+    stable_after = 60
+    shutdown_timeout = 30
+
+    def __init__(self, argv, config, workers, metrics_port=None, watch=True):
+        self.argv = argv
+        self.config = config
+        self.max_workers = workers
+        shards = assign_sections(read_weights(config), workers)
+        self.workers = [Worker(i, sections) for i, sections in enumerate(shards) if sections]
+        self.metrics_port = metrics_port
+        self.watch = watch
+        self.watcher = None
+        self.output_lock = threading.Lock()
+        self.stopping = False
+        self.config_changed = False
+
+    def start_worker(self, worker):
+        cmd = [sys.executable, "-m", "ananas.run"] + self.argv
+        cmd += ["--worker-id", str(worker.id), "--sections", ",".join(worker.sections)]
+        if self.metrics_port is not None: cmd += ["--metrics-port", "0"]
+        # In its own session, so that a ^C in the terminal only reaches us and
+        # each worker is told to stop exactly once
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        worker.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                          start_new_session=True, bufsize=1,
+                                          universal_newlines=True, env=env)
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        worker.metrics_port = None
+        worker.output_threads = []
+        for pipe, out in ((worker.process.stdout, sys.stdout), (worker.process.stderr, sys.stderr)):
+            thread = threading.Thread(target=self._forward_threadproc, args=(worker, pipe, out),
+                                      name="ananas-worker-{}-output".format(worker.id), daemon=True)
+            thread.start()
+            worker.output_threads.append(thread)
+        self.log("started worker {} (pid {}) with {}".format(worker.id, worker.process.pid, ", ".join(worker.sections)))
+
+    def _forward_threadproc(self, worker, pipe, out):
+        prefix = "[worker {}] ".format(worker.id)
+        for line in pipe:
+            if line.startswith(METRICS_PORT_MARKER):
+                worker.metrics_port = int(line[len(METRICS_PORT_MARKER):])
+                continue
+            with self.output_lock:
+                out.write(prefix + line)
+                out.flush()
+
+    def log(self, msg):
+        with self.output_lock:
+            print("ananas: {}".format(msg), file=sys.stderr, flush=True)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, "SIGHUP"): signal.signal(signal.SIGHUP, self.reload)
+        server = None
+        if self.metrics_port is not None:
+            from .metrics import MetricsServer
+            server = MetricsServer(WorkerMetrics(self), self.metrics_port)
+            server.start()
+        if self.watch:
+            from .watch import FileWatcher
+            self.watcher = FileWatcher(self.config, self.changed)
+            self.watcher.start()
+
+        for worker in self.workers: self.start_worker(worker)
+        while not self.stopping:
+            if self.config_changed:
+                self.config_changed = False
+                self.reshard()
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.restart_at is not None:
+                    if now >= worker.restart_at and not self.stopping: self.start_worker(worker)
+                    continue
+                code = worker.process.poll()
+                if code is None:
+                    if now - worker.started > self.stable_after: worker.restarts = 0
+                    continue
+                if worker.resharding:
+                    worker.resharding = False
+                    self.start_worker(worker)
+                    continue
+                delay = min(self.restart_min_wait * 2 ** worker.restarts, self.restart_max_wait)
+                worker.restarts += 1
+                worker.restart_at = now + delay
+                self.log("worker {} exited with status {}, restarting in {}s".format(worker.id, code, delay))
+            time.sleep(0.5)
+
+        if self.watcher: self.watcher.stop()
+        self.shutdown()
+        if server: server.stop()
+
+    def changed(self):
+        self.config_changed = True
+
+    def reshard(self):
+        """ Hand out the sections which have been added to the config since
+        the workers were given theirs. Removed sections are stopped by the
+        workers themselves, and stay assigned to them in case they come
+        back. """
+        sections = read_weights(self.config)
+        weights = dict(sections)
+        assigned = {name for worker in self.workers for name in worker.sections}
+        added = [(name, weight) for name, weight in sections if name not in assigned]
+        if not added: return
+        loads = {worker.id: sum(weights.get(name, 0.0) for name in worker.sections) for worker in self.workers}
+        touched = []
+        for name, weight in sorted(added, key=lambda s: -s[1]):
+            if len(self.workers) < self.max_workers:
+                worker = Worker(max((w.id for w in self.workers), default=-1) + 1, [])
+                self.workers.append(worker)
+                loads[worker.id] = 0.0
+            else:
+                worker = min(self.workers, key=lambda w: loads[w.id])
+            worker.sections.append(name)
+            loads[worker.id] += weight
+            if worker not in touched: touched.append(worker)
+        for worker in touched:
+            if worker.process is None:
+                self.start_worker(worker)
+            elif worker.process.poll() is None:
+                self.log("restarting worker {} to add {}".format(worker.id, ", ".join(
+                    name for name, _ in added if name in worker.sections)))
+                worker.resharding = True
+                worker.process.send_signal(signal.SIGTERM)
+            # Otherwise it's waiting to be restarted, and will be with them
+
+    def reload(self, signum=None, frame=None):
+        self.config_changed = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGHUP)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def shutdown(self):
+        running = [w for w in self.workers if w.process is not None and w.process.poll() is None]
+        for worker in running: worker.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker in running:
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.log("worker {} didn't stop in time, killing it".format(worker.id))
+                worker.process.kill()
+                worker.process.wait()
+        # Pass on the last of their output
+        for worker in running:
+            for thread in worker.output_threads: thread.join(5)
+        self.log("all workers stopped")
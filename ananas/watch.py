@@ -0,0 +1,116 @@
+import ctypes, ctypes.util, os, select, struct, sys, threading, time
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_event_header = struct.Struct("iIII")
+
+def _inotify():
+    """ libc, if it has inotify (i.e. on Linux), otherwise None. """
+    if not sys.platform.startswith("linux"): return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+class FileWatcher():
+    """
+    Calls callback() on a background thread whenever the file at path
+    changes. Uses inotify where it's available, watching the file's directory
+    so that files replaced by renaming a new one over them (as ConfigFile
+    does) are still noticed, and otherwise checks the file's mtime, size and
+    inode every poll_interval seconds. Bursts of changes within <debounce>
+    seconds of each other result in a single call.
+    """
+
+    def __init__(self, path, callback, debounce=0.5, poll_interval=2.0):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.method = None
+        self.thread = None
+        self.running = False
+        self.fd = None
+
+    def start(self):
+        self.running = True
+        libc = _inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+            if fd >= 0:
+                wd = libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(),
+                                            IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+                if wd >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        self.method = "inotify" if self.fd is not None else "polling"
+        target = self._inotify_threadproc if self.fd is not None else self._poll_threadproc
+        self.thread = threading.Thread(target=target, name="ananas-watch", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _changed(self):
+        try:
+            self.callback()
+        except Exception as e:
+            print("Exception handling change to {}: {}".format(self.path, repr(e)), file=sys.stderr)
+
+    def _read_events(self):
+        """ Whether any of the pending inotify events are about our file. """
+        name = os.path.basename(self.path).encode()
+        ours = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return ours
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                if data[offset:offset + length].rstrip(b"\0") == name: ours = True
+                offset += length
+
+    def _inotify_threadproc(self):
+        try:
+            while self.running:
+                ready, _, _ = select.select([self.fd], [], [], 1.0)
+                if not ready or not self._read_events(): continue
+                # Wait for the writes to settle down
+                while select.select([self.fd], [], [], self.debounce)[0]:
+                    self._read_events()
+                self._changed()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def _poll_threadproc(self):
+        last = self._signature()
+        while self.running:
+            time.sleep(self.poll_interval)
+            current = self._signature()
+            if current == last: continue
+            # Wait for the writes to settle down
+            time.sleep(self.debounce)
+            last = self._signature()
+            self._changed()
@@ -0,0 +1,186 @@
+"""
+Compares DiceBot's dice parser with the generator-based one it replaced, on
+mention texts like the ones it gets: time per parse for the old parser, and
+for the new one without and with its parse cache.
+
+    python benchmarks/dice_bench.py [--number N]
+"""
+import argparse, os, random, string, sys, timeit
+from more_itertools import peekable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ananas.default import roll
+
+ops = "+-*x"
+
+def peek(gen): return gen.peek()
+
+def legacy_parse_dice(text):
+    class AbortedParseError(Exception): pass
+
+    def expect(gen, pred): 
+        val,ws = gen.peek()
+        if (not pred(val,ws)): raise AbortedParseError("parse got unexpected value {} in {}".format(val, pred.__code__))
+        return next(gen)[0]
+
+    def tokenizer():
+        s = ""
+        ws = False
+        for c in text:
+            if c in string.digits: s += c
+            else:
+                if len(s) > 0:
+                    yield int(s), ws
+                    s = ""
+                    ws = False
+                if c in string.whitespace: ws = True; continue
+                elif c in ops+"dk;,\n": yield c, ws; ws = False
+                elif c == '\U0001F4AF': yield 100, ws; ws = False
+                else: yield 'z', ws; ws = False
+        if len(s) > 0:
+            yield int(s), ws
+        return
+
+    def parse_roll_list(tokens):
+        rolls = []
+        try:
+            roll = parse_roll_add_expr(tokens)
+            if (roll[0] != 'c'):
+                rolls.append(roll)
+        except StopIteration: return rolls
+        except AbortedParseError as e: pass #print(repr(e))
+        except ValueError as e: pass #print(repr(e))
+
+        while True:
+            try:
+                next(tokens)
+                roll = parse_roll_add_expr(tokens)
+                if (roll[0] != 'c'):
+                    rolls.append(roll)
+            except StopIteration: break
+            except AbortedParseError as e: continue #print(repr(e)); continue
+            except ValueError as e: continue #print(repr(e)); continue
+
+        return rolls
+
+    # 2 * 3 x 4
+    # (* 2 3)
+    # (x (* 2 3) 4)
+    # (* 2 (x 3 4))
+
+    # 2 x 3 x 4
+    # (x 2 3)
+    # (x (x 2 3) 4)
+
+    def parse_roll_mul_expr(tokens):
+        lhs = parse_roll(tokens)
+        while True:
+            try: 
+                if (str(peek(tokens)[0]) not in "*x"): break
+                op = expect(tokens, lambda t,ws: t in "*x")
+                rhs = parse_roll(tokens)
+                lhs = (op, lhs, rhs)
+            except AbortedParseError: return lhs
+            except StopIteration: return lhs
+        return lhs
+
+    def parse_roll_add_expr(tokens):
+        lhs = parse_roll_mul_expr(tokens)
+        while True:
+            try: 
+                if (peek(tokens)[0] not in "+-"): break
+                op = expect(tokens, lambda t,ws: t in "+-")
+                rhs = parse_roll_mul_expr(tokens)
+                lhs = (op, lhs, rhs)
+            except AbortedParseError: return lhs
+            except StopIteration: return lhs
+        return lhs
+
+    def parse_roll(tokens):
+        p,ws = peek(tokens)
+        if (p == 'd'): c = -1
+        else: c = expect(tokens, lambda t,ws: isinstance(t, int))
+
+        try:
+            d = expect(tokens, lambda t,ws: t == 'd')
+            sides = expect(tokens, lambda t,ws: isinstance(t, int) and not ws)
+        except AbortedParseError:
+            return ('c', c)
+        except StopIteration: 
+            if c < 0: raise ValueError() # lone 'd'
+            return ('c', c)
+
+        if (c < 0): return ('r', 1, sides)
+
+        try:
+            dk = expect(tokens, lambda t,ws: t == 'd' or t == 'k')
+            num = expect(tokens, lambda t,ws: isinstance(t, int))
+        except StopIteration: 
+            return ('r', c, sides)
+        except AbortedParseError:
+            return ('r', c, sides)
+
+        return ('r', c, sides, dk, num)
+
+    return parse_roll_list(peekable(tokenizer()))
+
+
+# Mention texts after html_strip_tags, weighted towards the popular rolls
+MENTIONS = [
+    "@roll d20",
+    "@roll d20",
+    "@roll@cybre.space d20",
+    "@roll 2d6+3",
+    "@roll 2d6 + 3",
+    "@roll 4d6d1",
+    "@roll 4d6d1, 4d6d1, 4d6d1, 4d6d1, 4d6d1, 4d6d1",
+    "@roll 3 d20 + 2",
+    "@roll 3d20 k 1 - 2",
+    "@roll 2d20k1+5 to hit, 1d8+3 damage",
+    "@roll 6x4d6d1",
+    "@roll d\U0001F4AF",
+    "hey @roll could you roll 1d100 for me? thanks!",
+    "@roll 8d6 fireball; 1d20+7 save",
+    "@roll 2d10 * 3 + d4 - 1",
+]
+
+def random_mention(rng):
+    """ Noisy input, for checking both parsers agree. """
+    alphabet = string.digits * 3 + "dkx+-*;, \n\t@aZ\u00a0\u00b2\U0001F4AF"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+
+def outcome(parse, text):
+    # Some input makes both raise (e.g. "2d6 5"), which DiceBot reports
+    try:
+        return parse(text)
+    except Exception as e:
+        return type(e)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DiceBot parser")
+    parser.add_argument("--number", type=int, default=20000, help="parses per measurement")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    for text in MENTIONS + [random_mention(rng) for _ in range(20000)]:
+        old, new = outcome(legacy_parse_dice, text), outcome(roll.parse_dice, text)
+        if old != new: sys.exit("parsers disagree on {!r}: {} != {}".format(text, old, new))
+    print("parsers agree on {} texts".format(len(MENTIONS) + 20000))
+
+    texts = [MENTIONS[i % len(MENTIONS)] for i in range(args.number)]
+    def uncached():
+        for text in texts: roll.parse_tokens.__wrapped__(roll.tokenize(text))
+    def cached():
+        for text in texts: roll.parse_dice(text)
+    def legacy():
+        for text in texts: legacy_parse_dice(text)
+
+    roll.parse_tokens.cache_clear()
+    for name, f in (("legacy", legacy), ("uncached", uncached), ("cached", cached)):
+        seconds = min(timeit.repeat(f, number=1, repeat=3))
+        print("{:<10} {:8.2f} us/parse".format(name, seconds / len(texts) * 1e6))
+    print(roll.parse_tokens.cache_info())
+
+if __name__ == "__main__":
+    main()
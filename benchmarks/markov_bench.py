@@ -0,0 +1,107 @@
+"""
+Compares the compiled NGramTextModel in ananas.default.markov with the
+string-keyed model it replaced: build time, peak RSS and sentences generated
+per second. Each model is measured in its own process so their peak RSS
+figures don't mix.
+
+    python benchmarks/markov_bench.py [--corpus FILE] [--lines N] [--n N]
+
+Without --corpus, a synthetic corpus with a Zipf-like word distribution is
+generated.
+"""
+import argparse, itertools, random, resource, subprocess, sys, time, os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def make_gram(word_array):
+    return " ".join(word_array)
+
+class LegacyNGramTextModel():
+    """ The model as it was before being compiled to integer arrays. """
+    def __init__(self, n, lines):
+        self.n = n
+        self.gram_dictionary = dict()
+        self.build_from_lines(lines)
+
+    def build_from_lines(self, lines):
+        for line in lines:
+            line = line.replace("\r", " ")
+            line = line.replace("\n", " ")
+            line_arr = ["^"] * self.n + [word.strip() for word in line.split()] + ["$"] * self.n
+
+            for i in range(self.n, len(line_arr)):
+                gram = make_gram(line_arr[i - self.n : i])
+                word = line_arr[i]
+                if (gram not in self.gram_dictionary):
+                    self.gram_dictionary[gram] = []
+                self.gram_dictionary[gram].append(word)
+
+    def generate_sentence(self):
+        sentence = self.n*["^"]
+        next_gram = sentence[-self.n : ]
+        while(next_gram != ["$"]*self.n):
+            try:
+                word_suggestion = random.choice(self.gram_dictionary[make_gram(next_gram)])
+                sentence += [word_suggestion]
+            except IndexError:
+                break
+            next_gram = sentence[-self.n : ]
+        return " ".join(sentence[self.n : -self.n])
+
+def synthetic_corpus(lines, vocab=20000, seed=1):
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(vocab)]
+    cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(vocab)))
+    out = []
+    for _ in range(lines):
+        out.append(" ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(4, 20))) + "\n")
+    return out
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def measure(model, args):
+    if args.corpus:
+        with open(args.corpus, "r") as f: lines = f.readlines()
+    else:
+        lines = synthetic_corpus(args.lines)
+    base_rss = max_rss_mb()
+
+    if model == "legacy":
+        cls = LegacyNGramTextModel
+    else:
+        from ananas.default.markov import NGramTextModel as cls
+
+    start = time.perf_counter()
+    m = cls(args.n, lines)
+    build = time.perf_counter() - start
+    rss = max_rss_mb() - base_rss
+
+    random.seed(1)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.seconds:
+        for _ in range(100): m.generate_sentence()
+        count += 100
+    rate = count / (time.perf_counter() - start)
+    print("{:<10} build {:8.3f}s   rss +{:8.1f}MB   {:10.0f} sentences/s".format(model, build, rss, rate))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Markov text models")
+    parser.add_argument("--corpus", help="corpus file, one sentence per line (default: synthetic)")
+    parser.add_argument("--lines", type=int, default=200000, help="lines of synthetic corpus")
+    parser.add_argument("--n", type=int, default=2, help="order of the model")
+    parser.add_argument("--seconds", type=float, default=3.0, help="how long to generate sentences for")
+    parser.add_argument("--model", choices=["legacy", "compiled"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.model:
+        measure(args.model, args)
+        return
+    for model in ("legacy", "compiled"):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--model", model] + sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
@@ -24,7 +24,7 @@ setup(name='ananas',
           'Topic :: Communications',
           'License :: OSI Approved :: MIT License',
           'Programming Language :: Python :: 3',
-          'Programming Language :: Python :: 3.3',
+          'Programming Language :: Python :: 3.7',
       ],
 
       packages=find_packages(exclude=['custom', 'dist']),
@@ -36,6 +36,9 @@ setup(name='ananas',
       package_data={
           'readme': ['readme.md'],
       },
-      install_requires=['requests', 'more_itertools', 'Mastodon.py>=1.3.0', 'configobj'],
-      python_requires='~=3.3',
+      install_requires=['requests', 'Mastodon.py>=1.3.0', 'configobj'],
+      extras_require={
+          'numpy': ['numpy'],
+      },
+      python_requires='>=3.7',
 )
@@ -0,0 +1,18 @@
+import itertools
+
+from ananas.pregen import Pregenerator
+
+def test_get_leaves_room_for_reserve():
+    outputs = itertools.cycle(["x" * 10, "y" * 4])
+    p = Pregenerator(lambda: next(outputs), size=0, max_length=10)
+    p.buffer.extend(["a" * 10, "b" * 5, "c" * 3])
+    assert p.get(reserve=6) == "c" * 3
+    assert list(p.buffer) == ["a" * 10, "b" * 5]
+    assert p.get() == "a" * 10
+    # Nothing ready fits, so one is generated
+    assert p.get(reserve=6) == "y" * 4
+
+def test_get_cuts_down_when_nothing_fits():
+    p = Pregenerator(lambda: "z" * 20, size=0, max_length=10)
+    assert p.get(reserve=3) == "z" * 7
+    assert p.stats()["rejected"] == Pregenerator.max_attempts
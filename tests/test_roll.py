@@ -0,0 +1,180 @@
+import itertools, math, random
+
+import pytest
+
+from ananas.default import roll
+from ananas.default.roll import parse_dice, parse_tokens, tokenize
+
+@pytest.mark.parametrize("text,expected", [
+    ("3d20k1 + d8 + 1", [('+', ('+', ('r', 3, 20, 'k', 1), ('r', 1, 8)), ('c', 1))]),
+    ("@roll 2d20, 2d6", [('r', 2, 20), ('r', 2, 6)]),
+    ("3 d20 + 2", [('+', ('r', 3, 20), ('c', 2))]),
+    ("3d20 k 4 - 2", [('-', ('r', 3, 20, 'k', 4), ('c', 2))]),
+    ("4d6d1", [('r', 4, 6, 'd', 1)]),
+    ("2x d6", [('x', ('c', 2), ('r', 1, 6))]),
+    ("3d6 * 2", [('*', ('r', 3, 6), ('c', 2))]),
+    ("3d6;d4", [('r', 3, 6), ('r', 1, 4)]),
+    ("d\U0001F4AF", [('r', 1, 100)]),
+    ("hello", []),
+    ("", []),
+])
+def test_parse_dice(text, expected):
+    assert parse_dice(text) == expected
+
+@pytest.mark.parametrize("a,b", [
+    # Runs of other characters are one token, whatever they are
+    ("hello 3d6", "hi!! 3d6"),
+    ("@roll@bots.social 2d20, 2d6", "@r 2d20, 2d6"),
+    # Whitespace only matters before numbers, and then not how much
+    ("3d6 +  2", "3d6 + 2"),
+    ("2d20 , 2d6", "2d20, 2d6"),
+    ("3d20k1", "3d20 k1"),
+    # Newlines are whitespace
+    ("3d6\n+ 2", "3d6 + 2"),
+])
+def test_tokenize_normalizes_equivalent_texts(a, b):
+    assert tokenize(a) == tokenize(b)
+    assert parse_dice(a) == parse_dice(b)
+
+@pytest.mark.parametrize("a,b", [
+    # Whitespace before the sides makes "3d 6" not a roll of d6s
+    ("3d6", "3d 6"),
+    ("3d6", "3x6"),
+    ("3d6 + 2", "3d6 +2"),
+])
+def test_tokenize_keeps_differences(a, b):
+    assert tokenize(a) != tokenize(b)
+
+def test_tokens():
+    assert tokenize("@roll 3d6+\U0001F4AF") == (('z', False), (3, True), ('d', False), (6, False), ('+', False), (100, False))
+
+def test_parse_is_cached_by_tokens():
+    parse_tokens.cache_clear()
+    parse_dice("@roll 7d7")
+    parse_dice("@r 7d7 ")
+    info = parse_tokens.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+
+def test_parse_returns_a_copy():
+    rolls = parse_dice("copy 2d4")
+    rolls.append(('r', 1, 6))
+    assert parse_dice("copy 2d4") == [('r', 2, 4)]
+
+# Distributions, with numpy if it's installed and without it
+
+@pytest.fixture(params=["numpy", "python"])
+def numpy_or_not(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(roll, "_numpy", None)
+    else:
+        monkeypatch.setattr(roll, "_numpy", False)
+    return request.param
+
+def brute_force(dice, sides, keep):
+    counts = {}
+    for faces in itertools.product(range(1, sides + 1), repeat=dice):
+        total = sum(sorted(faces, reverse=True)[:keep])
+        counts[total] = counts.get(total, 0) + 1
+    return {total: n / sides ** dice for total, n in counts.items()}
+
+def as_dict(distribution):
+    lo, p = distribution
+    return {lo + i: x for i, x in enumerate(p) if x > 1e-12}
+
+def assert_same(distribution, expected):
+    got = as_dict(distribution)
+    assert set(got) == set(expected)
+    for total, x in expected.items():
+        assert got[total] == pytest.approx(x, abs=1e-12)
+
+@pytest.mark.parametrize("dice,sides,keep", [
+    (1, 6, 1), (3, 6, 3), (4, 6, 3), (3, 20, 1), (5, 4, 2), (4, 3, 4), (2, 1, 1), (6, 3, 5),
+])
+def test_keep_distribution_matches_brute_force(numpy_or_not, dice, sides, keep):
+    assert_same(roll.dice_distribution(('r', dice, sides, 'k', keep)), brute_force(dice, sides, keep))
+    if keep < dice:
+        assert_same(roll.dice_distribution(('r', dice, sides, 'd', dice - keep)), brute_force(dice, sides, keep))
+
+def test_expression_distributions(numpy_or_not):
+    d6, d4 = range(1, 7), range(1, 5)
+    def expected(values):
+        counts = {}
+        for v in values: counts[v] = counts.get(v, 0) + 1
+        n = sum(counts.values())
+        return {v: c / n for v, c in counts.items()}
+
+    assert_same(roll.dice_distribution(parse_dice("2d6 - d4")[0]),
+                expected(a + b - c for a in d6 for b in d6 for c in d4))
+    assert_same(roll.dice_distribution(parse_dice("d6 * d4 + 3")[0]),
+                expected(a * b + 3 for a in d6 for b in d4))
+    assert_same(roll.dice_distribution(parse_dice("3x d4")[0]),
+                expected(a + b + c for a in d4 for b in d4 for c in d4))
+
+def test_4d6_drop_lowest_stats(numpy_or_not):
+    stats = roll.dice_stats(parse_dice("4d6d1")[0])
+    assert stats["mean"] == pytest.approx(12.2446, abs=1e-4)
+    assert (stats["min"], stats["max"]) == (3, 18)
+    assert stats["percentiles"] == {5: 7, 25: 10, 50: 12, 75: 14, 95: 17}
+
+def test_big_sum_stats(numpy_or_not):
+    stats = roll.dice_stats(parse_dice("300d20 + 5")[0])
+    assert stats["mean"] == pytest.approx(300 * 10.5 + 5)
+    assert stats["sd"] == pytest.approx(math.sqrt(300 * (20 ** 2 - 1) / 12))
+    assert stats["percentiles"][50] == 3155
+
+def test_product_keeps_unlikely_ends(numpy_or_not):
+    for text in ("100d6 * 3", "3 * 100d6"):
+        stats = roll.dice_stats(parse_dice(text)[0])
+        assert (stats["min"], stats["max"]) == (300, 1800)
+        assert stats["mean"] == pytest.approx(1050)
+
+@pytest.mark.parametrize("spec", [
+    ('r', 10000, 1000),
+    ('x', ('c', 10000), ('r', 10000, 1000)),
+    ('*', ('r', 1000, 1000), ('r', 1000, 1000)),
+    ('r', 50, 20, 'd', 1),
+    ('r', 10001, 6),
+    ('r', 3, 1001),
+])
+def test_stats_limits(numpy_or_not, spec):
+    with pytest.raises(roll.SillyDiceError):
+        roll.dice_stats(spec)
+
+def test_budget_is_shared():
+    budget = roll._Budget(1000)
+    roll.dice_stats(('r', 3, 6), budget)
+    with pytest.raises(roll.SillyDiceError):
+        for _ in range(100): roll.dice_stats(('r', 3, 6), budget)
+
+# Rolling
+
+def test_select_dice_keeps_order_and_earliest_ties():
+    assert roll.select_dice([3, 6, 1, 6, 2], 2) == [6, 6]
+    assert roll.select_dice([3, 6, 1, 6, 2], 3) == [3, 6, 6]
+    assert roll.select_dice([5, 5, 5, 5], 2) == [5, 5]
+    assert roll.select_dice([1, 2], 5) == [1, 2]
+
+def test_select_dice_matches_sorting():
+    rng = random.Random(1)
+    for _ in range(1000):
+        r = [rng.randint(1, 6) for _ in range(rng.randint(1, 20))]
+        keep = rng.randint(1, 25)
+        kept = sorted(sorted(range(len(r)), key=lambda i: -r[i])[:keep])
+        assert roll.select_dice(r, keep) == [r[i] for i in kept]
+
+def test_perform_roll_limits():
+    assert len(roll.perform_roll(50, 6)) == 50
+    assert len(roll.perform_roll(5, 6, keep=2)) == 2
+    assert len(roll.perform_roll(5, 6, drop=2)) == 3
+    for args in [(51, 6), (1, 0), (1, 1001), (4, 6, 0, -1), (4, 6, -1, 4), (4, 6, -1, 0)]:
+        with pytest.raises(roll.SillyDiceError):
+            roll.perform_roll(*args)
+
+def test_draw_dice(monkeypatch):
+    monkeypatch.setattr(roll, "numpy_min_dice", 1)
+    for _ in range(2):
+        faces = roll.draw_dice(2000, 6)
+        assert len(faces) == 2000 and set(faces) == set(range(1, 7))
+        assert all(isinstance(f, int) for f in faces)
+        monkeypatch.setattr(roll, "_numpy", False)
@@ -0,0 +1,91 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from ananas.ananas import Schedule, next_run, schedule, interval, daily, hourly
+
+def brute_next(s, t, limit):
+    """ Schedule.next, by trying every second after t. """
+    t = t.replace(microsecond=0) + timedelta(seconds=1)
+    end = t + limit
+    while t < end:
+        if s.matches(t): return t
+        t += timedelta(seconds=1)
+    return None
+
+# Each with a window long enough to always find the next match in
+@pytest.mark.parametrize("spec,days", [
+    ({"minute": 5}, 1),
+    ({"hour": 3, "minute": 30}, 2),
+    ({"minute": "*/15"}, 1),
+    ({"hour": "9-17", "minute": "0,30"}, 1),
+    ({"minute": "0-30/10", "second": 45}, 1),
+    ({"day_of_week": 2, "hour": 12}, 8),
+    ({"day_of_week": "5-6", "hour": 23, "minute": 59, "second": 59}, 8),
+    ({"day_of_month": "1,8,15,22,29", "hour": 0}, 10),
+    ({"second": "*/7"}, 1),
+])
+def test_next_matches_brute_force(spec, days):
+    s = Schedule(**spec)
+    rng = random.Random(repr(spec))
+    for _ in range(3):
+        t = datetime(2024, 2, 27) + timedelta(seconds=rng.randrange(4 * 86400), microseconds=rng.randrange(2) * 500000)
+        assert s.next(t) == brute_next(s, t, timedelta(days=days))
+
+def test_next_is_after_t_unless_inclusive():
+    s = Schedule(minute=0)
+    t = datetime(2024, 1, 1, 10, 0, 0)
+    assert s.next(t) == datetime(2024, 1, 1, 11, 0, 0)
+    assert s.next(t, inclusive=True) == t
+    assert s.next(t.replace(microsecond=1), inclusive=True) == datetime(2024, 1, 1, 11, 0, 0)
+
+def test_month_and_leap_day_rollover():
+    assert Schedule(day_of_month=31).next(datetime(2024, 4, 1)) == datetime(2024, 5, 31)
+    assert Schedule(month=2, day_of_month=29).next(datetime(2025, 1, 1)) == datetime(2028, 2, 29)
+    assert Schedule(month=12, day_of_month=31, hour=23, minute=59, second=59).next(
+        datetime(2024, 12, 31, 23, 59, 59)) == datetime(2025, 12, 31, 23, 59, 59)
+
+def test_day_of_month_wins_over_day_of_week():
+    s = Schedule(day_of_month=15, day_of_week=0)
+    assert s.day_of_week is None
+    assert s.next(datetime(2024, 1, 1)) == datetime(2024, 1, 15)
+
+def test_fully_pinned_schedule_ends():
+    s = Schedule(year=2024, month=6, day_of_month=1, hour=12, minute=0)
+    assert s.next(datetime(2024, 1, 1)) == datetime(2024, 6, 1, 12)
+    assert s.next(datetime(2024, 6, 1, 12)) is None
+
+def test_full_range_field_is_open():
+    assert Schedule(minute="*").minute is None
+    assert Schedule(hour=list(range(24))).hour is None
+
+@pytest.mark.parametrize("spec", [
+    {"minute": 60}, {"hour": "25"}, {"minute": "5-1"}, {"minute": "*/0"}, {"minute": "x"}, {"fortnight": 1},
+])
+def test_invalid_fields(spec):
+    with pytest.raises(ValueError):
+        Schedule(**spec)
+
+def test_next_run():
+    t = datetime(2024, 1, 1, 10, 20, 30)
+
+    @daily(hour=3)
+    def d(): pass
+    assert next_run(d, t, t) == datetime(2024, 1, 2, 3, 0, 0)
+
+    @hourly(minute=15)
+    @hourly(minute=45)
+    def h(): pass
+    assert next_run(h, t, t) == datetime(2024, 1, 1, 10, 45, 0)
+
+    @interval(60)
+    def i(): pass
+    assert next_run(i, t, t) == t + timedelta(seconds=60)
+    assert next_run(i, t, t - timedelta(seconds=120)) == t
+
+    # At least the interval after the last run, and then on the schedule
+    @interval(3600)
+    @schedule(minute="*/10")
+    def both(): pass
+    assert next_run(both, t, t) == datetime(2024, 1, 1, 11, 30, 0)
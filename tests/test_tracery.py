@@ -0,0 +1,105 @@
+import json, os, random
+
+import pytest
+
+from ananas.default.tracery import TraceryGrammar, load_grammar, _parse, _split
+
+def expand(rules, symbol="origin", seed=1):
+    random.seed(seed)
+    return TraceryGrammar(rules).eval(symbol)
+
+def test_plain_expansion():
+    assert expand({"origin": "hello #name#", "name": "world"}) == "hello world"
+
+def test_choices_are_all_reachable():
+    g = TraceryGrammar({"origin": ["#a#", "#b#"], "a": "x", "b": ["y", "z"]})
+    random.seed(1)
+    assert {g.eval("origin") for _ in range(200)} == {"x", "y", "z"}
+
+def test_deep_grammar_needs_no_recursion():
+    depth = 5000
+    rules = {"s{}".format(i): "#s{}#".format(i + 1) for i in range(depth)}
+    rules["s{}".format(depth)] = "end"
+    assert expand(rules, "s0") == "end"
+
+def test_runaway_grammar_is_stopped():
+    with pytest.raises(ValueError):
+        expand({"origin": "#origin##origin#"})
+
+def test_unknown_symbol():
+    with pytest.raises(KeyError):
+        expand({"origin": "#nope#"})
+
+@pytest.mark.parametrize("rule,expected", [
+    ("#x.a#", "an owl"),
+    ("#x.capitalize#", "Owl"),
+    ("#x.s#", "owls"),
+    ("#x.ed#", "owled"),
+    ("#x.s.capitalize#", "Owls"),
+    ("#x.replace(w,n)#", "onl"),
+    ("#x.replace(.,!)#", "owl"),
+    ("#y.replace(.,!)#", "a!b"),
+    ("#z.replace(a+,b)#", "ab"),
+    ("#y.capitalizeAll#", "A.B"),
+])
+def test_modifiers(rule, expected):
+    assert expand({"origin": rule, "x": "owl", "y": "a.b", "z": "aa+"}) == expected
+
+def test_unknown_modifier():
+    with pytest.raises(ValueError):
+        TraceryGrammar({"origin": "#x.nope#", "x": "a"})
+
+def test_push_binds_one_expansion():
+    g = TraceryGrammar({"origin": "[hero:#name#]#hero# and #hero#", "name": ["Ann", "Bo", "Cy"]})
+    random.seed(1)
+    for _ in range(50):
+        a, b = g.eval("origin").split(" and ")
+        assert a == b
+
+def test_push_with_several_rules_and_pop():
+    g = TraceryGrammar({"origin": "[x:a,b]#x#[x:POP]#x#", "x": "c"})
+    random.seed(1)
+    assert {g.eval("origin") for _ in range(100)} == {"ac", "bc"}
+
+def test_push_rules_split_outside_tags():
+    g = TraceryGrammar({"origin": "[y:#x.replace(a,b)#,q]#y#", "x": "aa"})
+    random.seed(1)
+    assert {g.eval("origin") for _ in range(100)} == {"bb", "q"}
+
+def test_push_inside_tag_is_scoped_to_it():
+    rules = {"origin": "#[x:in]y# #x#", "y": "#x#", "x": "out"}
+    assert expand(rules) == "in out"
+
+def test_bindings_are_per_eval():
+    g = TraceryGrammar({"origin": "#[n:#num#]say#", "say": "#n##n#", "num": ["1", "2", "3"]})
+    random.seed(2)
+    outputs = {g.eval("origin") for _ in range(100)}
+    assert outputs == {"11", "22", "33"}
+
+def test_escapes():
+    assert expand({"origin": "\\#not a tag\\# \\[nor this\\]"}) == "#not a tag# [nor this]"
+
+@pytest.mark.parametrize("rule", ["#unclosed", "[unclosed"])
+def test_bad_rules(rule):
+    with pytest.raises(ValueError):
+        TraceryGrammar({"origin": rule})
+
+def test_parse_sections():
+    assert _parse("a #b# [c:d] e") == [("text", "a "), ("tag", "b"), ("text", " "), ("action", "c:d"), ("text", " e")]
+
+def test_split():
+    assert _split("x.replace(.,!).s", ".", parens=True) == ["x", "replace(.,!)", "s"]
+    assert _split("#a.b(c,d)#,[e:f,g],h", ",") == ["#a.b(c,d)#", "[e:f,g]", "h"]
+    assert _split("a\\,b,c", ",") == ["a\\,b", "c"]
+
+def test_load_grammar_is_cached_until_changed(tmp_path):
+    path = tmp_path / "grammar.json"
+    path.write_text(json.dumps({"origin": "one"}))
+    g = load_grammar(str(path))
+    assert load_grammar(str(path)) is g
+    path.write_text(json.dumps({"origin": "two!"}))
+    st = os.stat(str(path))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+    g2 = load_grammar(str(path))
+    assert g2 is not g
+    assert g2.eval("origin") == "two!"